@@ -0,0 +1,6 @@
+import os
+
+TEMP_DIR   = '.gittest'
+TEMP_REPO  = TEMP_DIR+os.sep+'.gitroot'
+SAMPLES    = '..'+os.sep+'samples'
+
@@ -0,0 +1,37 @@
+from config import *
+import subprocess, os, urllib
+
+def _command(executable, *args):
+    params = [executable]+[a for a in args]
+    subprocess.check_call(params)
+
+def git(*args):
+    _command('git', '--git-dir='+getrepodir('.git'),
+             '--work-tree='+getrepodir(), *args)
+
+def rmdir_rf(dir):
+    subprocess.check_call(['rm', '-rf', dir])
+
+def getrepourl():
+    path = os.getcwd() + os.sep + TEMP_REPO
+    url = urllib.pathname2url(path)
+    url = url.lstrip('/')
+    return 'file:///'+url
+
+def getpath(basedir, rel_path):
+    rel_path = rel_path.strip('/') # remove leading and trailing slashes
+    path = basedir
+    if len(rel_path) and rel_path != '.':
+        rel_path = rel_path.replace('/', os.sep)
+        path += os.sep + rel_path
+    return path
+
+def gettempdir(rel_path=''):
+    return getpath(TEMP_DIR, rel_path)
+
+def getsamplesdir(rel_path=''):
+    return getpath(SAMPLES, rel_path)
+
+def getrepodir(rel_path=''):
+    return getpath(TEMP_REPO, rel_path)
+
@@ -0,0 +1,78 @@
+from config import *
+from framework import *
+import os, shutil, subprocess
+
+def operations(exchlist=[], removelist=[]):
+    if len(exchlist) == 0 and len(removelist) == 0:
+        return
+    for a, b in exchlist:
+        a = getrepodir(a)
+        b = getrepodir(b)
+        os.rename(a, a+'.tmp')
+        os.rename(b, a)
+        os.rename(a+'.tmp', b)
+    for removal in removelist:
+        git('rm', '-q', removal)
+    git('commit', '-q', '-a', '-m', 'doing some file manipulations')
+
+def setUp():
+    rmdir_rf(gettempdir())
+    os.mkdir(gettempdir())
+
+    subprocess.check_call(['git', 'init', '-q', getrepodir()])
+    git('config', 'user.name', 'xray')
+    git('config', 'user.email', 'xray@localhost')
+
+    imps = [
+        ('initial import', ['ActionscriptFile.as', 'CMakeLists.txt']),
+        ('foo import',     ['Makefile', 'Makefile.am', 'TCPSocket.m']),
+        ('blitz import',   ['blitzmax.bmx', 'bourne_again_script']),
+        ('clear fix',      ['clearsilver_template1.cs', 'configure']),
+        ('configure bug',  ['configure.in','core.lisp', 'cs1.cs']),
+        ('d script fix',   ['d_script', 'eiffel.e', 'empty.in']),
+        ('en language',    ['english.st', 'example.st', 'example.xsl']),
+        ('foo import 2',   ['foo.d', 'foo.ebuild', 'foo.eclass']),
+        ('mk files',       ['foo.mk', 'foo.pro', 'foo.rb', 'foo.sci']),
+        ('tex commit',     ['foo.tex', 'foo.vala', 'foo.vim']),
+        ('rocket files',   ['foo.cmake', 'bash_script', 'classic_basic.b',
+                            'configure.ac', 'tcl_script']),
+    ]
+
+    for log, files in imps:
+        for file in files:
+            shutil.copy(getsamplesdir(file), getrepodir())
+            git('add', file)
+        git('commit', '-q', '-m', log)
+
+    exchanges = [
+        ('english.st', 'example.st'),
+        ('foo.d', 'foo.ebuild'),
+        ('foo.mk', 'foo.pro'),
+        ('foo.rb', 'foo.sci'),
+        ('foo.tex', 'foo.vala'),
+    ]
+
+    removals = [ 'foo.cmake', 'bash_script' ]
+
+    operations(exchanges, removals)
+
+    # create a new branch and do some random operations
+    git('checkout', '-q', '-b', '1.0')
+
+    exchanges = [
+        ('Makefile', 'Makefile.am'),
+        ('TCPSocket.m', 'blitzmax.bmx'),
+        ('bourne_again_script', 'clearsilver_template1.cs'),
+        ('configure', 'configure.in'),
+    ]
+
+    removals = [ 'foo.vim' ]
+
+    operations(exchanges, removals)
+
+    # bring the branch back, its changes are seen as a single revision
+    git('checkout', '-q', 'master')
+    git('merge', '-q', '--no-ff', '-m', 'Merging branch 1.0', '1.0')
+
+if __name__ == '__main__':
+    setUp()
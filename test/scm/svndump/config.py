@@ -0,0 +1,6 @@
+import os
+
+TEMP_DIR   = '.svndumptest'
+TEMP_DUMP  = TEMP_DIR+os.sep+'repos.dump'
+SAMPLES    = '..'+os.sep+'samples'
+
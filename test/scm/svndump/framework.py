@@ -0,0 +1,95 @@
+from config import *
+import subprocess, os, urllib
+
+def rmdir_rf(dir):
+    subprocess.check_call(['rm', '-rf', dir])
+
+def getrepourl(filename=TEMP_DUMP):
+    path = os.getcwd() + os.sep + filename
+    url = urllib.pathname2url(path)
+    url = url.lstrip('/')
+    return 'file:///'+url
+
+def getpath(basedir, rel_path):
+    rel_path = rel_path.strip('/') # remove leading and trailing slashes
+    path = basedir
+    if len(rel_path) and rel_path != '.':
+        rel_path = rel_path.replace('/', os.sep)
+        path += os.sep + rel_path
+    return path
+
+def gettempdir(rel_path=''):
+    return getpath(TEMP_DIR, rel_path)
+
+def getsamplesdir(rel_path=''):
+    return getpath(SAMPLES, rel_path)
+
+def readsample(name):
+    f = open(getsamplesdir(name), 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def _props(props):
+    data = ''
+    for key in sorted(props):
+        value = props[key]
+        if value is None:
+            data += 'D %d\n%s\n' % (len(key), key)
+        else:
+            data += 'K %d\n%s\nV %d\n%s\n' % (len(key), key, len(value),
+                                              value)
+    return data + 'PROPS-END\n'
+
+class DumpWriter(object):
+    """Writes a dump file as 'svnadmin dump' does, so that tests do not
+    need a Subversion installation."""
+
+    def __init__(self, filename):
+        self._file = open(filename, 'wb')
+        self._file.write('SVN-fs-dump-format-version: 2\n\n')
+        self._file.write('UUID: 6f2e9a56-63c9-4b8e-a3a2-2b0b1c7d0e11\n\n')
+
+    def _write(self, headers, props=None, text=None):
+        content = ''
+        if props is not None:
+            props = _props(props)
+            headers.append(('Prop-content-length', len(props)))
+            content += props
+        if text is not None:
+            headers.append(('Text-content-length', len(text)))
+            content += text
+        if props is not None or text is not None:
+            headers.append(('Content-length', len(content)))
+        for (key, value) in headers:
+            self._file.write('%s: %s\n' % (key, value))
+        self._file.write('\n' + content + '\n\n')
+
+    def revision(self, revno, log, author='xray'):
+        self._write([('Revision-number', revno)], {
+            'svn:author' : author,
+            'svn:date'   : '2010-01-%02dT12:00:00.000000Z' % (revno + 1),
+            'svn:log'    : log,
+        })
+
+    def node(self, path, action, kind=None, text=None, props=None,
+             propdelta=False, copyfrom=None, textdelta=False):
+        headers = [('Node-path', path)]
+        if kind is not None:
+            headers.append(('Node-kind', kind))
+        headers.append(('Node-action', action))
+        if copyfrom is not None:
+            headers.append(('Node-copyfrom-rev', copyfrom[1]))
+            headers.append(('Node-copyfrom-path', copyfrom[0]))
+        if propdelta:
+            headers.append(('Prop-delta', 'true'))
+        if textdelta:
+            headers.append(('Text-delta', 'true'))
+        if action == 'add' and copyfrom is None and props is None:
+            props = {}
+        self._write(headers, props, text)
+
+    def close(self):
+        self._file.close()
+
@@ -0,0 +1,53 @@
+from config import *
+from framework import *
+import os
+
+def setUp():
+    rmdir_rf(gettempdir())
+    os.mkdir(gettempdir())
+
+    foo = readsample('foo.c')
+    dump = DumpWriter(TEMP_DUMP)
+
+    dump.revision(1, 'standard layout')
+    for dir in ('trunk', 'branches', 'tags'):
+        dump.node(dir, 'add', 'dir')
+
+    dump.revision(2, 'initial import')
+    dump.node('trunk/src', 'add', 'dir')
+    dump.node('trunk/src/foo.c', 'add', 'file', foo)
+    dump.node('trunk/Makefile', 'add', 'file', readsample('Makefile'))
+    dump.node('trunk/logo.png', 'add', 'file', '\x89PNG\r\n\x1a\n\0\0',
+              { 'svn:mime-type' : 'application/octet-stream' })
+
+    dump.revision(3, 'foo fix and eol style')
+    dump.node('trunk/src/foo.c', 'change', 'file', foo + '/* fixed */\n')
+    dump.node('trunk/Makefile', 'change', 'file',
+              props={ 'svn:eol-style' : 'native' }, propdelta=True)
+
+    dump.revision(4, 'tagging 1.0')
+    dump.node('tags/1.0', 'add', 'dir', copyfrom=('trunk', 3))
+
+    dump.revision(5, 'ruby bindings')
+    dump.node('trunk/src/foo.c', 'change', 'file', foo)
+    dump.node('trunk/src/foo.rb', 'add', 'file', readsample('foo.rb'))
+
+    # a copy of a copy, changed within the revision that makes it
+    dump.revision(6, 'maintenance branch for 1.0')
+    dump.node('branches/1.x', 'add', 'dir', copyfrom=('tags/1.0', 4))
+    dump.node('branches/1.x/logo.png', 'delete')
+    dump.node('branches/1.x/Makefile', 'change', 'file',
+              readsample('Makefile.am'))
+
+    dump.revision(7, 'sources moved away')
+    dump.node('trunk/src', 'delete')
+
+    dump.revision(8, 'sources brought back')
+    dump.node('trunk/src', 'add', 'dir', copyfrom=('trunk/src', 6))
+
+    dump.revision(9, 'retagging 1.0')
+    dump.node('tags/1.0', 'replace', 'dir', copyfrom=('trunk', 8))
+    dump.close()
+
+if __name__ == '__main__':
+    setUp()
@@ -0,0 +1,41 @@
+from config import *
+from framework import *
+import xray4scm.scm.svndump as svndump
+
+client = svndump.Client(getrepourl())
+client.setbranch('trunk')
+
+def changes(revno):
+    return dict([ (str(c.path), c)
+                  for c in client.getrev(revno).iterchanges() ])
+
+print 'Property only change:'
+makefile = changes(3)['/Makefile']
+assert makefile.changetype == 'M'
+assert not makefile.textmodified()
+assert changes(3)['/src/foo.c'].textmodified()
+assert client.cat(3, '/Makefile') == readsample('Makefile')
+print '   ok'
+
+print 'Binary files by their mime-type:'
+logo = changes(2)['/logo.png']
+assert logo.path.isbinary() and not changes(2)['/Makefile'].path.isbinary()
+assert logo.path.size() == 10
+print '   ok'
+
+print 'Deleted directory:'
+src = changes(7)['/src']
+assert src.changetype == 'D' and src.path.isdir()
+assert src.textmodified() is None
+assert [ p for (p, size, binary) in client.listfiles(7)
+         if p.startswith('/src/') ] == []
+assert client.cat(7, '/src/foo.c') == ''
+assert client.cat(6, '/src/foo.c') == readsample('foo.c')
+print '   ok'
+
+print 'Deleted file of a copied directory:'
+client.setbranch('branches/1.x')
+logo = changes(6)['/logo.png']
+assert logo.changetype == 'D' and logo.path.isfile()
+assert logo.path.isbinary()
+print '   ok'
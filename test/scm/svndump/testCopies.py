@@ -0,0 +1,57 @@
+from config import *
+from framework import *
+import xray4scm.scm.svndump as svndump
+
+foo = readsample('foo.c')
+
+def files(client, revno, path='/'):
+    return dict([ (p, (size, binary)) for (p, size, binary)
+                  in client.listfiles(revno, path) ])
+
+client = svndump.Client(getrepourl())
+
+print 'Copy of trunk as a tag:'
+client.setbranch('tags/1.0')
+rev = client.getrev(4)
+changes = list(rev.iterchanges())
+assert len(changes) == 1
+(origin, originrev) = changes[0].getorigin()
+assert changes[0].iscopy() and changes[0].path.isdir()
+assert (origin.fullpath, originrev) == ('/trunk', 3)
+tagged = files(client, 4)
+print '   %s' % sorted(tagged)
+assert sorted(tagged) == ['/Makefile', '/logo.png', '/src/foo.c']
+assert client.cat(4, '/src/foo.c') == foo + '/* fixed */\n'
+assert tagged['/logo.png'][1]
+
+print 'Later changes to trunk do not reach the tag:'
+assert files(client, 5) == tagged
+assert client.cat(5, '/src/foo.c') == foo + '/* fixed */\n'
+assert ''.join(client.catchunks(5, '/src/foo.c', 10)) == \
+    foo + '/* fixed */\n'
+print '   ok'
+
+print 'Copy of a copy, changed while copied:'
+client.setbranch('branches/1.x')
+branched = files(client, 6)
+print '   %s' % sorted(branched)
+assert sorted(branched) == ['/Makefile', '/src/foo.c']
+assert client.cat(6, '/Makefile') == readsample('Makefile.am')
+assert [ c.changetype for c in client.getrev(6).iterchanges() ] == \
+    ['A', 'D', 'M']
+
+print 'Directory copied back from before its deletion:'
+client.setbranch('trunk')
+assert files(client, 7, '/src') == {}
+restored = files(client, 8)
+print '   %s' % sorted(restored)
+assert sorted(restored) == ['/Makefile', '/logo.png', '/src/foo.c',
+                            '/src/foo.rb']
+assert client.cat(8, '/src/foo.c') == foo
+
+print 'Tag replaced by a newer copy:'
+client.setbranch('tags/1.0')
+assert sorted(files(client, 9)) == sorted(restored)
+assert client.cat(9, '/src/foo.rb') == readsample('foo.rb')
+assert sorted(files(client, 8)) == sorted(tagged)
+print '   ok'
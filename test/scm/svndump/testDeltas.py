@@ -0,0 +1,19 @@
+from config import *
+from framework import *
+import xray4scm.scm.svndump as svndump
+import xray4scm.error as error
+
+filename = gettempdir('deltas.dump')
+dump = DumpWriter(filename)
+dump.revision(1, 'dumped with --deltas')
+dump.node('foo.c', 'add', 'file', 'SVN\0\0\0\0', textdelta=True)
+dump.close()
+
+print 'Dump file with deltas:'
+client = svndump.Client(getrepourl(filename))
+try:
+    client.listfiles(1)
+except error.Abort as inst:
+    print '   refused: %s' % inst
+else:
+    raise AssertionError('dump file with deltas was read')
@@ -0,0 +1,72 @@
+from datetime import datetime
+import os, tempfile, shutil
+import xray4scm.storage as storage
+from xray4scm.storage import migrate
+
+tempdir = tempfile.mkdtemp()
+try:
+    path = os.path.join(tempdir, 'xray.db')
+    storage.init(storage.connectionForURI('sqlite://' + path))
+    conn = storage._connection
+
+    print 'Creating a database of version %d' % migrate.version
+    storage.create()
+    assert storage.checkVersion(None)
+    assert storage.upgrade() == 0
+
+    # some history, its reports to be computed again by the upgrade
+    storage.addRepos('svn+file:///xray')
+    storage.addBranch('svn+file:///xray', 'trunk')
+    branch = storage.Branch.select().getOne()
+    history = [
+        (1, [('A', '/a.c', [('c', 10, 2, 1)]),
+             ('A', '/b.py', [('python', 5, 0, 0)])]),
+        (2, [('M', '/a.c', [('c', 12, 2, 1)])]),
+        (3, [('D', '/b.py', [])]),
+    ]
+    trans = storage.transaction()
+    for (revno, changes) in history:
+        rev = branch.insertRevision(revno, 'xray', 'log', datetime.now(),
+                                    connection=trans)
+        rev.insertChanges([ (changetype, path, locs, [])
+                            for (changetype, path, locs) in changes ],
+                          connection=trans)
+    branch.rebuildReports(connection=trans)
+    trans.commit(close=True)
+    totals = [ t[2:] for t in branch.getLocTotals() ]
+    assert totals == [(15, 2, 1), (17, 2, 1), (12, 2, 1)], totals
+
+    def downgrade():
+        # as left by the first version of XRay
+        storage.Metadata.select().getOne().version = '1'
+        for table in ('revision', 'change'):
+            for (name,) in conn.queryAll("SELECT name FROM sqlite_master "
+                    "WHERE type = 'index' AND tbl_name = '%s' AND name IN "
+                    "('revision_branchCommitdate', 'change_pathRevision')"
+                    % table):
+                conn.query('DROP INDEX %s' % name)
+        storage.RevisionLoc.dropTable()
+        storage.SnapshotOversized.dropTable()
+        storage.LocDelta.clearTable()
+
+    def notify(version, description):
+        print '  upgrading to version %d: %s' % (version, description)
+
+    print 'Upgrading a database of version 1'
+    downgrade()
+    assert not storage.checkVersion(None)
+    assert storage.upgrade(notify) == migrate.version - 1
+    assert storage.checkVersion(None)
+    assert storage.RevisionLoc.tableExists()
+    assert storage.SnapshotOversized.tableExists()
+    assert [ t[2:] for t in branch.getLocTotals() ] == totals
+    assert migrate._hasIndex(conn, storage.Revision, 'branchCommitdate')
+    assert migrate._hasIndex(conn, storage.Change, 'pathRevision')
+
+    print 'Upgrading again, as after an interrupted upgrade'
+    storage.Metadata.select().getOne().version = '1'
+    assert storage.upgrade(notify) == migrate.version - 1
+    assert storage.checkVersion(None)
+    print 'Done'
+finally:
+    shutil.rmtree(tempdir)
@@ -6,8 +6,8 @@
 # GNU General Public License version 2, incorporated herein by reference.
 
 import os, sys, errno, shutil
-import error, storage
-import scm, sync, report
+import error, storage, util
+import scm, sync, report, recount, store
 from i18n import _
 from ConfigParser import SafeConfigParser
 from string import Template
@@ -44,6 +44,7 @@ class CmdLine(cmdln.Cmdln):
         cmdln.Cmdln.do_help.aliases.append("h")
         self._config = SafeConfigParser()
         self._ui = ui
+        self._contentstore = None
 
     def get_optparser(self):
         """this is the parser for "global" options (not specific to subcommand)"""
@@ -107,7 +108,7 @@ class CmdLine(cmdln.Cmdln):
                     " database %s" % self._sqldb))
         storage.init(connection)
 
-    def _loadConfig(self):
+    def _loadConfig(self, checkversion=True):
         dest = os.getcwd()
         xraydir = os.path.join(dest, '.xray')
         if not os.path.isdir(xraydir):
@@ -116,13 +117,20 @@ class CmdLine(cmdln.Cmdln):
         self._config.read(os.path.join(xraydir, 'storage.conf'))
         sqldb = self._config.get('Storage', 'sqldb')
         self._connectToDatabase(sqldb)
-        storage.checkVersion()
+        if checkversion:
+            storage.checkVersion()
+        if self._config.has_option('Storage', 'contentstore'):
+            self._contentstore = store.ContentStore(os.path.join(xraydir,
+                self._config.get('Storage', 'contentstore')))
 
     @alias('create')
     @option("--db", metavar='SQLDB-URI',
             help="uses an alternative database as storage backend")
     @option("--force", action='store_true',
             help="force the creation of XRay repository")
+    @option("--content-store", action='store_true',
+            help="keep the contents of the synchronized files under "
+                 "'.xray/store', so that they can be recounted later")
     def do_init(self, subcmd, opts, *args):
         """${cmd_name}: Create XRay database
 
@@ -179,6 +187,8 @@ class CmdLine(cmdln.Cmdln):
 
         self._config.add_section('Storage')
         self._config.set('Storage', 'sqldb', sqldb)
+        if opts.content_store:
+            self._config.set('Storage', 'contentstore', 'store')
 
         with open(os.path.join(xraydir, './storage.conf'), 'wb') as configfile:
             self._config.write(configfile)
@@ -209,6 +219,22 @@ class CmdLine(cmdln.Cmdln):
         self._loadConfig()
         storage.clear()
 
+    def do_upgrade(self, subcmd, opts):
+        """${cmd_name}: Upgrade XRay database
+
+        Usage: xray upgrade
+
+        Bring a database created by an earlier version of XRay to the
+        current one in place, keeping everything synchronized so far. An
+        interrupted upgrade resumes where it stopped."""
+
+        self._loadConfig(checkversion=False)
+        def notify(version, description):
+            self._ui.writenl(_("Upgrading to version %d: %s...") %
+                             (version, description))
+        if storage.upgrade(notify) == 0:
+            self._ui.writenl(_("The database is up-to-date."))
+
     @alias('addr')
     @cmdln.option('--force', action='store_true',
                   help='force addition of the repositories even if they are not available')
@@ -319,6 +345,88 @@ class CmdLine(cmdln.Cmdln):
         r = storage.Repository.byArg(repos)
         for b in bs:
             storage.rmBranch(r, b)
+
+    @option("--stream", action='store_true',
+            help="count larger files in pieces instead of skipping them")
+    def do_setlimit(self, subcmd, opts, repos, size):
+        """${cmd_name}: Limit the size of files read from a repository
+
+        Usage: xray setlimit [OPTIONS] REPOS SIZE
+
+        Set the size above which files of a repository are not read at once
+        while synchronizing. The size of each file is asked before reading
+        it: larger files are skipped and recorded as such, or counted a
+        piece at a time with '--stream'. A SIZE of 0 removes the limit.
+
+        You can use the URI format of the repository or the repository-id.
+        Examples:
+
+          $ xray setlimit svn+http://some.host/some/path 10mb
+          $ xray setlimit --stream 10 512kb
+          $ xray setlimit 10 0
+
+       Options:
+         ${cmd_option_list}"""
+
+        self._loadConfig()
+        r = storage.Repository.byArg(repos)
+        maxsize = util.sizetoint(size)
+        if maxsize < 0:
+            raise error.Abort(_("invalid size: %s") % size)
+        r.setSizeLimit(maxsize or None, opts.stream)
+
+    @alias('addf')
+    @option("--include", action='store_true',
+            help="synchronize only the paths matching the patterns (and "
+                 "those matching other include patterns)")
+    def do_addfilter(self, subcmd, opts, repos, branch, pattern,
+                     *pattern_list):
+        """${cmd_name}: Keep paths of a branch from being synchronized
+
+        Usage: xray addfilter [OPTIONS] REPOS BRANCH PATTERN...
+
+        Exclude paths matching glob patterns from synchronization, or with
+        '--include', synchronize only the paths matching them. Filtered
+        paths are dropped before anything is asked about them to the
+        repository. Patterns holding a '/' are taken from the root of the
+        branch, the others match a file or directory name at any depth.
+        Revisions already synchronized are left as they are.
+
+        You can use the URI format of the repository or the repository-id.
+        Examples:
+
+          $ xray addfilter 10 trunk vendor third_party '*.min.js'
+          $ xray addfilter 10 trunk /src/generated
+          $ xray addfilter --include 10 trunk /src /include
+
+       Options:
+         ${cmd_option_list}"""
+
+        self._loadConfig()
+        ps = [ pattern ]
+        ps += [ p for p in pattern_list ]
+        for p in ps:
+            storage.addFilter(repos, branch, p, opts.include)
+
+    @alias('rmf')
+    def do_rmfilter(self, subcmd, opts, repos, branch, pattern,
+                    *pattern_list):
+        """${cmd_name}: Remove path filters of a branch
+
+        Usage: xray rmfilter REPOS BRANCH PATTERN...
+
+        Remove include or exclude patterns added with 'addfilter'.
+
+        You can use the URI format of the repository or the repository-id.
+        Examples:
+
+          $ xray rmfilter 10 trunk vendor"""
+
+        self._loadConfig()
+        ps = [ pattern ]
+        ps += [ p for p in pattern_list ]
+        for p in ps:
+            storage.rmFilter(repos, branch, p)
  
     @alias('ls', 'l')
     def do_list(self, subcmd, opts, *repos):
@@ -346,22 +454,67 @@ class CmdLine(cmdln.Cmdln):
                 (r.id, r.url, r.updated)
             )
 
+            limit = r.getSizeLimit()
+            if limit is not None:
+                self._ui.writenl(
+                    "size-limit:   %d bytes (%s)\n" %
+                    (limit[0], limit[1] and 'streamed' or 'skipped'))
+
             branches = r.branches
             if len(branches) > 0:
                 for b in branches:
                     firstrev = b.getFirstRev(0)
                     lastrev = b.getLastRev(0)
+                    (includes, excludes) = b.getFilters()
+                    filters = ''
+                    snapshot = b.getSnapshot()
+                    if snapshot is not None and not snapshot.complete:
+                        # read backwards from a snapshot, not done yet
+                        firstrev = snapshot.nextRev+1
+                        lastrev = max(lastrev, snapshot.revno)
+                        filters += "pending:      %d-%d\n" % \
+                            (snapshot.startRev, snapshot.nextRev)
+                    if len(includes) > 0:
+                        filters += "include:      %s\n" % ' '.join(includes)
+                    if len(excludes) > 0:
+                        filters += "exclude:      %s\n" % ' '.join(excludes)
                     self._ui.writenl(
                         "branch:       %s\n"
                         "first-revlog: %d\n"
-                        "last-revlog:  %d\n" %
-                        (b.name, firstrev, lastrev))
+                        "last-revlog:  %d\n%s" %
+                        (b.name, firstrev, lastrev, filters))
  
     @alias('syn', 's')
+    @option("-j", "--jobs", type='int', default=1, metavar='N',
+            help="count lines of code using N worker processes")
+    @option("--pipeline", type='int', default=0, metavar='DEPTH',
+            help="fetch, count and store revisions concurrently, queueing "
+                 "at most DEPTH revisions between each step")
+    @option("-p", "--parallel", type='int', default=1, metavar='N',
+            help="synchronize up to N repositories at the same time")
+    @option("-b", "--branches", type='int', default=1, metavar='N',
+            help="synchronize up to N branches of a repository at the "
+                 "same time")
+    @option("--commit-every", type='int', default=1, metavar='N',
+            help="commit the database transaction every N revisions")
+    @option("--fetch-jobs", type='int', default=1, metavar='N',
+            help="download up to N files of a revision at the same time")
+    @option("--prefetch", type='int', default=0, metavar='N',
+            help="download the files of up to N revisions ahead of the "
+                 "one being counted and stored")
+    @option("--prefetch-size", type='int', default=64, metavar='MB',
+            help="keep at most MB megabytes of prefetched files in memory "
+                 "(default: 64)")
+    @option("--head-first", action='store_true', default=False,
+            help="count the files of new branches at their last revision "
+                 "first, then read their history backwards")
+    @option("--backfill", type='int', default=0, metavar='N',
+            help="read at most N revisions of history backwards per branch "
+                 "(default: all of them)")
     def do_sync(self, subcmd, opts, *repos):
         """${cmd_name}: Synchronize metadata from repositories
 
-        Usage: xray sync [REPOS]...
+        Usage: xray sync [OPTIONS] [REPOS]...
  
         Synchronize metadata from repositories to XRay database.
  
@@ -372,22 +525,158 @@ class CmdLine(cmdln.Cmdln):
         Examples:
  
           $ xray sync svn+http://some.host/some/path
-          $ xray sync 10"""
+          $ xray sync 10
+          $ xray sync --jobs=4
+          $ xray sync --jobs=4 --pipeline=8
+          $ xray sync --parallel=8
+          $ xray sync --branches=4 svn+http://some.host/some/path
+          $ xray sync --commit-every=200
+          $ xray sync --fetch-jobs=4 --pipeline=8
+          $ xray sync --prefetch=32 --prefetch-size=256
+          $ xray sync --head-first --backfill=1000
+
+       Options:
+         ${cmd_option_list}"""
 
+        if opts.jobs < 1:
+            raise error.Abort(_("invalid number of jobs: %d") % opts.jobs)
+        if opts.pipeline < 0:
+            raise error.Abort(_("invalid pipeline depth: %d") % opts.pipeline)
+        if opts.parallel < 1:
+            raise error.Abort(_("invalid number of parallel "
+                    "repositories: %d") % opts.parallel)
+        if opts.branches < 1:
+            raise error.Abort(_("invalid number of parallel "
+                    "branches: %d") % opts.branches)
+        if opts.commit_every < 1:
+            raise error.Abort(_("invalid number of revisions "
+                    "per commit: %d") % opts.commit_every)
+        if opts.fetch_jobs < 1:
+            raise error.Abort(_("invalid number of fetch jobs: %d") %
+                              opts.fetch_jobs)
+        if opts.prefetch < 0:
+            raise error.Abort(_("invalid number of revisions to "
+                    "prefetch: %d") % opts.prefetch)
+        if opts.prefetch_size < 1:
+            raise error.Abort(_("invalid prefetch size: %d") %
+                              opts.prefetch_size)
+        if opts.backfill < 0:
+            raise error.Abort(_("invalid number of revisions to "
+                    "backfill: %d") % opts.backfill)
         self._loadConfig()
         if len(repos) == 0:
             repos = storage.getRepositories()
         else:
             repos = [storage.Repository.byArg(r) for r in repos]
 
+        if opts.parallel > 1 and len(repos) > 1:
+            sync.executeparallel(repos, self._ui, self.options.verbose,
+                                 self._sqldb, opts.parallel,
+                                 jobs=opts.jobs, depth=opts.pipeline,
+                                 branchjobs=opts.branches,
+                                 commitevery=opts.commit_every,
+                                 fetchjobs=opts.fetch_jobs,
+                                 lookahead=opts.prefetch,
+                                 prefetchsize=opts.prefetch_size*1024*1024,
+                                 contentstore=self._contentstore,
+                                 headfirst=opts.head_first,
+                                 backfill=opts.backfill)
+            return
+
         for r in repos:
             try:
-                sync.execute(r, self._ui, self.options.verbose)
+                sync.execute(r, self._ui, self.options.verbose,
+                             jobs=opts.jobs, depth=opts.pipeline,
+                             branchjobs=opts.branches,
+                             commitevery=opts.commit_every,
+                             fetchjobs=opts.fetch_jobs,
+                             lookahead=opts.prefetch,
+                             prefetchsize=opts.prefetch_size*1024*1024,
+                             contentstore=self._contentstore,
+                             headfirst=opts.head_first,
+                             backfill=opts.backfill)
             except error.Abort as inst:
                 self._ui.warn("abort: %s\n" % inst)
             except:
                 raise
 
+    @option("-j", "--jobs", type='int', default=0, metavar='N',
+            help="count lines of code using N worker processes (default: "
+                 "one per processor)")
+    def do_recount(self, subcmd, opts, *repos):
+        """${cmd_name}: Count lines of code again from stored contents
+
+        Usage: xray recount [OPTIONS] [REPOS]...
+
+        Rebuild the lines of code of already synchronized revisions from
+        the contents kept in the content store, without accessing the
+        repositories. Useful after upgrading ohcount, to apply its new
+        rules. The content store is enabled by 'xray init --content-store',
+        or by adding 'contentstore = store' to the Storage section of
+        '.xray/storage.conf'; only files synchronized since then can be
+        recounted.
+
+        Examples:
+
+          $ xray recount
+          $ xray recount --jobs=4 10
+
+       Options:
+         ${cmd_option_list}"""
+
+        if opts.jobs < 0:
+            raise error.Abort(_("invalid number of jobs: %d") % opts.jobs)
+        self._loadConfig()
+        if self._contentstore is None:
+            raise error.Abort(_("There is no content store to recount "
+                "from (see 'xray help recount')"))
+        if len(repos) == 0:
+            repos = storage.getRepositories()
+        else:
+            repos = [storage.Repository.byArg(r) for r in repos]
+
+        for r in repos:
+            recount.execute(r, self._ui, self.options.verbose,
+                            self._contentstore, opts.jobs or None)
+
+    def do_rebuild(self, subcmd, opts, *repos):
+        """${cmd_name}: Compute again what reports are made of
+
+        Usage: xray rebuild [REPOS]...
+
+        Compute again, from the lines of code stored for each file, the
+        lines each change added, and from these the totals of each branch
+        after each revision, which reports read. 'xray upgrade' does it
+        already for databases of earlier versions of XRay. Branches
+        synchronized head-first only get their totals computed again.
+
+        Examples:
+
+          $ xray rebuild
+          $ xray rebuild 10
+
+       Options:
+         ${cmd_option_list}"""
+
+        self._loadConfig()
+        if len(repos) == 0:
+            repos = storage.getRepositories()
+        else:
+            repos = [storage.Repository.byArg(r) for r in repos]
+
+        for r in repos:
+            self._ui.writenl(_("Rebuilding repo %s...") % r.url)
+            for b in r.branches:
+                self._ui.write("  " + _("Branch %s: ") % b.name)
+                trans = storage.transaction()
+                try:
+                    b.rebuildReports(connection=trans)
+                except:
+                    trans.rollback()
+                    raise
+                trans.commit(close=True)
+                self._ui.writenl(_("done"))
+
     @alias('bk')
     def do_backends(self, subcmd, opts):
         """${cmd_name}: List available backends
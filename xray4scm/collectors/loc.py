@@ -18,15 +18,19 @@ class Loc(collectorbase.Collector):
 
     def collect(self, branch):
         x, y1, y2, y3 = [], [], [], []
-        code, comments, blanks = 0, 0, 0
-        for rev in branch.revisions:
-            (c_code, c_comments, c_blanks) = rev.getLocDiff()
-
-            code += c_code
-            comments += c_comments
-            blanks += c_blanks
-
-            x.append(rev.commitdate)
+        totals = branch.getLocTotals()
+        snapshot = branch.getSnapshot()
+        if snapshot is not None:
+            if snapshot.revno not in [ t[0] for t in totals ]:
+                totals.append((snapshot.revno, snapshot.commitdate) +
+                              snapshot.getTotals())
+                totals.sort()
+            if not snapshot.complete:
+                self.note = 'history from revision %d on, back to %d ' \
+                    'pending' % (snapshot.nextRev+1, snapshot.startRev)
+
+        for (revno, date, code, comments, blanks) in totals:
+            x.append(date)
             y1.append(code+comments+blanks)
             y2.append(code+comments)
             y3.append(code)
@@ -0,0 +1,49 @@
+# match.py - path filters for XRay.
+#
+# Copyright (C) 2010 Guilherme Versiani <guibv@comunip.com.br>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+import fnmatch
+
+def _matches(pattern, parts):
+    """Tell whether a glob pattern matches a path (given as a list of its
+    names) or one of its parent directories. Patterns holding a '/' are
+    taken from the root of the branch, the others match a single name at
+    any depth, like in '.gitignore' files."""
+    pattern = pattern.strip('/')
+    if '/' not in pattern:
+        for name in parts:
+            if fnmatch.fnmatchcase(name, pattern):
+                return True
+        return False
+    for i in xrange(len(parts)):
+        if fnmatch.fnmatchcase('/'.join(parts[:i+1]), pattern):
+            return True
+    return False
+
+def match(includes=[], excludes=[]):
+    """Return a function telling whether a path (relative to a branch) is
+    wanted: it must match one of the includes, if any, and none of the
+    excludes. Returns None when there is nothing to filter."""
+    if len(includes) == 0 and len(excludes) == 0:
+        return None
+
+    def accept(path):
+        parts = [ p for p in path.split('/') if p ]
+        if len(parts) == 0:
+            return True
+        for pattern in excludes:
+            if _matches(pattern, parts):
+                return False
+        if len(includes) == 0:
+            return True
+        for pattern in includes:
+            if _matches(pattern, parts):
+                return True
+        return False
+
+    return accept
+
+# Modeline for vim: set tw=79 et ts=4:
@@ -0,0 +1,218 @@
+# pipeline.py - bounded multi-stage pipelines for XRay.
+#
+# Copyright (C) 2010 Guilherme Versiani <guibv@comunip.com.br>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+import sys, time, threading, Queue
+
+# marks the end of the items flowing through a queue
+_end = object()
+
+class Stopped(Exception):
+    """Raised inside a stage when the pipeline has been stopped."""
+
+class Stage(object):
+    """One step of a pipeline.
+
+    Every item read from the input queue is handed to `func`, and the
+    result is written to the output queue. The first stage has no input:
+    its `func` is called without arguments and must return an iterable.
+    Each time the stage has to wait for its input or its output it counts
+    a stall, so the slowest stage of the pipeline can be identified."""
+
+    def __init__(self, pipeline, name, func):
+        self.pipeline  = pipeline
+        self.name      = name
+        self.func      = func
+        self.input     = None
+        self.output    = None
+        self.items     = 0
+        self.inputstalls  = 0
+        self.outputstalls = 0
+        self.inwait    = 0.0
+        self.outwait   = 0.0
+
+    def _wait(self, incoming, op, *args):
+        start = time.time()
+        try:
+            while True:
+                if self.pipeline.stopped.isSet():
+                    raise Stopped()
+                try:
+                    return op(*(args + (True, 0.1)))
+                except (Queue.Full, Queue.Empty):
+                    pass
+        finally:
+            waited = time.time() - start
+            if incoming:
+                self.inwait += waited
+            else:
+                self.outwait += waited
+
+    def get(self):
+        try:
+            return self.input.get_nowait()
+        except Queue.Empty:
+            self.inputstalls += 1
+        return self._wait(True, self.input.get)
+
+    def put(self, item):
+        try:
+            return self.output.put_nowait(item)
+        except Queue.Full:
+            self.outputstalls += 1
+        return self._wait(False, self.output.put, item)
+
+    def run(self):
+        try:
+            if self.input is None:
+                for item in self.func():
+                    self.items += 1
+                    self.put(item)
+            else:
+                while True:
+                    item = self.get()
+                    if item is _end:
+                        break
+                    self.items += 1
+                    result = self.func(item)
+                    if self.output is not None:
+                        self.put(result)
+            if self.output is not None:
+                self.put(_end)
+        except Stopped:
+            pass
+        except:
+            self.pipeline.fail(sys.exc_info())
+
+class Pipeline(object):
+    """A chain of stages connected by queues holding at most `depth`
+    items each. All stages run in their own threads except the last one,
+    which runs in the thread calling run()."""
+
+    def __init__(self, depth=8):
+        self.depth   = depth
+        self.stages  = []
+        self.stopped = threading.Event()
+        self._failure = None
+
+    def add(self, name, func):
+        stage = Stage(self, name, func)
+        if len(self.stages) > 0:
+            queue = Queue.Queue(self.depth)
+            self.stages[-1].output = queue
+            stage.input = queue
+        self.stages.append(stage)
+        return stage
+
+    def fail(self, exc_info):
+        if self._failure is None:
+            self._failure = exc_info
+        self.stopped.set()
+
+    def run(self):
+        threads = []
+        for stage in self.stages[:-1]:
+            t = threading.Thread(target=stage.run,
+                                 name='xray-%s' % stage.name)
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        try:
+            self.stages[-1].run()
+        finally:
+            self.stopped.set()
+            for t in threads:
+                t.join()
+        if self._failure is not None:
+            raise self._failure[0], self._failure[1], self._failure[2]
+
+    def stats(self):
+        """Return a list of (name, items, inputstalls, inwait,
+        outputstalls, outwait) tuples, one for each stage."""
+        return [ (s.name, s.items, s.inputstalls, s.inwait,
+                  s.outputstalls, s.outwait) for s in self.stages ]
+
+class Prefetcher(object):
+    """Reads ahead an iterable in a thread of its own, keeping at most
+    `items` items and `size` bytes (as told by `sizeof`) waiting to be
+    consumed. An item larger than the whole budget is still let through
+    when nothing else is waiting. Errors raised while reading ahead are
+    raised again by the consumer once it reaches them."""
+
+    def __init__(self, iterable, items, size, sizeof=len):
+        self.iterable = iterable
+        self.items    = items
+        self.size     = size
+        self.sizeof   = sizeof
+        self.buffered = 0
+        self.consumed = 0
+        self.stalls   = 0
+        self._pending = []
+        self._done    = False
+        self._failure = None
+        self._stopped = False
+        self._cond    = threading.Condition()
+
+    def _full(self, size):
+        if len(self._pending) == 0:
+            return False
+        return len(self._pending) >= self.items or \
+            self.buffered + size > self.size
+
+    def _run(self):
+        try:
+            for item in self.iterable:
+                size = self.sizeof(item)
+                self._cond.acquire()
+                try:
+                    while self._full(size) and not self._stopped:
+                        self._cond.wait(0.1)
+                    if self._stopped:
+                        return
+                    self._pending.append((item, size))
+                    self.buffered += size
+                    self._cond.notifyAll()
+                finally:
+                    self._cond.release()
+        except:
+            self._failure = sys.exc_info()
+        finally:
+            self._cond.acquire()
+            self._done = True
+            self._cond.notifyAll()
+            self._cond.release()
+
+    def __iter__(self):
+        t = threading.Thread(target=self._run, name='xray-prefetch')
+        t.setDaemon(True)
+        t.start()
+        try:
+            while True:
+                self._cond.acquire()
+                try:
+                    if len(self._pending) == 0 and not self._done:
+                        self.stalls += 1
+                    while len(self._pending) == 0 and not self._done:
+                        self._cond.wait(0.1)
+                    if len(self._pending) == 0:
+                        break
+                    (item, size) = self._pending.pop(0)
+                    self.buffered -= size
+                    self.consumed += 1
+                    self._cond.notifyAll()
+                finally:
+                    self._cond.release()
+                yield item
+        finally:
+            self._cond.acquire()
+            self._stopped = True
+            self._cond.notifyAll()
+            self._cond.release()
+            t.join()
+        if self._failure is not None:
+            raise self._failure[0], self._failure[1], self._failure[2]
+
+# Modeline for vim: set tw=79 et ts=4:
@@ -0,0 +1,135 @@
+# recount.py - count lines of code again from the local content store.
+#
+# Copyright (C) 2010 Guilherme Versiani <guibv@comunip.com.br>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+import storage, store
+from sync import countlocs, locdigest
+from i18n import _
+import os, signal, multiprocessing
+
+# changes recounted between two progress dots
+_dotevery = 500
+
+_contentstore = None
+
+def _initworker(root):
+    # let the parent process handle keyboard interrupts
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    globals()['_contentstore'] = store.ContentStore(root)
+
+def _recount(args):
+    """Count the lines of code of stored contents, returning the LOC cache
+    digest along with the counts, or (None, None) if they are missing."""
+    (filepath, digest) = args
+    contents = _contentstore.get(digest)
+    if contents is None:
+        return (None, None)
+    return (locdigest(os.path.basename(filepath), contents),
+            countlocs(filepath, contents))
+
+class Recount(object):
+    """Rebuilds the lines of code of every change whose contents are in the
+    content store, counting them on `jobs` processes. Changes that took
+    their counts from an earlier revision of the same file (only their
+    properties changed) take the new counts of that revision; the others
+    without stored contents are left as they are. The lines of code each
+    change added, and the totals after each revision, are then computed
+    again. Each branch is recounted in a single transaction, so that a
+    failure leaves its counts and reports as they were."""
+
+    def __init__(self, repo, ui, verbose, contentstore, jobs=None):
+        self.repo         = repo
+        self.ui           = ui
+        self.verbose      = verbose
+        self.contentstore = contentstore
+        self.jobs         = jobs or multiprocessing.cpu_count()
+
+    def process(self):
+        self.ui.writenl(_("Recounting repo %s...") % self.repo.url)
+        pool = multiprocessing.Pool(self.jobs, _initworker,
+                                    (self.contentstore.root,))
+        try:
+            for branch in self.repo.branches:
+                self.processbranch(branch, pool)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def processbranch(self, branch, pool):
+        self.ui.write("  " + _("Branch %s: ") % branch.name)
+        self.ui.flush()
+        if branch.getSnapshot() is not None:
+            # its reports add up deltas that recounting would not match
+            self.ui.writenl(_("skipped, synchronized head-first"))
+            return
+        index = self.contentstore.index(self.repo.url, branch.name)
+        changes = [ (id, changetype, revno, filepath,
+                     index.digest(revno, filepath))
+                    for (id, changetype, revno, filepath)
+                    in branch.getChanges() ]
+        stored = [ (store.encodepath(filepath), digest)
+                   for (id, changetype, revno, filepath, digest) in changes
+                   if digest is not None ]
+        counts = pool.imap(_recount, stored, 16)
+
+        latest = {}
+        recounted, inherited, kept = 0, 0, 0
+        trans = storage.transaction()
+        try:
+            for i, (id, changetype, revno, filepath, digest) in \
+                    enumerate(changes):
+                if i > 0 and i % _dotevery == 0 and self.verbose >= 0:
+                    self.ui.write('.')
+                    self.ui.flush()
+                if digest is not None:
+                    (digest, locs) = counts.next()
+                    if locs is not None:
+                        # the cache may hold counts made by older rules
+                        cached = storage.LocCache.insert(digest, locs,
+                                                         connection=trans)
+                        if cached.locs != locs:
+                            cached.locs = locs
+                        recounted += 1
+                    else:
+                        kept += 1
+                elif changetype == 'M' and filepath in latest:
+                    locs = latest[filepath]
+                    inherited += 1
+                else:
+                    locs = None
+                    if changetype != 'D':
+                        kept += 1
+                if changetype in ('D', 'R'):
+                    latest.pop(filepath, None)
+                if locs is None:
+                    continue
+                latest[filepath] = locs
+                change = storage.Change.get(id, connection=trans)
+                change.clearLocs(connection=trans)
+                for (language, code, comments, blanks) in locs:
+                    change.insertLoc(
+                        language=language,
+                        code=code,
+                        comments=comments,
+                        blanks=blanks,
+                        connection=trans
+                    )
+            branch.rebuildDeltas(connection=trans)
+            branch.rebuildTotals(connection=trans)
+        except:
+            trans.rollback()
+            raise
+        trans.commit(close=True)
+        self.ui.writenl(_("%d recounted, %d from earlier revisions, "
+            "%d without stored contents") % (recounted, inherited, kept))
+
+def execute(repo, ui, verbose, contentstore, jobs=None):
+    Recount(repo, ui, verbose, contentstore, jobs).process()
+
+# Modeline for vim: set tw=79 et ts=4:
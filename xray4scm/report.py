@@ -79,6 +79,9 @@ def render(charts):
         fig = pyplot.figure()
         if 'title' in chart:
             fig.suptitle(chart.title)
+        if hasattr(collector, 'note'):
+            # e.g. the part of the history covered so far
+            fig.text(0.5, 0.01, collector.note, ha='center', size='small')
 
         ax = fig.add_subplot(1, 1, 1)
         if 'xlabel' in chart:
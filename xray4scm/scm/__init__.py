@@ -5,7 +5,7 @@
 # This software may be used and distributed according to the terms of the
 # GNU General Public License version 2, incorporated herein by reference.
 
-__all__ = [ 'svn' ]
+__all__ = [ 'svn', 'svndump', 'git' ]
 
 def createInstance(url):
     assert url
@@ -13,7 +13,7 @@ def createInstance(url):
     impl = None
     for key in __all__:
         if url.startswith(key+'+') or url.startswith(key+','):
-            impl = __import__(key)
+            impl = __import__(key, globals())
             break
     else:
         raise NotImplementedError("No support for this SCM schema: '%s'" % url)
@@ -0,0 +1,458 @@
+# git.py - git backend for XRay.
+#
+# Copyright (C) 2010 Guilherme Versiani <guibv@comunip.com.br>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+import scmbase
+import xray4scm.error as error
+from xray4scm.i18n import _
+from xray4scm.util import lrucachedict
+import os, subprocess, threading, datetime, time, urllib
+
+# fields of a commit header in the log, the leading \x01 tells headers
+# apart from the raw diff entries following them
+_logformat = '%x01%H%x00%an <%ae>%x00%at%x00%B%x00'
+
+# git looks at this many leading bytes of a blob to tell binary files
+_binarysniff = 8000
+
+# blobs up to this size are read whole when telling binary files, and kept
+# until read again, so that reading them afterwards is free; only the first
+# _binarysniff bytes of larger ones are read
+_sniffkeep = 64*1024
+
+# bytes of the text blobs kept that way; files are all told apart before
+# any is read, so enough for most revisions
+_sniffedbytes = 4*1024*1024
+
+# unread parts of blobs larger than this are not read through when reading
+# them stops early, 'git cat-file' is started again instead
+_skipread = 1024*1024
+
+_nullsha = '0' * 40
+
+# git processes must not hold the pipes of each other, or one never sees the
+# end of its input; Windows cannot close them along with redirecting them
+_closefds = os.name != 'nt'
+
+# how long a 'git cat-file' process is given to exit once its input is
+# closed, in seconds, before it is killed
+_stoptimeout = 1.0
+
+def getDescription():
+    return {
+        'name'    : 'git',
+        'example' : 'git+file:///path/to/repos',
+    }
+
+def _tokens(stream):
+    """Yield the NUL terminated fields read from a stream."""
+    pending = ''
+    while True:
+        data = stream.read(65536)
+        if data == '':
+            break
+        fields = (pending + data).split('\0')
+        pending = fields.pop()
+        for field in fields:
+            yield field
+    if pending != '':
+        yield pending
+
+class _ChangeRecord(object):
+
+    __slots__ = ('action', 'path', 'oldmode', 'newmode', 'oldsha', 'newsha')
+
+    def __init__(self, action, path, oldmode, newmode, oldsha, newsha):
+        self.action  = action
+        self.path    = path
+        self.oldmode = oldmode
+        self.newmode = newmode
+        self.oldsha  = oldsha
+        self.newsha  = newsha
+
+class _RevisionRecord(object):
+
+    def __init__(self, revno, sha, author, date, message):
+        self.revno   = revno
+        self.sha     = sha
+        self.author  = author
+        self.date    = int(date)
+        self.message = message
+        self.changes = []
+
+class Client(scmbase.Client):
+    """Reads the history of a git repository through two long running git
+    processes: 'git log --raw' streams the commits of a branch with their
+    changed paths, and 'git cat-file --batch' serves file contents.
+
+    Revision numbers are the positions of the commits in the first-parent
+    history of the branch, starting at 1 for its root commit. Merges are
+    seen as a single change against their first parent."""
+
+    def __init__(self, repo_url):
+        self._repo_url = repo_url
+        if repo_url.startswith('file://'):
+            self._repo_dir = urllib.url2pathname(repo_url[len('file://'):])
+        else:
+            self._repo_dir = repo_url
+        self._branch = ''
+        self._commits = None
+        self._catfile = None
+        self._catlock = threading.Lock()
+        self._checkfile = None
+        self._checklock = threading.Lock()
+        self._sniffed = lrucachedict(_sniffedbytes, len)
+
+    def __del__(self):
+        # never wait here: a process forked meanwhile may hold the input of
+        # 'git cat-file' open, so that it would never exit
+        for proc in (self._catfile, self._checkfile):
+            if proc is not None:
+                proc.stdin.close()
+                proc.stdout.close()
+                if proc.poll() is None:
+                    proc.terminate()
+
+    def _stop(self, proc):
+        proc.stdin.close()
+        proc.stdout.close()
+        deadline = time.time() + _stoptimeout
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.01)
+        if proc.poll() is None:
+            proc.terminate()
+            proc.wait()
+
+    def close(self):
+        for proc in (self._catfile, self._checkfile):
+            if proc is not None:
+                self._stop(proc)
+        self._catfile = None
+        self._checkfile = None
+        self._sniffed.clear()
+
+    def _popen(self, *args, **kwargs):
+        try:
+            return subprocess.Popen(('git',) + args, cwd=self._repo_dir,
+                                    close_fds=_closefds, **kwargs)
+        except OSError as inst:
+            raise error.Abort(_("Cannot run git on %s: %s") %
+                              (self._repo_dir, inst.strerror))
+
+    def _git(self, *args):
+        proc = self._popen(stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           *args)
+        (out, err) = proc.communicate()
+        if proc.returncode != 0:
+            raise error.Abort(_("git %s failed on %s: %s") %
+                              (args[0], self._repo_dir, err.strip()))
+        return out
+
+    def _ref(self):
+        return self._branch.strip('/') or 'HEAD'
+
+    def _revlist(self):
+        """Return the shas of the first-parent history of the branch, the
+        root commit first."""
+        if self._commits is None:
+            out = self._git('rev-list', '--first-parent', '--reverse',
+                            self._ref(), '--')
+            self._commits = out.split()
+        return self._commits
+
+    def _sha(self, revno):
+        commits = self._revlist()
+        if revno < 1 or revno > len(commits):
+            raise error.Abort(_("Revision %d does not exist in branch %s") %
+                              (revno, self._ref()))
+        return commits[revno-1]
+
+    def _log(self, revno, *args):
+        """Yield the revisions listed by 'git log', numbering them from
+        `revno`."""
+        proc = self._popen('log', '--first-parent', '-m', '--reverse',
+                           '--raw', '-z', '--no-abbrev', '--no-renames',
+                           '--format=' + _logformat, *args,
+                           stdout=subprocess.PIPE)
+        current = None
+        try:
+            fields = _tokens(proc.stdout)
+            for field in fields:
+                field = field.lstrip('\n')
+                if field.startswith('\x01'):
+                    if current is not None:
+                        yield current
+                        revno += 1
+                    sha = field[1:]
+                    if sha != self._sha(revno):
+                        raise error.Abort(_("History of branch %s changed "
+                            "while reading it") % self._ref())
+                    author = fields.next()
+                    date = fields.next()
+                    message = fields.next()
+                    current = _RevisionRecord(revno, sha, author, date,
+                                              message)
+                elif field.startswith(':'):
+                    (oldmode, newmode, oldsha, newsha, status) = \
+                        field[1:].split(' ')
+                    path = '/' + fields.next()
+                    action = status[0]
+                    if action == 'T':
+                        action = 'M'
+                    current.changes.append(_ChangeRecord(action, path,
+                        oldmode, newmode, oldsha, newsha))
+            if current is not None:
+                yield current
+        finally:
+            proc.stdout.close()
+            proc.wait()
+
+    def _request(self, proc, option, name):
+        """Ask a 'git cat-file' process about an object, returning the
+        process and the size of the object, or None when it does not
+        exist."""
+        if proc is None:
+            proc = self._popen('cat-file', option, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE)
+        proc.stdin.write(name + '\n')
+        proc.stdin.flush()
+        header = proc.stdout.readline()
+        if header == '':
+            raise error.Abort(_("git cat-file exited on %s") %
+                              self._repo_dir)
+        if header.rstrip('\n').endswith(' missing'):
+            return (proc, None)
+        return (proc, int(header.split()[2]))
+
+    def _blob(self, name):
+        """Return the contents of an object through 'git cat-file --batch',
+        or None when it does not exist. Blobs kept when telling binary files
+        apart are handed out, and forgotten, instead."""
+        data = self._sniffed.pop(name)
+        if data is not None:
+            return data
+        self._catlock.acquire()
+        try:
+            (self._catfile, size) = self._request(self._catfile, '--batch',
+                                                  name)
+            data = None
+            if size is not None:
+                data = self._catfile.stdout.read(size)
+                self._catfile.stdout.read(1)
+            return data
+        finally:
+            self._catlock.release()
+
+    def _blobsize(self, name):
+        """Return the size of an object, or None when it does not exist."""
+        self._checklock.acquire()
+        try:
+            (self._checkfile, size) = self._request(self._checkfile,
+                                                    '--batch-check', name)
+            return size
+        finally:
+            self._checklock.release()
+
+    def setbranch(self, branch):
+        self._branch = branch
+        self._commits = None
+
+    def getrevrange(self):
+        commits = self._revlist()
+        if len(commits) == 0:
+            return (0, 0)
+        return (1, len(commits))
+
+    def getrev(self, revno):
+        for revision in self._log(revno, '-1', self._sha(revno), '--'):
+            return Revision(self, revision)
+
+    def cat(self, revno, filepath):
+        data = self._blob('%s:%s' % (self._sha(revno), filepath.strip('/')))
+        return data or ''
+
+    def catchunks(self, revno, filepath, chunksize):
+        self._catlock.acquire()
+        try:
+            (self._catfile, size) = self._request(self._catfile, '--batch',
+                '%s:%s' % (self._sha(revno), filepath.strip('/')))
+            if size is None:
+                return
+            stdout = self._catfile.stdout
+            remaining = size
+            try:
+                while remaining > 0:
+                    chunk = stdout.read(min(chunksize, remaining))
+                    remaining -= len(chunk)
+                    yield chunk
+            finally:
+                if remaining > _skipread:
+                    self._stop(self._catfile)
+                    self._catfile = None
+                else:
+                    # leave the process ready for the next object
+                    while remaining > 0:
+                        remaining -= len(stdout.read(min(chunksize,
+                                                         remaining)))
+                    stdout.read(1)
+        finally:
+            self._catlock.release()
+
+    def listfiles(self, revno, path='/'):
+        """List the files with 'git ls-tree'. Whether a file is binary is
+        only known for symbolic links."""
+        args = ['ls-tree', '-r', '-l', '-z', self._sha(revno)]
+        if path.strip('/') != '':
+            args += ['--', path.strip('/')]
+        files = []
+        for entry in self._git(*args).split('\0'):
+            if entry == '':
+                continue
+            (info, name) = entry.split('\t', 1)
+            (mode, kind, sha, size) = info.split()
+            if kind != 'blob':
+                continue
+            filepath = '/' + name
+            if not self.accepts(filepath):
+                continue
+            files.append((filepath, int(size), mode == '120000' or None))
+        return files
+
+    def iterrevs(self, startrev=0, endrev=0):
+        (first, last) = self.getrevrange()
+        startrev = max(startrev, first)
+        endrev = min(endrev, last)
+        if first == 0 or startrev > endrev:
+            return
+        if startrev == 1:
+            revrange = self._sha(endrev)
+        else:
+            revrange = '%s..%s' % (self._sha(startrev-1), self._sha(endrev))
+        for revision in self._log(startrev, revrange, '--'):
+            yield Revision(self, revision)
+
+class Revision(scmbase.Revision):
+
+    def __init__(self, parent, base):
+        self.parent = parent
+        self._base  = base
+
+    @property
+    def id(self):
+        return self._base.revno
+
+    @property
+    def author(self):
+        return self._base.author
+
+    @property
+    def message(self):
+        return self._base.message
+
+    @property
+    def date(self):
+        return datetime.datetime.fromtimestamp(self._base.date)
+
+    def iterchanges(self):
+        for change in self._base.changes:
+            if self.parent.accepts(change.path):
+                yield Change(self, change)
+
+class Change(scmbase.Change):
+
+    def __init__(self, parent, base):
+        self.parent = parent
+        self._base  = base
+
+    @property
+    def path(self):
+        return Path(self, self._base.path)
+
+    @property
+    def changetype(self):
+        return self._base.action
+
+    def iscopy(self):
+        return False
+
+    def getorigin(self):
+        return (None, None)
+
+    def textmodified(self):
+        if self._base.action != 'M':
+            return None
+        return self._base.oldsha != self._base.newsha
+
+class Path(scmbase.Path):
+
+    def __init__(self, parent, filepath):
+        self.parent    = parent
+        self._filepath = filepath
+
+    def _mode(self):
+        change = self.parent._base
+        if change.newsha == _nullsha:
+            return change.oldmode
+        return change.newmode
+
+    def isdir(self):
+        # git only tracks files, submodules are the nearest to directories
+        return self._mode() == '160000'
+
+    def isfile(self):
+        return not self.isdir()
+
+    def isbinary(self):
+        mode = self._mode()
+        if mode == '160000':
+            return False
+        if mode == '120000':
+            return True # symbolic links
+        change = self.parent
+        revision = change.parent
+        revno = revision.id
+        if change.changetype == 'D':
+            revno -= 1
+        client = revision.parent
+        name = '%s:%s' % (client._sha(revno), self._filepath.lstrip('/'))
+        size = client._blobsize(name)
+        if size is None:
+            return False
+        if size > _sniffkeep:
+            # do not read large files just to look at them
+            for data in client.catchunks(revno, self._filepath,
+                                         _binarysniff):
+                return '\0' in data
+            return False
+        data = client._blob(name)
+        if data is None:
+            return False
+        if '\0' in data[:_binarysniff]:
+            return True
+        # to be read next, once every file of the revision is told apart
+        client._sniffed[name] = data
+        return False
+
+    def istext(self):
+        return not self.isbinary()
+
+    def size(self):
+        change = self.parent
+        revision = change.parent
+        client = revision.parent
+        sha = change._base.newsha
+        if sha == _nullsha:
+            sha = change._base.oldsha
+        return client._blobsize(sha)
+
+    @property
+    def fullpath(self):
+        return self._filepath
+
+    def __str__(self):
+        return self._filepath
+
+# Modeline for vim: set tw=79 et ts=4:
@@ -12,6 +12,8 @@ from abc import abstractmethod, abstractproperty
 class Client(object):
     __metaclass__ = abc.ABCMeta
 
+    _accept = None
+
     @abstractmethod
     def setbranch(self, branch):
         pass
@@ -32,6 +34,45 @@ class Client(object):
     def iterrevs(self, startrev=0, endrev=0):
         pass
 
+    def getboundaries(self):
+        """Return a dictionary of facts about the repository and the branch
+        that never change once known (like where the branch starts), to be
+        given back to setboundaries() by later instances."""
+        return {}
+
+    def setboundaries(self, boundaries):
+        """Take facts saved from getboundaries(), sparing their lookup."""
+        pass
+
+    def close(self):
+        """Release what the client holds, like the processes it started.
+        The client may still be used afterwards, taking them again."""
+        pass
+
+    def setfilter(self, accept):
+        """Only report changes of paths (relative to the branch) for which
+        accept(path) is true; None reports every change. Backends must
+        drop filtered changes before looking anything up about them."""
+        self._accept = accept
+
+    def accepts(self, path):
+        return self._accept is None or self._accept(path)
+
+    def catchunks(self, rev_id, path, chunksize):
+        """Yield the contents of a file in pieces of at most `chunksize`
+        bytes. Backends able to read files piecewise should override it."""
+        contents = self.cat(rev_id, path)
+        for i in xrange(0, len(contents), chunksize):
+            yield contents[i:i+chunksize]
+
+    def listfiles(self, rev_id, path='/'):
+        """Return the files at `path` (relative to the branch), or below it
+        when it is a directory, as of some revision: a list of (path, size,
+        isbinary) tuples, size and isbinary being None when unknown, leaving
+        out filtered paths. Backends unable to list a whole tree with a few
+        requests raise NotImplementedError."""
+        raise NotImplementedError
+
 class Revision(object):
     __metaclass__ = abc.ABCMeta
 
@@ -74,6 +115,11 @@ class Change(object):
     def getorigin(self):
         pass
 
+    def textmodified(self):
+        """Tell whether the contents of the path were modified by this
+        change, or None when the backend does not know."""
+        return None
+
 class Path(object):
     __metaclass__ = abc.ABCMeta
 
@@ -97,6 +143,16 @@ class Path(object):
     def __str__(self):
         pass
 
+    def size(self):
+        """Return the size of the file in bytes, or None when the backend
+        cannot tell it without reading the file."""
+        return None
+
+    @property
+    def fullpath(self):
+        """The path relative to the repository root, not to the branch."""
+        return str(self)
+
     @property
     def ext(self):
         (root, ext) = os.path.splitext(str(self))
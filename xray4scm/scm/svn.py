@@ -6,46 +6,128 @@
 # GNU General Public License version 2, incorporated herein by reference.
 
 import scmbase
-import pysvn, getpass, datetime
+from xray4scm.util import lrucachedict
+import pysvn, getpass, datetime, threading, urllib, posixpath
+
+# revisions modifying at least this number of paths have their text
+# modifications found with a single diff summary, when the log lacks them
+_summarizethreshold = 8
+
+# bounds of the number of revisions asked per log request; the page size
+# adapts to keep about _logpagepaths changed paths in memory at once
+_logpagemin   = 1
+_logpagemax   = 1000
+_logpagepaths = 10000
+
+# unknown node kinds are found with a recursive listing of their common
+# parent when at least this many of them are below a directory of the
+# branch, other than its root
+_listthreshold = 8
+
+# node kinds and svn:mime-type properties remembered between revisions
+_cachesize = 20000
+
+_unknown = object()
+
+def getDescription():
+    return {
+        'name'    : 'svn',
+        'example' : 'svn+http://some.domain/path/to/repos',
+    }
+
+def _commonparent(paths):
+    parts = [ p.strip('/').split('/') for p in paths ]
+    common = []
+    for names in zip(*parts):
+        if len(set(names)) > 1:
+            break
+        common.append(names[0])
+    return '/' + '/'.join(common)
+
+def _prunebelow(cache, dirs):
+    """Forget the cached entries of the paths below some directories."""
+    if len(dirs) > 0:
+        prefixes = tuple([ '/' + d.strip('/') + '/' for d in dirs ])
+        cache.prune(lambda path: path.startswith(prefixes))
 
 class Client(scmbase.Client):
+    """Access to a subversion repository.
+
+    A pysvn client can only serve one call at a time, so every thread gets
+    a session of its own, opened on first use and kept for the next calls.
+    The sessions share the repository root, the caches and the answers
+    given at the prompts."""
 
     def __init__(self, repo_url):
         self._repo_url = repo_url
         self._branch = ''
-        self.svnclient = pysvn.Client()
+        self._local = threading.local()
+        self._authlock = threading.RLock()
+        self._logins = {} # (username, password) by realm
+        self._trusts = {} # answers to the server certificate prompt by realm
         self._repo_root_url = None
+        self._first_rev_date = None
+        self._start_rev = None
+        # node kinds and svn:mime-type by path, kept while syncing
+        self._kinds = lrucachedict(_cachesize)
+        self._mimetypes = lrucachedict(_cachesize)
 
-        self.svnclient.callback_get_login = \
-            self._get_login
-        self.svnclient.callback_ssl_server_trust_prompt = \
-            self._ssl_server_trust_prompt
-        self.svnclient.callback_ssl_client_cert_password_prompt = \
-            self._ssl_client_cert_password_prompt
+    @property
+    def svnclient(self):
+        """The pysvn client of the calling thread."""
+        svnclient = getattr(self._local, 'svnclient', None)
+        if svnclient is None:
+            svnclient = pysvn.Client()
+            svnclient.callback_get_login = \
+                self._get_login
+            svnclient.callback_ssl_server_trust_prompt = \
+                self._ssl_server_trust_prompt
+            svnclient.callback_ssl_client_cert_password_prompt = \
+                self._ssl_client_cert_password_prompt
+            self._local.svnclient = svnclient
+            self._local.tried = set()
+        return svnclient
 
     def _get_login(self, realm, username, may_save):
-        user = raw_input("username for %s: " % realm)
-        password = getpass.getpass()
-        retcode = user == '' and False or True
-        return retcode, user, password, may_save
+        with self._authlock:
+            # another session already logged in, unless it failed here
+            if realm in self._logins and realm not in self._local.tried:
+                self._local.tried.add(realm)
+                user, password = self._logins[realm]
+                return True, user, password, may_save
+            user = raw_input("username for %s: " % realm)
+            password = getpass.getpass()
+            retcode = user == '' and False or True
+            if retcode:
+                self._logins[realm] = (user, password)
+                self._local.tried.add(realm)
+            return retcode, user, password, may_save
 
     def _ssl_server_trust_prompt(self, trust_dict):
-        for key, value in trust_dict.items():
-            print '%s: %s' % (key, value)
-        print ''
-        answer = ''
-        while answer.lower() not in ['p','t','r']:
-            answer = raw_input('(P)ermanent accept, (T)emporary accept or (R)eject: ')
-        if answer.lower() == 'p':
-            return True, trust_data['failures'], True
-        if answer.lower() == 't':
-            return True, trust_data['failures'], False
-        return False, 0, False
+        with self._authlock:
+            realm = trust_dict.get('realm')
+            if realm in self._trusts:
+                return self._trusts[realm]
+            for key, value in trust_dict.items():
+                print '%s: %s' % (key, value)
+            print ''
+            answer = ''
+            while answer.lower() not in ['p','t','r']:
+                answer = raw_input('(P)ermanent accept, (T)emporary accept or (R)eject: ')
+            if answer.lower() == 'p':
+                trust = (True, trust_dict['failures'], True)
+            elif answer.lower() == 't':
+                trust = (True, trust_dict['failures'], False)
+            else:
+                trust = (False, 0, False)
+            self._trusts[realm] = trust
+            return trust
 
     def _ssl_client_cert_password_prompt(self, realm, may_save):
-        certfile = raw_input("client cert for %s: " % realm)
-        retcode = certfile == '' and False or True
-        return retcode, certfile, may_save
+        with self._authlock:
+            certfile = raw_input("client cert for %s: " % realm)
+            retcode = certfile == '' and False or True
+            return retcode, certfile, may_save
 
     @property
     def repo_url(self):
@@ -68,32 +150,207 @@ class Client(scmbase.Client):
             url += '/' + path
         return url
 
+    def branchpath(self, path):
+        """Turn a path relative to the repository root into one relative
+        to the branch."""
+        path = path.lstrip('/')
+        if path.startswith(self._branch):
+            path = path.replace(self._branch, '', 1)
+            path = path.lstrip('/')
+        return '/'+path
+
+    def root_path(self, path):
+        url = self.repo_root_url
+        path = path.lstrip('/')
+        if len(path) > 0:
+            url += '/' + path
+        return url
+
+    def inbranch(self, path):
+        """Tell whether a path relative to the repository root is the
+        branch or below it."""
+        branch = '/'+self._branch.strip('/')
+        return branch == '/' or path == branch or \
+            path.startswith(branch + '/')
+
+    def _listroot(self, paths):
+        """Return the directory to list recursively to find many paths at
+        once: their common parent, when there are enough of them and it is
+        below the branch root, so that a listing never covers the whole
+        branch. Returns None otherwise."""
+        if len(paths) < _listthreshold:
+            return None
+        parent = _commonparent(paths)
+        if parent == '/'+self._branch.strip('/') or not self.inbranch(parent):
+            return None
+        return parent
+
+    def _remember(self, cache, found, paths):
+        """Keep what a lookup found for later revisions, only the paths
+        asked for when it found too much to be kept without flushing the
+        cache."""
+        if len(found) > _cachesize / 4:
+            found = dict([ (p, found[p]) for p in paths if p in found ])
+        cache.update(found)
+
+    def _listkinds(self, path, rev, depth, kinds, sizes):
+        try:
+            for (entry, lock) in self.svnclient.list(
+                    self.root_path(path),
+                    revision=rev,
+                    peg_revision=rev,
+                    depth=depth,
+                    dirent_fields=pysvn.SVN_DIRENT_KIND |
+                                  pysvn.SVN_DIRENT_SIZE):
+                entrypath = '/'+entry.repos_path.strip('/')
+                kinds[entrypath] = entry.kind
+                if entry.kind == pysvn.node_kind.file:
+                    sizes[entrypath] = entry.size
+        except pysvn.ClientError:
+            pass
+
+    def nodekinds(self, paths, revno, sizes=None):
+        """Find the node kinds of paths (relative to the repository root) at
+        some revision. Many paths below a directory of the branch are found
+        with a single recursive listing of it (see _listroot()), paths
+        sharing a directory with a listing of that directory alone, and the
+        others one at a time. What is seen while doing so is remembered for
+        later revisions, and the sizes of the files seen are put in
+        `sizes`."""
+        rev = pysvn.Revision(pysvn.opt_revision_kind.number, revno)
+        kinds = {}
+        if sizes is None:
+            sizes = {}
+        parent = self._listroot(paths)
+        if parent is not None:
+            self._listkinds(parent, rev, pysvn.depth.infinity, kinds, sizes)
+        else:
+            bydir = {}
+            for path in paths:
+                bydir.setdefault(posixpath.dirname(path), []).append(path)
+            for dir, entries in bydir.iteritems():
+                if len(entries) > 1:
+                    self._listkinds(dir, rev, pysvn.depth.immediates, kinds,
+                                    sizes)
+                else:
+                    self._listkinds(entries[0], rev, pysvn.depth.empty,
+                                    kinds, sizes)
+        self._remember(self._kinds, kinds, paths)
+        for path in paths:
+            if path not in kinds:
+                kinds[path] = self.svnclient.info2(
+                    self.root_path(path),
+                    revision=rev,
+                    peg_revision=rev,
+                    recurse=False
+                )[0][1].kind
+        return kinds
+
+    def _propget(self, propname, path, rev, depth):
+        found = {}
+        root = self.repo_root_url
+        for url, value in self.svnclient.propget(
+                propname,
+                self.root_path(path),
+                revision=rev,
+                peg_revision=rev,
+                depth=depth).iteritems():
+            if url.startswith(root):
+                url = urllib.unquote(url[len(root):])
+            found['/'+url.lstrip('/')] = value
+        return found
+
+    def mimetypes(self, paths, revno):
+        """Find the svn:mime-type of files (paths relative to the repository
+        root) at some revision, asking for them the way nodekinds() does.
+        Files without the property get None. What is seen while doing so is
+        remembered for later revisions."""
+        rev = pysvn.Revision(pysvn.opt_revision_kind.number, revno)
+        found = {}
+        pending = paths
+        parent = self._listroot(paths)
+        if parent is not None:
+            try:
+                found = self._propget('svn:mime-type', parent, rev,
+                                      pysvn.depth.infinity)
+                pending = []
+            except pysvn.ClientError:
+                pass
+        else:
+            bydir = {}
+            for path in paths:
+                bydir.setdefault(posixpath.dirname(path), []).append(path)
+            pending = []
+            for dir, entries in bydir.iteritems():
+                if len(entries) == 1:
+                    pending.extend(entries)
+                    continue
+                try:
+                    found.update(self._propget('svn:mime-type', dir, rev,
+                                               pysvn.depth.files))
+                except pysvn.ClientError:
+                    pending.extend(entries)
+        for path in pending:
+            found.update(self._propget('svn:mime-type', path, rev,
+                                       pysvn.depth.empty))
+        self._remember(self._mimetypes, found, paths)
+        mimetypes = {}
+        for path in paths:
+            mimetypes[path] = found.get(path)
+            self._mimetypes[path] = mimetypes[path]
+        return mimetypes
+
     def setbranch(self, branch):
+        if branch != self._branch:
+            self._start_rev = None
         self._branch = branch
 
+    def getboundaries(self):
+        boundaries = {}
+        if self._repo_root_url is not None:
+            boundaries['root_url'] = self._repo_root_url
+        if self._first_rev_date is not None:
+            boundaries['first_rev_date'] = self._first_rev_date
+        if self._start_rev is not None:
+            boundaries['start_rev'] = self._start_rev
+        return boundaries
+
+    def setboundaries(self, boundaries):
+        self._repo_root_url = boundaries.get('root_url', self._repo_root_url)
+        self._first_rev_date = boundaries.get('first_rev_date',
+                                              self._first_rev_date)
+        self._start_rev = boundaries.get('start_rev', self._start_rev)
+
     def getrevrange(self):
+        """Return the first and last revisions of the branch. Only the last
+        one needs a request once the boundaries are known."""
         headrev = self.svnclient.info2(
             self.repo_url,
             recurse=False
         )[0][1].last_changed_rev
 
-        firstrevdate = self.svnclient.info2(
-            self.repo_root_url,
-            revision=pysvn.Revision(pysvn.opt_revision_kind.number, 1),
-            recurse=False
-        )[0][1].last_changed_date
+        if self._start_rev is None:
+            if self._first_rev_date is None:
+                self._first_rev_date = self.svnclient.info2(
+                    self.repo_root_url,
+                    revision=pysvn.Revision(pysvn.opt_revision_kind.number, 1),
+                    recurse=False
+                )[0][1].last_changed_date
 
-        startrev = self.svnclient.log(
-            self.repo_url,
-            revision_start=pysvn.Revision(pysvn.opt_revision_kind.date, firstrevdate),
-            revision_end=headrev,
-            discover_changed_paths=False,
-            limit=1
-        )
+            startrev = self.svnclient.log(
+                self.repo_url,
+                revision_start=pysvn.Revision(pysvn.opt_revision_kind.date,
+                                              self._first_rev_date),
+                revision_end=headrev,
+                discover_changed_paths=False,
+                limit=1
+            )
+            if startrev != None and len(startrev) > 0:
+                self._start_rev = startrev[0].revision.number
 
         startrevno, endrevno = 0, 0
-        if startrev != None and len(startrev) > 0:
-            startrevno = startrev[0].revision.number
+        if self._start_rev is not None:
+            startrevno = self._start_rev
             endrevno = headrev.number
 
         return (startrevno, endrevno)
@@ -103,32 +360,79 @@ class Client(scmbase.Client):
             self.repo_url,
             revision_start=pysvn.Revision(pysvn.opt_revision_kind.number, revno),
             revision_end=pysvn.Revision(pysvn.opt_revision_kind.number, revno),
-            discover_changed_paths=detailedLog,
+            discover_changed_paths=True,
             limit=1,
         )[0]
 
-        return Revision(revision)
+        return Revision(self, revision)
 
     def cat(self, revno, filepath):
+        rev = pysvn.Revision(pysvn.opt_revision_kind.number, revno)
+        # the path as of that revision, it may be gone since
         return self.svnclient.cat(
             self.repo_path(filepath),
-            revision=pysvn.Revision(pysvn.opt_revision_kind.number, revno)
+            revision=rev,
+            peg_revision=rev
         )
 
-    def iterrevs(self, startrev=0, endrev=0, detailedLog=True, cache=1):
+    def listfiles(self, revno, path='/'):
+        """List the files with one request for their sizes and another for
+        their svn:mime-type properties."""
+        rev = pysvn.Revision(pysvn.opt_revision_kind.number, revno)
+        url = self.repo_path(path)
+        try:
+            entries = self.svnclient.list(
+                url,
+                revision=rev,
+                peg_revision=rev,
+                recurse=True,
+                dirent_fields=pysvn.SVN_DIRENT_KIND | pysvn.SVN_DIRENT_SIZE)
+        except pysvn.ClientError:
+            return [] # not there at that revision
+        root = self.repo_root_url
+        mimetypes = self._propget('svn:mime-type',
+            urllib.unquote(url[len(root):]), rev, pysvn.depth.infinity)
+        files = []
+        for (entry, lock) in entries:
+            if entry.kind != pysvn.node_kind.file:
+                continue
+            fullpath = '/'+entry.repos_path.strip('/')
+            filepath = self.branchpath(fullpath)
+            if not self.accepts(filepath):
+                continue
+            mimetype = mimetypes.get(fullpath)
+            files.append((filepath, entry.size,
+                          mimetype is not None and mimetype.find('text') < 0))
+        return files
+
+    def iterrevs(self, startrev=0, endrev=0, detailedLog=True, cache=None):
+        """Iterate over revisions, fetching the log in pages of `cache`
+        revisions. By default the page size adapts: it grows while
+        revisions change few paths and shrinks when they change many, so
+        that round trips are few and buffered revisions stay bounded."""
+        limit = cache or 16
         while (startrev <= endrev):
             revisions = self.svnclient.log(
                 self.repo_url,
                 revision_start=pysvn.Revision(pysvn.opt_revision_kind.number, startrev),
                 revision_end=pysvn.Revision(pysvn.opt_revision_kind.number, endrev),
                 discover_changed_paths=detailedLog,
-                limit=cache,
+                limit=limit,
             )
             if len(revisions) == 0:
                 break
             startrev = revisions[-1].revision.number+1
+            if cache is None and detailedLog:
+                paths = sum([ len(r.changed_paths) for r in revisions ])
+                wanted = _logpagepaths * len(revisions) / max(paths, 1)
+                # move gradually, a single huge revision says little
+                wanted = max(limit / 2, min(limit * 2, wanted))
+                limit = max(_logpagemin, min(_logpagemax, wanted))
+            elif cache is None:
+                limit = min(_logpagemax, limit * 2)
             for revision in revisions:
                 yield Revision(self, revision)
+            del revisions # release the page before asking the next one
 
 class Revision(scmbase.Revision):
 
@@ -138,7 +442,12 @@ class Revision(scmbase.Revision):
         self._date          = base.date
         self._message       = base.message
         self._revno         = base.revision.number
-        self._changed_paths = base.changed_paths
+        self._changed_paths = [ c for c in base.changed_paths
+                                if parent.accepts(parent.branchpath(c.path)) ]
+        self._textmods      = None
+        self._kinds         = None
+        self._sizes         = {}
+        self._mimetypes     = None
 
     @property
     def id(self):
@@ -160,6 +469,148 @@ class Revision(scmbase.Revision):
         for change in self._changed_paths:
             yield Change(self, change)
 
+    def nodekind(self, path):
+        """Return the node kind of a path (relative to the repository root)
+        changed by this revision; deleted paths get their last kind."""
+        if self._kinds is None:
+            self._resolvekinds()
+        return self._kinds.get(path)
+
+    def _resolvekinds(self):
+        client = self.parent
+        self._kinds = {}
+        unknown = {}
+        # what was below a replaced node is gone, whatever its kind was
+        _prunebelow(client._kinds, [ c.path for c in self._changed_paths
+                                     if c.action == 'R' ])
+        for change in self._changed_paths:
+            path = '/'+change.path.lstrip('/')
+            # only reported by servers and bindings for svn 1.6 or later
+            kind = getattr(change, 'node_kind', None)
+            if kind is not None and kind != pysvn.node_kind.unknown:
+                self._kinds[path] = kind
+                continue
+            if change.action in ('A', 'R'):
+                # a new node, whatever was known about the path is stale
+                client._kinds.pop(path, None)
+            kind = client._kinds.get(path)
+            if kind is not None:
+                self._kinds[path] = kind
+                continue
+            if change.action == 'D':
+                revno = self._revno-1
+            else:
+                revno = self._revno
+            unknown.setdefault(revno, []).append(path)
+        for revno, paths in unknown.iteritems():
+            sizes = None
+            if revno == self._revno:
+                sizes = self._sizes
+            self._kinds.update(client.nodekinds(paths, revno, sizes))
+        for change in self._changed_paths:
+            path = '/'+change.path.lstrip('/')
+            if change.action == 'D':
+                client._kinds.pop(path, None)
+            else:
+                client._kinds[path] = self._kinds[path]
+        _prunebelow(client._kinds, self._deleteddirs())
+
+    def _deleteddirs(self):
+        dirs = []
+        for change in self._changed_paths:
+            path = '/'+change.path.lstrip('/')
+            if change.action == 'D' and \
+                    self.nodekind(path) == pysvn.node_kind.dir:
+                dirs.append(path)
+        return dirs
+
+    def filesize(self, path):
+        """Return the size of a file (path relative to the repository root)
+        changed by this revision. Sizes seen while finding the node kinds
+        are known already, the others are asked for all files of the
+        revision at once."""
+        if self._kinds is None:
+            self._resolvekinds()
+        if path not in self._sizes:
+            unknown = [ p for p in [ '/'+c.path.lstrip('/')
+                                     for c in self._changed_paths
+                                     if c.action != 'D' ]
+                        if p not in self._sizes and
+                           self._kinds.get(p) == pysvn.node_kind.file ]
+            try:
+                if len(unknown) > 0:
+                    self.parent.nodekinds(unknown, self._revno, self._sizes)
+            except pysvn.ClientError:
+                pass
+            for p in unknown:
+                # not asked again
+                self._sizes.setdefault(p, None)
+        return self._sizes.get(path)
+
+    def mimetype(self, path):
+        """Return the svn:mime-type of a file (path relative to the
+        repository root) changed by this revision, or None."""
+        if self._mimetypes is None:
+            self._resolvemimetypes()
+        return self._mimetypes.get(path)
+
+    def _resolvemimetypes(self):
+        client = self.parent
+        self._mimetypes = {}
+        unknown = []
+        # the files below a replaced or deleted directory are gone too
+        _prunebelow(client._mimetypes, [ c.path for c in self._changed_paths
+                                         if c.action == 'R' ] +
+                                       self._deleteddirs())
+        for change in self._changed_paths:
+            path = '/'+change.path.lstrip('/')
+            if change.action == 'D':
+                client._mimetypes.pop(path, None)
+                continue
+            if self.nodekind(path) == pysvn.node_kind.dir:
+                continue
+            # only reported by servers and bindings for svn 1.7 or later
+            props_modified = getattr(change, 'props_modified', None)
+            if change.action != 'M' or props_modified is None or \
+                    props_modified:
+                # the change may have set or removed the property
+                client._mimetypes.pop(path, None)
+            # None is remembered too, for files without the property
+            mimetype = client._mimetypes.get(path, _unknown)
+            if mimetype is not _unknown:
+                self._mimetypes[path] = mimetype
+            else:
+                unknown.append(path)
+        if len(unknown) > 0:
+            self._mimetypes.update(client.mimetypes(unknown, self._revno))
+
+    def textmods(self):
+        """Return a dictionary telling, for each path modified by this
+        revision, whether its text was changed or only its properties."""
+        if self._textmods is not None:
+            return self._textmods
+        self._textmods = {}
+        modified = [ c for c in self._changed_paths if c.action == 'M' ]
+        if len(modified) < _summarizethreshold:
+            return self._textmods
+        client = self.parent
+        try:
+            summary = client.svnclient.diff_summarize(
+                client.repo_url,
+                revision1=pysvn.Revision(pysvn.opt_revision_kind.number,
+                                         self._revno-1),
+                url_or_path2=client.repo_url,
+                revision2=pysvn.Revision(pysvn.opt_revision_kind.number,
+                                         self._revno),
+                recurse=True
+            )
+        except pysvn.ClientError:
+            return self._textmods
+        for entry in summary:
+            self._textmods['/'+entry.path.lstrip('/')] = \
+                entry.summarize_kind != pysvn.diff_summarize_kind.normal
+        return self._textmods
+
 class Change(scmbase.Change):
 
     def __init__(self, parent, base):
@@ -167,6 +618,8 @@ class Change(scmbase.Change):
         self._path              = base.path
         self._action            = base.action
         self._copyfrom_path     = base.copyfrom_path
+        # only reported by servers and bindings for svn 1.7 or later
+        self._text_modified     = getattr(base, 'text_modified', None)
 
         if base.copyfrom_revision:
             self._copyfrom_revision = base.copyfrom_revision.number
@@ -187,6 +640,13 @@ class Change(scmbase.Change):
     def getorigin(self):
         return (self._copyFromPath(), self._copyFromRevision())
 
+    def textmodified(self):
+        if self._text_modified is not None:
+            return bool(self._text_modified)
+        if self._action == 'M':
+            return self.parent.textmods().get(str(self.path))
+        return None
+
     def _copyFromPath(self):
         if self._copyfrom_path is None:
             return None
@@ -204,46 +664,33 @@ class Path(scmbase.Path):
         self._filepath = filepath
 
     def isdir(self):
-        change = self.parent
-        revision = change.parent
-        client = revision.parent
-        if change.changetype == 'D':
-            revno = revision.id-1
-        else:
-            revno = revision.id
-        node = client.svnclient.info2(
-            client.repo_path(str(self)),
-            revision=pysvn.Revision(pysvn.opt_revision_kind.number, revno),
-            recurse=False
-        )[0][1]
-        return node.kind == pysvn.node_kind.dir
+        revision = self.parent.parent
+        return revision.nodekind(self.fullpath) == pysvn.node_kind.dir
 
     def isfile(self):
         return not self.isdir()
 
     def isbinary(self):
         revision = self.parent.parent
-        client = revision.parent
-        (rev, propdict) = client.svnclient.revproplist(
-            client.repo_path(self._filepath),
-            pysvn.Revision(pysvn.opt_revision_kind.number, revision.id)
-        )
+        fmimetype = revision.mimetype(self.fullpath)
         isbin = False #if explicit mime-type is not found assumes 'text'
-        if 'svn:mime-type' in propdict:
-            fmimetype = propdict['svn:mime-type']
-            if fmimetype.find('text') < 0:
-                isbin = True
+        if fmimetype is not None and fmimetype.find('text') < 0:
+            isbin = True
         return isbin
 
     def istext(self):
         return not self.isbinary()
 
+    def size(self):
+        revision = self.parent.parent
+        return revision.filesize(self.fullpath)
+
+    @property
+    def fullpath(self):
+        return '/'+self._filepath.lstrip('/')
+
     def __str__(self):
         client = self.parent.parent.parent
-        filepath = self._filepath.lstrip('/')
-        if filepath.startswith(client._branch):
-            filepath = filepath.replace(client._branch, '', 1)
-            filepath = filepath.lstrip('/')
-        return '/'+filepath
+        return client.branchpath(self._filepath)
 
 # Modeline for vim: set tw=79 et ts=4:
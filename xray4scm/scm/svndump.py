@@ -0,0 +1,524 @@
+# svndump.py - svn dump stream backend for XRay.
+#
+# Copyright (C) 2010 Guilherme Versiani <guibv@comunip.com.br>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+import scmbase
+import xray4scm.error as error
+from xray4scm.i18n import _
+import os, posixpath, bisect, calendar, datetime, time, threading, urllib
+
+_actions = {
+    'add'     : 'A',
+    'change'  : 'M',
+    'delete'  : 'D',
+    'replace' : 'R',
+}
+
+def getDescription():
+    return {
+        'name'    : 'svndump',
+        'example' : 'svndump+file:///path/to/repos.dump',
+    }
+
+def _normpath(path):
+    return '/' + path.strip('/')
+
+def _rebase(path, old, new):
+    """Move a path from below directory `old` to below `new`."""
+    return _normpath(new.rstrip('/') + '/' + path[len(old):].lstrip('/'))
+
+def _parseprops(data, props=None):
+    """Parse a property section of a dump, applying it over `props` when
+    it is a delta."""
+    if props is None:
+        props = {}
+    else:
+        props = dict(props)
+    pos = 0
+    while True:
+        end = data.index('\n', pos)
+        line = data[pos:end]
+        pos = end+1
+        if line == 'PROPS-END':
+            break
+        (tag, length) = line.split(' ')
+        length = int(length)
+        key = data[pos:pos+length]
+        pos += length+1
+        if tag == 'D':
+            props.pop(key, None)
+            continue
+        end = data.index('\n', pos)
+        length = int(data[pos:end].split(' ')[1])
+        pos = end+1
+        props[key] = data[pos:pos+length]
+        pos += length+1
+    return props
+
+class _Node(object):
+    """State of a path at some revision: kind is 'file' or 'dir', text is
+    an (offset, length) pair pointing into the dump file. A directory that
+    was copied keeps the (path, revno) it was copied from in copyfrom, the
+    entries below it are looked up there."""
+
+    __slots__ = ('kind', 'text', 'props', 'copyfrom')
+
+    def __init__(self, kind, text, props, copyfrom=None):
+        self.kind     = kind
+        self.text     = text
+        self.props    = props
+        self.copyfrom = copyfrom
+
+class _ChangeRecord(object):
+
+    __slots__ = ('action', 'path', 'copyfrom_path', 'copyfrom_revision',
+                 'text_modified', 'removed')
+
+    def __init__(self, action, path, copyfrom_path, copyfrom_revision,
+                 text_modified, removed):
+        self.action            = action
+        self.path              = path
+        self.copyfrom_path     = copyfrom_path
+        self.copyfrom_revision = copyfrom_revision
+        self.text_modified     = text_modified
+        self.removed           = removed # node a deletion took away
+
+class _RevisionRecord(object):
+
+    def __init__(self, revno, props):
+        self.revno   = revno
+        self.author  = props.get('svn:author', '')
+        self.message = props.get('svn:log', '')
+        self.date    = 0
+        if 'svn:date' in props:
+            self.date = calendar.timegm(time.strptime(
+                props['svn:date'].split('.')[0], '%Y-%m-%dT%H:%M:%S'))
+        self.changes = []
+
+class _Index(object):
+    """The history of every path of a dump file. The dump is scanned once,
+    reading only headers and properties; file contents are read back from
+    the dump when asked for."""
+
+    def __init__(self, filename, stamp):
+        self.filename  = filename
+        self.stamp     = stamp
+        self.file      = None
+        self.filelock  = threading.Lock()
+        self.revisions = {}
+        self.history   = {} # path -> ([revno...], [_Node or None...])
+        self.resets    = {} # path -> revisions it was added, replaced or
+                            # deleted in, same layout as history
+        self.children  = {} # directory -> paths ever seen below it
+
+    def load(self):
+        try:
+            self.file = open(self.filename, 'rb')
+        except IOError as inst:
+            raise error.Abort(_("Cannot open dump file %s: %s") %
+                              (self.filename, inst.strerror))
+        current = None
+        f = self.file
+        while True:
+            headers = self._readheaders(f)
+            if headers is None:
+                break
+            props = None
+            if 'Prop-content-length' in headers:
+                props = f.read(int(headers['Prop-content-length']))
+            text = None
+            if 'Text-content-length' in headers:
+                if headers.get('Text-delta') == 'true':
+                    f.close()
+                    raise error.Abort(_("Dump file %s holds deltas, create "
+                        "it with 'svnadmin dump' without '--deltas'") %
+                        self.filename)
+                length = int(headers['Text-content-length'])
+                text = (f.tell(), length)
+                f.seek(length, os.SEEK_CUR)
+
+            if 'Revision-number' in headers:
+                current = _RevisionRecord(int(headers['Revision-number']),
+                                          _parseprops(props or 'PROPS-END\n'))
+                self.revisions[current.revno] = current
+            elif 'Node-path' in headers:
+                self._apply(current, headers, props, text)
+
+    def _readheaders(self, f):
+        headers = {}
+        while True:
+            line = f.readline()
+            if line == '':
+                return headers or None
+            line = line.rstrip('\n')
+            if line == '':
+                if len(headers) > 0:
+                    return headers
+                continue
+            (key, value) = line.split(': ', 1)
+            headers[key] = value
+
+    def read(self, text, offset=0, length=None):
+        if length is None:
+            length = text[1] - offset
+        with self.filelock:
+            self.file.seek(text[0] + offset)
+            return self.file.read(length)
+
+    def _latest(self, table, path, revno):
+        if path not in table:
+            return None
+        (revs, nodes) = table[path]
+        i = bisect.bisect_right(revs, revno)
+        if i == 0:
+            return None
+        return (revs[i-1], nodes[i-1])
+
+    def _origin(self, path, revno):
+        """Return (path, node) of the entry deciding the state of a path:
+        its own latest one, unless a directory above it was added, replaced
+        or deleted after that. Within a revision the deepest one wins, as
+        the dump lists parents first."""
+        (origin, originrev, node) = (None, -1, None)
+        latest = self._latest(self.history, path, revno)
+        if latest is not None:
+            (origin, originrev, node) = (path, latest[0], latest[1])
+        parent = path
+        while parent != '/':
+            parent = posixpath.dirname(parent)
+            latest = self._latest(self.resets, parent, revno)
+            if latest is not None and latest[0] > originrev:
+                (origin, originrev, node) = (parent, latest[0], latest[1])
+        return (origin, node)
+
+    def state(self, path, revno):
+        (origin, node) = self._origin(path, revno)
+        while origin is not None and origin != path:
+            # below a directory that was replaced as a whole: the path is
+            # there only if the directory was copied from where it was
+            if node is None or node.copyfrom is None:
+                return None
+            (source, revno) = node.copyfrom
+            path = _rebase(path, origin, source)
+            (origin, node) = self._origin(path, revno)
+        return node
+
+    def _copysource(self, path, revno):
+        """Return the (path, revno) a directory took its entries from when
+        it, or a directory above it, was copied."""
+        (origin, node) = self._origin(path, revno)
+        if node is None or node.copyfrom is None:
+            return None
+        (source, sourcerev) = node.copyfrom
+        return (_rebase(path, origin, source), sourcerev)
+
+    def _entries(self, path, revno):
+        """Return the paths that may be found right below a directory."""
+        entries = set(self.children.get(path, ()))
+        source = self._copysource(path, revno)
+        if source is not None:
+            (sourcepath, sourcerev) = source
+            for p in self._entries(sourcepath, sourcerev):
+                entries.add(_rebase(p, sourcepath, path))
+        return entries
+
+    def tree(self, path, revno):
+        """Yield (path, node) for the nodes below a directory."""
+        pending = [path]
+        while len(pending) > 0:
+            for child in sorted(self._entries(pending.pop(), revno)):
+                node = self.state(child, revno)
+                if node is not None:
+                    yield (child, node)
+                    if node.kind == 'dir':
+                        pending.append(child)
+
+    def _set(self, path, revno, node, reset):
+        tables = [self.history]
+        if reset:
+            tables.append(self.resets)
+        for table in tables:
+            (revs, nodes) = table.setdefault(path, ([], []))
+            if len(revs) > 0 and revs[-1] == revno:
+                nodes[-1] = node
+            else:
+                revs.append(revno)
+                nodes.append(node)
+        while node is not None and path != '/':
+            children = self.children.setdefault(posixpath.dirname(path),
+                                                set())
+            if path in children:
+                break
+            children.add(path)
+            path = posixpath.dirname(path)
+
+    def _apply(self, revision, headers, props, text):
+        path = _normpath(headers['Node-path'])
+        action = headers['Node-action']
+        revno = revision.revno
+
+        removed = None
+        if action in ('delete', 'replace'):
+            removed = self.state(path, revno)
+            # takes whatever was below along, see _origin()
+            self._set(path, revno, None, True)
+
+        copyfrom_path = headers.get('Node-copyfrom-path')
+        copyfrom_revision = None
+        base = None
+        copyfrom = None
+        if action == 'change':
+            base = self.state(path, revno)
+            copyfrom = self._copysource(path, revno)
+        if copyfrom_path is not None:
+            copyfrom_path = _normpath(copyfrom_path)
+            copyfrom_revision = int(headers['Node-copyfrom-rev'])
+            base = self.state(copyfrom_path, copyfrom_revision)
+            copyfrom = (copyfrom_path, copyfrom_revision)
+
+        text_modified = text is not None
+        if action != 'delete':
+            kind = headers.get('Node-kind') or (base and base.kind)
+            nodeprops = base and base.props or {}
+            if props is not None:
+                if headers.get('Prop-delta') == 'true':
+                    nodeprops = _parseprops(props, nodeprops)
+                else:
+                    nodeprops = _parseprops(props)
+            if text is None and base is not None:
+                text = base.text
+            if kind != 'dir':
+                copyfrom = None
+            self._set(path, revno, _Node(kind, text, nodeprops, copyfrom),
+                      action != 'change')
+        if action == 'delete' or \
+                (action == 'add' and copyfrom_path is None):
+            text_modified = None
+
+        revision.changes.append(_ChangeRecord(_actions[action], path,
+            copyfrom_path, copyfrom_revision, text_modified, removed))
+
+_indexes = {} # real path of a dump file -> _Index
+_indexlock = threading.Lock()
+
+def _getindex(filename):
+    """Return the index of a dump file, shared by all the clients reading
+    it and built again only when the file changes."""
+    try:
+        st = os.stat(filename)
+    except OSError as inst:
+        raise error.Abort(_("Cannot open dump file %s: %s") %
+                          (filename, inst.strerror))
+    key = os.path.realpath(filename)
+    stamp = (st.st_size, st.st_mtime)
+    with _indexlock:
+        index = _indexes.get(key)
+        if index is None or index.stamp != stamp:
+            index = _Index(filename, stamp)
+            index.load()
+            _indexes[key] = index
+    return index
+
+class Client(scmbase.Client):
+    """Reads the history of a repository from the output of 'svnadmin
+    dump'. Clients of the same dump file share its index."""
+
+    def __init__(self, repo_url):
+        self._repo_url = repo_url
+        if repo_url.startswith('file://'):
+            self._filename = urllib.url2pathname(repo_url[len('file://'):])
+        else:
+            self._filename = repo_url
+        self._branch = ''
+        self._index = None
+
+    def _load(self):
+        if self._index is None:
+            self._index = _getindex(self._filename)
+        return self._index
+
+    def _inbranch(self, path):
+        prefix = _normpath(self._branch)
+        return prefix == '/' or path == prefix or \
+            path.startswith(prefix + '/')
+
+    def _branchrevs(self):
+        return sorted([ r.revno for r in self._load().revisions.itervalues()
+                        if [ c for c in r.changes if self._inbranch(c.path) ]])
+
+    def _branchpath(self, path):
+        filepath = path.lstrip('/')
+        branch = self._branch.strip('/')
+        if len(branch) > 0 and (filepath == branch or
+                                filepath.startswith(branch + '/')):
+            filepath = filepath[len(branch):].lstrip('/')
+        return '/'+filepath
+
+    def _fullpath(self, filepath):
+        return _normpath(self._branch.strip('/') + '/' + filepath.strip('/'))
+
+    def setbranch(self, branch):
+        self._branch = branch
+
+    def getrevrange(self):
+        revs = self._branchrevs()
+        if len(revs) == 0:
+            return (0, 0)
+        return (revs[0], revs[-1])
+
+    def getrev(self, revno):
+        return Revision(self, self._load().revisions[revno])
+
+    def cat(self, revno, filepath):
+        index = self._load()
+        node = index.state(self._fullpath(filepath), revno)
+        if node is None or node.text is None:
+            return ''
+        return index.read(node.text)
+
+    def catchunks(self, revno, filepath, chunksize):
+        index = self._load()
+        node = index.state(self._fullpath(filepath), revno)
+        if node is None or node.text is None:
+            return
+        length = node.text[1]
+        for pos in xrange(0, length, chunksize):
+            yield index.read(node.text, pos, min(chunksize, length - pos))
+
+    def listfiles(self, revno, path='/'):
+        index = self._load()
+        fullpath = self._fullpath(path)
+        node = index.state(fullpath, revno)
+        if node is None and fullpath != '/':
+            return []
+        if node is None or node.kind == 'dir':
+            nodes = index.tree(fullpath, revno)
+        else:
+            nodes = [(fullpath, node)]
+        files = []
+        for (p, node) in nodes:
+            if node.kind != 'file':
+                continue
+            filepath = self._branchpath(p)
+            if not self.accepts(filepath):
+                continue
+            mimetype = node.props.get('svn:mime-type')
+            files.append((filepath, node.text and node.text[1] or 0,
+                          mimetype is not None and mimetype.find('text') < 0))
+        return files
+
+    def iterrevs(self, startrev=0, endrev=0):
+        revisions = self._load().revisions
+        for revno in self._branchrevs():
+            if startrev <= revno <= endrev:
+                yield Revision(self, revisions[revno])
+
+class Revision(scmbase.Revision):
+
+    def __init__(self, parent, base):
+        self.parent = parent
+        self._base  = base
+
+    @property
+    def id(self):
+        return self._base.revno
+
+    @property
+    def author(self):
+        return self._base.author
+
+    @property
+    def message(self):
+        return self._base.message
+
+    @property
+    def date(self):
+        return datetime.datetime.fromtimestamp(self._base.date)
+
+    def iterchanges(self):
+        client = self.parent
+        for change in self._base.changes:
+            if client._inbranch(change.path) and \
+                    client.accepts(client._branchpath(change.path)):
+                yield Change(self, change)
+
+class Change(scmbase.Change):
+
+    def __init__(self, parent, base):
+        self.parent = parent
+        self._base  = base
+
+    @property
+    def path(self):
+        return Path(self, self._base.path)
+
+    @property
+    def changetype(self):
+        return self._base.action
+
+    def iscopy(self):
+        return self._base.copyfrom_path is not None
+
+    def getorigin(self):
+        if self._base.copyfrom_path is None:
+            return (None, None)
+        return (Path(self, self._base.copyfrom_path),
+                self._base.copyfrom_revision)
+
+    def textmodified(self):
+        return self._base.text_modified
+
+class Path(scmbase.Path):
+
+    def __init__(self, parent, filepath):
+        self.parent    = parent
+        self._filepath = filepath
+
+    def _node(self):
+        change = self.parent
+        revision = change.parent
+        client = revision.parent
+        revno = revision.id
+        if change.changetype == 'D':
+            # it may have been added earlier in the same revision
+            if self._filepath == change._base.path:
+                return change._base.removed
+            revno -= 1
+        return client._load().state(self._filepath, revno)
+
+    def isdir(self):
+        node = self._node()
+        return node is not None and node.kind == 'dir'
+
+    def isfile(self):
+        return not self.isdir()
+
+    def isbinary(self):
+        node = self._node()
+        isbin = False #if explicit mime-type is not found assumes 'text'
+        if node is not None and 'svn:mime-type' in node.props:
+            if node.props['svn:mime-type'].find('text') < 0:
+                isbin = True
+        return isbin
+
+    def istext(self):
+        return not self.isbinary()
+
+    def size(self):
+        node = self._node()
+        if node is None or node.text is None:
+            return None
+        return node.text[1]
+
+    @property
+    def fullpath(self):
+        return self._filepath
+
+    def __str__(self):
+        client = self.parent.parent.parent
+        return client._branchpath(self._filepath)
+
+# Modeline for vim: set tw=79 et ts=4:
@@ -7,6 +7,7 @@
 # GNU General Public License version 2, incorporated herein by reference.
 
 from entities import *
+import idcache, migrate
 import xray4scm.error as error
 from xray4scm.i18n import _
 from sqlobject import connectionForURI
@@ -23,13 +24,17 @@ def init(connection):
     globals()['_connection'] = connection
 
 def transaction():
-    return globals()['_connection'].transaction()
+    return idcache.CachingTransaction(globals()['_connection'])
 
 def _defineVersion():
-    m = Metadata(version=1)
+    m = Metadata(version=str(migrate.version))
 
 def create():
-    """Checks if database tables exist and if they don't, creates them."""
+    """Checks if database tables exist and if they don't, creates them.
+    Databases of an earlier version are upgraded instead."""
+    if migrate.getVersion() is not None:
+        upgrade()
+        return
     for cls in entities.__all__:
         globals()[cls].createTable(ifNotExists=True)
     Metadata.clearTable()
@@ -40,23 +45,33 @@ def clear():
     for cls in entities.__all__:
         globals()[cls].dropTable()
         globals()[cls].createTable()
+    idcache.clear()
     _defineVersion()
 
 def drop():
     """Drops all database tables."""
     for cls in entities.__all__:
         globals()[cls].dropTable()
+    idcache.clear()
 
 def checkVersion(e=error.Abort(_('Invalid database version'))):
-    try:
-        res = Metadata.select(Metadata.q.version == 1).count() == 1
-    except:
-        if e: raise e
-        return False
+    version = migrate.getVersion()
+    res = version == migrate.version
     if not res and e:
+        if version is not None and version < migrate.version:
+            raise error.Abort(_("The database is from an earlier version "
+                "of XRay, upgrade it with 'xray upgrade'"))
         raise e
     return res
 
+def upgrade(notify=None):
+    """Brings the database to the current version in place, calling
+    notify(version, description) before each migration. Returns how many
+    migrations were run."""
+    n = migrate.upgrade(_connection, notify)
+    idcache.clear()
+    return n
+
 def getRepositories():
     return list( Repository.select() )
 
@@ -82,6 +97,30 @@ def rmBranch(repo, branch):
         raise error.Abort(_("Branch not found."))
     Branch.delete(b.id)
 
+def addFilter(repo, branch, pattern, include=False):
+    r = Repository.byArg(repo)
+    b = Branch.select(AND(Branch.q.repository == r.id,
+            Branch.q.name == branch)).getOne(None)
+    if not b:
+        raise error.Abort(_("Branch not found."))
+    f = PathFilter.select(AND(PathFilter.q.branch == b.id,
+            PathFilter.q.pattern == pattern)).getOne(None)
+    if f:
+        raise error.Abort(_("This filter already exists."))
+    f = PathFilter(branch=b, pattern=pattern, include=include)
+
+def rmFilter(repo, branch, pattern):
+    r = Repository.byArg(repo)
+    b = Branch.select(AND(Branch.q.repository == r.id,
+            Branch.q.name == branch)).getOne(None)
+    if not b:
+        raise error.Abort(_("Branch not found."))
+    f = PathFilter.select(AND(PathFilter.q.branch == b.id,
+            PathFilter.q.pattern == pattern)).getOne(None)
+    if not f:
+        raise error.Abort(_("Filter not found."))
+    PathFilter.delete(f.id)
+
 __backends__= TheURIOpener.schemeBuilders.keys()
 
 # Modeline for vim: set tw=79 et ts=4:
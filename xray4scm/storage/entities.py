@@ -9,7 +9,8 @@
 import os, sys
 import xray4scm.error as error
 from xray4scm.i18n import _
-from xray4scm.util import parsedate
+from xray4scm.util import parsedate, addlocs
+import idcache
 from sqlobject import *
 from sqlobject.sqlbuilder import *
 from sqlobject.dberrors import *
@@ -17,9 +18,40 @@ from datetime import datetime
 
 __all__ = [
 'Metadata', 'Author', 'Language', 'File', 'Path', 'FilePath', 'Repository',
-'Branch', 'Revision', 'Change', 'Loc'
+'Branch', 'Revision', 'Change', 'Loc', 'LocCache', 'BranchBoundary',
+'SizeLimit', 'Oversized', 'PathFilter', 'Snapshot', 'SnapshotLoc', 'LocDelta',
+'RevisionLoc', 'SnapshotOversized'
 ]
 
+# rows written by a single INSERT statement
+_insertbatch = 500
+
+# ids of the dimension rows, by name
+_authors   = idcache.cache(1000)
+_languages = idcache.cache(1000)
+_files     = idcache.cache(20000)
+_paths     = idcache.cache(20000)
+_filepaths = idcache.cache(50000)
+
+def _internId(cache, cls, column, value, connection=None):
+    """Return the id of the row of `cls` whose alternate id `column` holds
+    `value`, creating the row when missing."""
+    id = cache.get(value, connection)
+    if id is not None:
+        return id
+    by = getattr(cls, 'by' + column[0].upper() + column[1:])
+    try:
+        id = by(value, connection=connection).id
+    except SQLObjectNotFound as nf:
+        try:
+            id = cls(connection=connection, **{column: value}).id
+        except DuplicateEntryError as inst:
+            id = by(value, connection=connection).id
+        except: raise
+    except: raise
+    cache.put(value, id, connection)
+    return id
+
 class Metadata(SQLObject):
     version = StringCol(length=45, notNone=True)
     created = TimestampCol(default=datetime.now(), notNone=True)
@@ -28,31 +60,39 @@ class Author(SQLObject):
     name = StringCol(length=255, alternateID=True)
     revisions = MultipleJoin('Revision')
 
+    @staticmethod
+    def idFromName(name, connection=None):
+        return _internId(_authors, Author, 'name', name, connection)
+
 class Language(SQLObject):
     language = StringCol(length=45, alternateID=True)
     files = MultipleJoin('File')
 
+    @staticmethod
+    def idFromLanguage(lang, connection=None):
+        return _internId(_languages, Language, 'language', lang, connection)
+
     @staticmethod
     def fromLanguage(lang, connection=None):
-        try:
-            l = Language.byLanguage(lang)
-        except SQLObjectNotFound as nf:
-            try:
-                l = Language(language=lang, connection=connection)
-            except DuplicateEntryError as inst:
-                l = Language.byLanguage(lang, connection=connection)
-            except: raise
-        except: raise
-        return l
+        return Language.get(Language.idFromLanguage(lang, connection),
+                            connection=connection)
 
 class File(SQLObject):
     name = UnicodeCol(length=255, alternateID=True)
     paths = MultipleJoin('FilePath')
 
+    @staticmethod
+    def idFromName(name, connection=None):
+        return _internId(_files, File, 'name', name, connection)
+
 class Path(SQLObject):
     path = UnicodeCol(length=255, alternateID=True)
     files = MultipleJoin('FilePath')
 
+    @staticmethod
+    def idFromPath(path, connection=None):
+        return _internId(_paths, Path, 'path', path, connection)
+
 class FilePath(SQLObject):
     file = ForeignKey('File', cascade=True)
     path = ForeignKey('Path', cascade=True)
@@ -78,42 +118,84 @@ class FilePath(SQLObject):
         ).getOne(None)
 
     @staticmethod
-    def fromFilePath(filepath, connection=None):
+    def idFromFilePath(filepath, connection=None):
+        id = _filepaths.get(filepath, connection)
+        if id is not None:
+            return id
         (dir, name, ext) = FilePath.breakNames(filepath)
+        file = File.idFromName(name, connection)
+        path = Path.idFromPath(dir, connection)
 
-        fp = FilePath.byFilePath(name, dir)
+        def lookup():
+            return FilePath.select(
+                AND(FilePath.q.file == file, FilePath.q.path == path),
+                connection=connection
+            ).getOne(None)
+
+        fp = lookup()
         if fp is None:
             try:
-                path = Path.byPath(dir)
-            except SQLObjectNotFound as nf:
-                path = None
-            except: raise
-            try:
-                file = File.byName(name)
-            except SQLObjectNotFound as nf:
-                file = None
+                fp = FilePath(file=file, path=path, connection=connection)
+            except DuplicateEntryError as inst:
+                fp = lookup()
             except: raise
+        _filepaths.put(filepath, fp.id, connection)
+        return fp.id
+
+    @staticmethod
+    def fromFilePath(filepath, connection=None):
+        return FilePath.get(FilePath.idFromFilePath(filepath, connection),
+                            connection=connection)
 
-            if file is None or path is None:
-                if file is None:
-                    try:
-                        file = File(name=name, connection=connection)
-                    except DuplicateEntryError as inst:
-                        file = File.byName(name, connection=connection)
-                    except: raise
-                if path is None:
-                    try:
-                        path = Path(path=dir, connection=connection)
-                    except DuplicateEntryError as inst:
-                        path = Path.byPath(dir, connection=connection)
-                    except: raise
-                try:
-                    fp = FilePath(file=file, path=path, connection=connection)
-                except DuplicateEntryError as inst:
-                    fp = fp = FilePath.byFilePath(name, dir, connection=connection)
-                except: raise
-
-        return fp
+def _insertMany(cls, columns, rows, connection=None):
+    """Insert rows (tuples of values for the `columns` of `cls`) with
+    multi-row INSERT statements, without creating SQLObject instances."""
+    conn = connection or cls._connection
+    names = [ cls.sqlmeta.columns[c].dbName for c in columns ]
+    for i in xrange(0, len(rows), _insertbatch):
+        conn.query(conn.sqlrepr(Insert(cls.sqlmeta.table,
+            valueList=rows[i:i+_insertbatch], template=names)))
+
+def _sumDeltas(where, language=None):
+    """Return the (code, comments, blanks) added by the changes matching
+    a condition, in a single query."""
+    where = [where, LocDelta.q.change == Change.q.id]
+    if language is not None:
+        where += [LocDelta.q.language == Language.q.id,
+                  Language.q.language == language]
+    conn = LocDelta._connection
+    row = conn.queryOne(conn.sqlrepr(Select(
+        [func.SUM(LocDelta.q.code), func.SUM(LocDelta.q.comments),
+         func.SUM(LocDelta.q.blanks)],
+        where=AND(*where))))
+    return tuple([ int(n or 0) for n in row ])
+
+def _addcounts(counts, others, sign=1):
+    return tuple([ a + sign * b for (a, b) in zip(counts, others) ])
+
+def _sumall(deltas):
+    """Return the (None, code, comments, blanks) sum of (language, code,
+    comments, blanks) tuples, or of (code, comments, blanks) ones."""
+    total = (0, 0, 0)
+    for counts in deltas:
+        total = _addcounts(total, counts[-3:])
+    return (None,) + total
+
+def _snapshotTotals(snapshot, language, connection=None):
+    if language is None:
+        return snapshot.getTotals(connection)
+    return snapshot.getLanguageTotals(connection).get(language, (0, 0, 0))
+
+def _belowpath(path):
+    """Conditions choosing the file paths at `path` or below it, to be
+    joined with File and Path."""
+    path = '/' + path.strip('/')
+    if path == '/':
+        return []
+    (dir, name, ext) = FilePath.breakNames(path)
+    return [OR(AND(Path.q.path == dir, File.q.name == name),
+               Path.q.path == path,
+               Path.q.path.startswith(path + '/'))]
 
 class Repository(SQLObject):
     url = StringCol(length=255, notNone=True)
@@ -144,6 +226,49 @@ class Repository(SQLObject):
     def markAsUpdated(self):
         self.set(updated=datetime.now())
 
+    def getSizeLimit(self, connection=None):
+        """Return a (maxsize, stream) tuple telling the size above which
+        files are not read at once, or None if there is no limit."""
+        limit = SizeLimit.select(SizeLimit.q.repository == self.id,
+                                 connection=connection).getOne(None)
+        if limit is None:
+            return None
+        return (limit.maxSize, limit.stream)
+
+    def setSizeLimit(self, maxsize, stream=False, connection=None):
+        """Limit the size of files read at once; a maxsize of None removes
+        the limit."""
+        limit = SizeLimit.select(SizeLimit.q.repository == self.id,
+                                 connection=connection).getOne(None)
+        if maxsize is None:
+            if limit is not None:
+                limit.destroySelf()
+            return
+        if limit is None:
+            SizeLimit(repository=self, maxSize=maxsize, stream=stream,
+                      connection=connection)
+        else:
+            limit.set(maxSize=maxsize, stream=stream)
+
+    def findBranch(self, path, connection=None):
+        """Find the branch holding a path given relative to the repository
+        root. Returns a (branch, path relative to the branch) tuple, or
+        (None, None) if no monitored branch contains that path."""
+        path = '/' + path.strip('/')
+        found, relpath = None, None
+        for b in Branch.select(Branch.q.repository == self.id,
+                               connection=connection):
+            prefix = '/' + b.name.strip('/')
+            if prefix == '/':
+                rest = path
+            elif path == prefix or path.startswith(prefix + '/'):
+                rest = path[len(prefix):] or '/'
+            else:
+                continue
+            if found is None or len(b.name) > len(found.name):
+                found, relpath = b, rest
+        return (found, relpath)
+
     @staticmethod
     def byArg(repo):
         if repo is None: return None
@@ -175,18 +300,276 @@ class Branch(SQLObject):
             join=INNERJOINOn(None, Revision, Branch.q.id == Revision.q.branch)
         ).max(Revision.q.revno) or default
 
-    def insertRevision(self, nr, who, msg, date, connection=None):
-        try:
-            a = Author.byName(who)
-        except SQLObjectNotFound as nf:
+    def getFileLocs(self, path, revno, connection=None):
+        """Return a dictionary mapping every file at `path`, or below it
+        when it is a directory, to its list of (language, code, comments,
+        blanks) tuples as of revision `revno` of this branch. Files deleted
+        by then, directly or along with a parent directory, are left out."""
+        conn = connection or self._connection
+        where = [Revision.q.branch == self.id,
+                 Revision.q.revno <= revno,
+                 Change.q.revision == Revision.q.id,
+                 Change.q.path == FilePath.q.id,
+                 FilePath.q.path == Path.q.id,
+                 FilePath.q.file == File.q.id] + _belowpath(path)
+        rows = conn.queryAll(conn.sqlrepr(Select(
+            [Change.q.id, Change.q.changetype, Revision.q.revno,
+             Path.q.path, File.q.name],
+            where=AND(*where),
+            orderBy=Revision.q.revno)))
+
+        latest, deleted = {}, {}
+        for (id, changetype, rev, dir, name) in rows:
+            filepath = os.path.join(dir, name)
+            latest[filepath] = (id, changetype, rev)
+            if changetype in ('D', 'R'):
+                deleted[filepath] = rev
+
+        def isdeleted(filepath, rev):
+            while True:
+                if deleted.get(filepath, -1) > rev:
+                    return True
+                parent = os.path.dirname(filepath)
+                if parent == filepath:
+                    return False
+                filepath = parent
+
+        changes = {}
+        for filepath, (id, changetype, rev) in latest.iteritems():
+            if changetype != 'D' and not isdeleted(filepath, rev):
+                changes[id] = filepath
+
+        locs = dict([ (filepath, []) for filepath in changes.values() ])
+        ids = changes.keys()
+        for i in xrange(0, len(ids), 500):
+            for (change, language, code, comments, blanks) in conn.queryAll(
+                    conn.sqlrepr(Select(
+                        [Loc.q.change, Language.q.language, Loc.q.code,
+                         Loc.q.comments, Loc.q.blanks],
+                        where=AND(IN(Loc.q.change, ids[i:i+500]),
+                                  Loc.q.language == Language.q.id)))):
+                locs[changes[change]].append(
+                    (language, code, comments, blanks))
+        return locs
+
+    def getFilters(self, connection=None):
+        """Return the (include patterns, exclude patterns) of this branch."""
+        includes, excludes = [], []
+        for f in PathFilter.select(PathFilter.q.branch == self.id,
+                                   orderBy=PathFilter.q.id,
+                                   connection=connection):
+            if f.include:
+                includes.append(f.pattern)
+            else:
+                excludes.append(f.pattern)
+        return (includes, excludes)
+
+    def getBoundaries(self, connection=None):
+        """Return the facts its SCM backend saved about this branch."""
+        entry = BranchBoundary.select(BranchBoundary.q.branch == self.id,
+                                      connection=connection).getOne(None)
+        if entry is None:
+            return {}
+        boundaries = {}
+        for key, attr in BranchBoundary.scmkeys:
+            value = getattr(entry, attr)
+            if value is not None:
+                boundaries[key] = value
+        return boundaries
+
+    def setBoundaries(self, boundaries, connection=None):
+        values = {}
+        for key, attr in BranchBoundary.scmkeys:
+            values[attr] = boundaries.get(key)
+        entry = BranchBoundary.select(BranchBoundary.q.branch == self.id,
+                                      connection=connection).getOne(None)
+        if entry is None:
             try:
-                a = Author(name=who, connection=connection)
+                entry = BranchBoundary(branch=self, connection=connection,
+                                       **values)
             except DuplicateEntryError as inst:
-                a = Author.byName(who, connection=connection)
+                pass
             except: raise
-        except: raise
+        else:
+            entry.set(**values)
+        return entry
+
+    def getChanges(self, connection=None):
+        """Return (change id, changetype, revno, filepath) tuples for all
+        changes of this branch, in revision order."""
+        conn = connection or self._connection
+        rows = conn.queryAll(conn.sqlrepr(Select(
+            [Change.q.id, Change.q.changetype, Revision.q.revno,
+             Path.q.path, File.q.name],
+            where=AND(Revision.q.branch == self.id,
+                      Change.q.revision == Revision.q.id,
+                      Change.q.path == FilePath.q.id,
+                      FilePath.q.path == Path.q.id,
+                      FilePath.q.file == File.q.id),
+            orderBy=[Revision.q.revno, Change.q.id])))
+        return [ (id, changetype, rev, os.path.join(dir, name))
+                 for (id, changetype, rev, dir, name) in rows ]
+
+    def getSnapshot(self, connection=None):
+        """Return the snapshot this branch was synchronized from, or None
+        when its history was read from the start."""
+        return Snapshot.select(Snapshot.q.branch == self.id,
+                               connection=connection).getOne(None)
+
+    def getLocDeltas(self, connection=None):
+        """Return (revno, commitdate, code, comments, blanks) tuples with
+        the lines of code each revision added, in revision order."""
+        conn = connection or self._connection
+        deltas = dict([ (rev, (code, comments, blanks))
+            for (rev, code, comments, blanks) in conn.queryAll(
+                conn.sqlrepr(Select(
+                    [Revision.q.revno, func.SUM(LocDelta.q.code),
+                     func.SUM(LocDelta.q.comments),
+                     func.SUM(LocDelta.q.blanks)],
+                    where=AND(Revision.q.branch == self.id,
+                              Change.q.revision == Revision.q.id,
+                              LocDelta.q.change == Change.q.id),
+                    groupBy=Revision.q.revno))) ])
+        rows = conn.queryAll(conn.sqlrepr(Select(
+            [Revision.q.revno, Revision.q.commitdate],
+            where=Revision.q.branch == self.id,
+            orderBy=Revision.q.revno)))
+        return [ (rev, date) + tuple([ int(n or 0)
+                     for n in deltas.get(rev, (0, 0, 0)) ])
+                 for (rev, date) in rows ]
+
+    def getLocTotals(self, connection=None):
+        """Return (revno, commitdate, code, comments, blanks) tuples with
+        the lines of code of the branch after each revision, in revision
+        order."""
+        conn = connection or self._connection
+        return conn.queryAll(conn.sqlrepr(Select(
+            [Revision.q.revno, Revision.q.commitdate,
+             RevisionLoc.q.totalCode, RevisionLoc.q.totalComments,
+             RevisionLoc.q.totalBlanks],
+            where=AND(Revision.q.branch == self.id,
+                      RevisionLoc.q.revision == Revision.q.id,
+                      RevisionLoc.q.language == None),
+            orderBy=Revision.q.revno)))
+
+    def rebuildTotals(self, connection=None):
+        """Compute again the lines of code each revision added and the
+        totals of the branch after it, from the lines each change added."""
+        conn = connection or self._connection
+        revisions = conn.queryAll(conn.sqlrepr(Select(
+            [Revision.q.id, Revision.q.revno],
+            where=Revision.q.branch == self.id,
+            orderBy=Revision.q.revno)))
+        ids = [ r[0] for r in revisions ]
+        for i in xrange(0, len(ids), 500):
+            RevisionLoc.deleteMany(IN(RevisionLoc.q.revision, ids[i:i+500]),
+                                   connection=connection)
+        deltas = {}
+        for (revision, language, code, comments, blanks) in conn.queryAll(
+                conn.sqlrepr(Select(
+                    [Change.q.revision, LocDelta.q.language,
+                     func.SUM(LocDelta.q.code), func.SUM(LocDelta.q.comments),
+                     func.SUM(LocDelta.q.blanks)],
+                    where=AND(Revision.q.branch == self.id,
+                              Change.q.revision == Revision.q.id,
+                              LocDelta.q.change == Change.q.id),
+                    groupBy=[Change.q.revision, LocDelta.q.language]))):
+            deltas.setdefault(revision, []).append(
+                (language, int(code), int(comments), int(blanks)))
+        for revision in deltas:
+            deltas[revision].insert(0, _sumall(deltas[revision]))
+
+        # totals before the first revision stored
+        totals = {}
+        snapshot = self.getSnapshot(connection)
+        if snapshot is not None:
+            totals = snapshot.getLanguageTotals(connection)
+            totals[None] = _sumall(totals.values())[1:]
+            for (id, revno) in revisions:
+                if revno > snapshot.revno:
+                    break
+                for (language, code, comments, blanks) in \
+                        deltas.get(id, []):
+                    totals[language] = _addcounts(
+                        totals.get(language, (0, 0, 0)),
+                        (code, comments, blanks), -1)
+
+        rows = []
+        for (id, revno) in revisions:
+            for (language, code, comments, blanks) in \
+                    deltas.get(id, [(None, 0, 0, 0)]):
+                totals[language] = _addcounts(
+                    totals.get(language, (0, 0, 0)),
+                    (code, comments, blanks))
+                rows.append((id, language, code, comments, blanks) +
+                            totals[language])
+        _insertMany(RevisionLoc, _revisionloccolumns, rows, connection)
+
+    def rebuildReports(self, connection=None):
+        """Compute again everything reports read: the lines of code each
+        change added, unless the branch was synchronized from a snapshot,
+        and the totals after each revision."""
+        if self.getSnapshot(connection) is None:
+            self.rebuildDeltas(connection)
+        self.rebuildTotals(connection)
+
+    def rebuildDeltas(self, connection=None):
+        """Compute again the lines of code each change added, from those
+        stored for its file after each change, replacing the deltas of the
+        branch. Not for branches synchronized from a snapshot, whose earlier
+        versions of the files are not stored."""
+        conn = connection or self._connection
+        changes = self.getChanges(connection)
+        ids = [ c[0] for c in changes ]
+        locs = {}
+        for i in xrange(0, len(ids), 500):
+            LocDelta.deleteMany(IN(LocDelta.q.change, ids[i:i+500]),
+                                connection=connection)
+            for (change, language, code, comments, blanks) in conn.queryAll(
+                    conn.sqlrepr(Select(
+                        [Loc.q.change, Language.q.language, Loc.q.code,
+                         Loc.q.comments, Loc.q.blanks],
+                        where=AND(IN(Loc.q.change, ids[i:i+500]),
+                                  Loc.q.language == Language.q.id)))):
+                locs.setdefault(change, []).append(
+                    (language, code, comments, blanks))
+        paths = {}
+        for (id, changetype, revno, filepath) in changes:
+            paths.setdefault(revno, set()).add(filepath)
+
+        latest = {}
+        rows = {}
+        for (id, changetype, revno, filepath) in changes:
+            after, before = [], []
+            if changetype != 'D':
+                after = locs.get(id, [])
+            if changetype != 'A':
+                before = latest.get(filepath, [])
+            delta = addlocs(after, before, -1)
+            if len(delta) > 0:
+                rows.setdefault(revno, []).append(
+                    (changetype, filepath, [], delta))
+            if changetype in ('D', 'R'):
+                # files deleted along with a directory
+                prefix = filepath.rstrip('/') + '/'
+                for f in [ f for f in latest if f.startswith(prefix) ]:
+                    if f not in paths[revno]:
+                        rows.setdefault(revno, []).append(
+                            ('D', f, [], addlocs([], latest.pop(f), -1)))
+            if len(after) > 0:
+                latest[filepath] = after
+            else:
+                latest.pop(filepath, None)
+
+        for revno in sorted(rows.keys()):
+            Revision.byRevisionBranch(revno, self, connection=connection) \
+                .insertChanges(rows[revno], connection=connection)
+
+    def insertRevision(self, nr, who, msg, date, connection=None):
+        a = Author.idFromName(who, connection)
         try:
-            r = Revision.byRevisionBranch(revno=nr, branch=self)
+            r = Revision.byRevisionBranch(revno=nr, branch=self,
+                    connection=connection)
         except SQLObjectNotFound as nf:
             try:
                 r = Revision(branch=self, revno=nr, author=a, log=msg,
@@ -205,23 +588,84 @@ class Revision(SQLObject):
     author = ForeignKey('Author', notNone=True, cascade=False)
     log = UnicodeCol(length=600, notNone=True)
     commitdate = TimestampCol(default=datetime.now(), notNone=True)
+    branchCommitdate = DatabaseIndex(branch, commitdate)
     changes = MultipleJoin('Change')
 
     def insertChange(self, type, filepath, connection=None):
-        try:
-            changes = Change.byRevisionPath(revision=self, path=filepath)
-        except SQLObjectNotFound as nf:
-            fp = FilePath.fromFilePath(filepath, connection=connection)
+        fp = FilePath.idFromFilePath(filepath, connection)
+
+        def lookup():
+            return Change.select(
+                AND(Change.q.revision == self.id, Change.q.path == fp),
+                connection=connection
+            ).getOne(None)
+
+        changes = lookup()
+        if changes is None:
             try:
                 changes = Change(revision=self, path=fp,
                     changetype=type, connection=connection)
             except DuplicateEntryError as inst:
-                changes = Change.byRevisionPath(revision=self,
-                        path=filepath, connection=connection)
+                changes = lookup()
             except: raise
-        except: raise
         return changes
 
+    def insertChanges(self, changes, connection=None):
+        """Store many changes of this revision with a few multi-row INSERT
+        statements. `changes` is a list of (changetype, filepath, locs,
+        deltas) tuples, locs and deltas being lists of (language, code,
+        comments, blanks) tuples. As with insertChange() and insertLoc(),
+        a path already changed by this revision keeps its change and a
+        language already counted for a change keeps its counts. Returns a
+        dictionary with the change id of each path."""
+        if len(changes) == 0:
+            return {}
+        conn = connection or self._connection
+        order = []
+        entries = {}
+        for (changetype, filepath, locs, deltas) in changes:
+            fp = FilePath.idFromFilePath(filepath, connection)
+            if fp not in entries:
+                entries[fp] = (changetype, filepath, [], [])
+                order.append(fp)
+            entries[fp][2].extend(locs)
+            entries[fp][3].extend(deltas)
+
+        def existing():
+            return dict(conn.queryAll(conn.sqlrepr(Select(
+                [Change.q.path, Change.q.id],
+                where=Change.q.revision == self.id))))
+
+        ids = existing()
+        old = [ ids[fp] for fp in order if fp in ids ]
+        new = [ (self.id, fp, entries[fp][0])
+                for fp in order if fp not in ids ]
+        if len(new) > 0:
+            _insertMany(Change, ['revisionID', 'pathID', 'changetype'], new,
+                        connection)
+            ids = existing()
+
+        for (cls, index) in ((Loc, 2), (LocDelta, 3)):
+            counted = set()
+            for i in xrange(0, len(old), 500):
+                counted.update(conn.queryAll(conn.sqlrepr(Select(
+                    [cls.q.change, cls.q.language],
+                    where=IN(cls.q.change, old[i:i+500])))))
+            rows = []
+            for fp in order:
+                change = ids[fp]
+                for (language, code, comments, blanks) in \
+                        entries[fp][index]:
+                    language = Language.idFromLanguage(language, connection)
+                    if (change, language) in counted:
+                        continue
+                    counted.add((change, language))
+                    rows.append((language, change, code, comments, blanks))
+            _insertMany(cls, ['languageID', 'changeID', 'code', 'comments',
+                              'blanks'], rows, connection)
+
+        return dict([ (entries[fp][1], ids[fp]) for fp in order ])
+
     @staticmethod
     def byRevisionBranch(revno, branch, connection=None):
         assert isinstance(branch, Branch)
@@ -233,18 +677,71 @@ class Revision(SQLObject):
         ).getOne()
 
     def getLocDiff(self, language=None):
-        code, comments, blanks = 0, 0, 0
-        for change in self.changes:
-            (c_code, c_comments, c_blanks) = change.getLocDiff(self, language)
-            code += c_code
-            comments += c_comments
-            blanks += c_blanks
-        return (code, comments, blanks)
+        """Return the (code, comments, blanks) this revision added."""
+        return _sumDeltas(Change.q.revision == self.id, language)
+
+    def insertTotals(self, connection=None):
+        """Record the lines of code this revision added, for each language
+        and in all, along with the totals of the branch after it. Once its
+        changes are stored, to be called for revisions stored in order, or
+        backwards from a snapshot."""
+        conn = connection or self._connection
+        RevisionLoc.deleteMany(RevisionLoc.q.revision == self.id,
+                               connection=connection)
+        deltas = [ (language, int(code), int(comments), int(blanks))
+                   for (language, code, comments, blanks) in conn.queryAll(
+                       conn.sqlrepr(Select(
+                           [LocDelta.q.language, func.SUM(LocDelta.q.code),
+                            func.SUM(LocDelta.q.comments),
+                            func.SUM(LocDelta.q.blanks)],
+                           where=AND(Change.q.revision == self.id,
+                                     LocDelta.q.change == Change.q.id),
+                           groupBy=LocDelta.q.language))) ]
+        snapshot = self.branch.getSnapshot(connection)
+        rows = []
+        for (language, code, comments, blanks) in [_sumall(deltas)] + deltas:
+            added = (code, comments, blanks)
+            if snapshot is None or self.revno > snapshot.revno:
+                # from the previous revision forwards
+                row = self._neighbour(language, Revision.q.revno < self.revno,
+                                      DESC(Revision.q.revno), conn)
+                if row is not None:
+                    totals = row[3:]
+                elif snapshot is not None:
+                    totals = _snapshotTotals(snapshot, language, connection)
+                else:
+                    totals = (0, 0, 0)
+                totals = _addcounts(totals, added)
+            else:
+                # from the next revision backwards
+                row = self._neighbour(language, Revision.q.revno > self.revno,
+                                      Revision.q.revno, conn)
+                if row is not None:
+                    totals = _addcounts(row[3:], row[:3], -1)
+                else:
+                    totals = _snapshotTotals(snapshot, language, connection)
+            rows.append((self.id, language) + added + totals)
+        _insertMany(RevisionLoc, _revisionloccolumns, rows, connection)
+
+    def _neighbour(self, language, where, orderBy, conn):
+        """Return the (code, comments, blanks, totalCode, totalComments,
+        totalBlanks) of the first revision of the branch matching a
+        condition, in some order, recorded for a language (None for all of
+        them), or None."""
+        return conn.queryOne(conn.sqlrepr(Select(
+            [RevisionLoc.q.code, RevisionLoc.q.comments, RevisionLoc.q.blanks,
+             RevisionLoc.q.totalCode, RevisionLoc.q.totalComments,
+             RevisionLoc.q.totalBlanks],
+            where=AND(Revision.q.branch == self.branch.id, where,
+                      RevisionLoc.q.revision == Revision.q.id,
+                      RevisionLoc.q.language == language),
+            orderBy=orderBy, limit=1)))
 
 class Change(SQLObject):
     revision = ForeignKey('Revision', cascade=True)
     path = ForeignKey('FilePath', cascade=False)
     revisionPath = DatabaseIndex(revision, path, unique=True)
+    pathRevision = DatabaseIndex(path, revision)
     changetype = EnumCol(enumValues=['A', 'M', 'D', 'R'])
 
     @staticmethod
@@ -261,20 +758,52 @@ class Change(SQLObject):
         ).getOne()
 
     def insertLoc(self, language, code, comments, blanks, connection=None):
-        try:
-            loc = Loc.byLanguageChange(language, self)
-        except SQLObjectNotFound as nf:
+        language = Language.idFromLanguage(language, connection)
+        loc = Loc.select(
+            AND(Loc.q.language == language, Loc.q.change == self.id),
+            connection=connection
+        ).getOne(None)
+        if loc is None:
             loc = Loc(
-                language=Language.fromLanguage(language, connection),
+                language=language,
                 change=self,
                 code=code,
                 comments=comments,
                 blanks=blanks,
                 connection=connection
             )
-        except: raise
         return loc
 
+    def insertDelta(self, language, code, comments, blanks, connection=None):
+        language = Language.idFromLanguage(language, connection)
+        delta = LocDelta.select(
+            AND(LocDelta.q.language == language,
+                LocDelta.q.change == self.id),
+            connection=connection
+        ).getOne(None)
+        if delta is None:
+            delta = LocDelta(
+                language=language,
+                change=self,
+                code=code,
+                comments=comments,
+                blanks=blanks,
+                connection=connection
+            )
+        return delta
+
+    def markOversized(self, size, connection=None):
+        """Record that the file was not counted because of its size."""
+        try:
+            return Oversized(change=self, size=size, connection=connection)
+        except DuplicateEntryError as inst:
+            return Oversized.select(Oversized.q.change == self.id,
+                                    connection=connection).getOne()
+        except: raise
+
+    def clearLocs(self, connection=None):
+        Loc.deleteMany(Loc.q.change == self.id, connection=connection)
+
     def getLoc(self, language=None):
         if language is None:
             query = Loc.select(
@@ -296,17 +825,9 @@ class Change(SQLObject):
         if blanks is None: blanks = 0
         return (code, comments, blanks)
 
-    def getLocDiff(self, revision, language=None):
-        code, comments, blanks = self.getLoc(language)
-        last_change = Change.select(
-            AND(Change.q.path == self.path,
-                Revision.q.commitdate < revision.commitdate),
-            join=[INNERJOINOn(Change, Revision, Change.q.revision == Revision.q.id)]
-        ).limit(1).getOne(None)
-        if last_change is None:
-            return (code, comments, blanks)
-        last_code, last_comments, last_blanks = last_change.getLoc(language)
-        return (code-last_code, comments-last_comments, blanks-last_blanks)
+    def getLocDiff(self, language=None):
+        """Return the (code, comments, blanks) this change added."""
+        return _sumDeltas(Change.q.id == self.id, language)
 
 class Loc(SQLObject):
     language = ForeignKey('Language', cascade=True)
@@ -317,13 +838,250 @@ class Loc(SQLObject):
     blanks = IntCol(notNone=True)
 
     @staticmethod
-    def byLanguageChange(language, change):
-        language = Language.byLanguage(language)
+    def byLanguageChange(language, change, connection=None):
+        language = Language.byLanguage(language, connection=connection)
         return Loc.select(
             AND(Loc.q.language == language,
-                Loc.q.change == change)
+                Loc.q.change == change),
+            connection=connection
         ).getOne()
 
+class LocCache(SQLObject):
+    """Lines of code already counted for some contents. The digest is taken
+    from the file name and the contents, since ohcount detects languages
+    by name too; locs is a list of (language, code, comments, blanks)."""
+    digest = StringCol(length=40, alternateID=True)
+    locs = PickleCol(notNone=True)
+
+    @staticmethod
+    def lookup(digests, connection=None):
+        """Return a dictionary with the cached locs of the given digests."""
+        digests = list(set(digests))
+        found = {}
+        for i in xrange(0, len(digests), 500):
+            for entry in LocCache.select(
+                    IN(LocCache.q.digest, digests[i:i+500]),
+                    connection=connection):
+                found[entry.digest] = entry.locs
+        return found
+
+    @staticmethod
+    def insert(digest, locs, connection=None):
+        try:
+            entry = LocCache.byDigest(digest, connection=connection)
+        except SQLObjectNotFound as nf:
+            try:
+                entry = LocCache(digest=digest, locs=locs,
+                    connection=connection)
+            except DuplicateEntryError as inst:
+                entry = LocCache.byDigest(digest, connection=connection)
+            except: raise
+        except: raise
+        return entry
+
+class BranchBoundary(SQLObject):
+    """Facts about the repository of a branch that do not change, saved to
+    spare their lookup on every sync."""
+    branch = ForeignKey('Branch', notNone=True, cascade=True)
+    branchIndex = DatabaseIndex(branch, unique=True)
+    rootUrl = StringCol(length=255, default=None)
+    firstRevDate = FloatCol(default=None)
+    startRev = IntCol(default=None)
+
+    # keys of the SCM backends and the columns keeping them
+    scmkeys = [ ('root_url', 'rootUrl'), ('first_rev_date', 'firstRevDate'),
+               ('start_rev', 'startRev') ]
+
+class PathFilter(SQLObject):
+    """Glob pattern choosing the paths of a branch to synchronize: included
+    paths, if any, are the only ones synchronized, and excluded paths are
+    never synchronized."""
+    branch = ForeignKey('Branch', notNone=True, cascade=True)
+    pattern = StringCol(length=255, notNone=True)
+    include = BoolCol(notNone=True, default=False)
+    branchPattern = DatabaseIndex(branch, pattern, unique=True)
+
+class SizeLimit(SQLObject):
+    """Size above which the files of a repository are not read at once:
+    they are counted in pieces if stream is set, skipped otherwise."""
+    repository = ForeignKey('Repository', notNone=True, cascade=True)
+    repositoryIndex = DatabaseIndex(repository, unique=True)
+    maxSize = BigIntCol(notNone=True)
+    stream = BoolCol(notNone=True, default=False)
+
+class Oversized(SQLObject):
+    """Marks changes whose file was skipped for being too large."""
+    change = ForeignKey('Change', notNone=True, cascade=True)
+    changeIndex = DatabaseIndex(change, unique=True)
+    size = BigIntCol(notNone=True)
+
+class Snapshot(SQLObject):
+    """Lines of code of every file of a branch at one revision, taken before
+    reading its history. The history is then read backwards, from that
+    revision down to startRev, the first one of the branch; nextRev is the
+    next revision to read."""
+    branch = ForeignKey('Branch', notNone=True, cascade=True)
+    branchIndex = DatabaseIndex(branch, unique=True)
+    revno = IntCol(notNone=True)
+    commitdate = TimestampCol(notNone=True)
+    startRev = IntCol(notNone=True)
+    nextRev = IntCol(notNone=True)
+    locs = MultipleJoin('SnapshotLoc')
+
+    @property
+    def complete(self):
+        return self.nextRev < self.startRev
+
+    def insertLocs(self, files, connection=None):
+        """Store the (filepath, locs) pairs of the snapshot with a few
+        multi-row INSERT statements."""
+        rows = []
+        counted = set()
+        for (filepath, locs) in files:
+            fp = FilePath.idFromFilePath(filepath, connection)
+            for (language, code, comments, blanks) in locs:
+                language = Language.idFromLanguage(language, connection)
+                if (fp, language) in counted:
+                    continue
+                counted.add((fp, language))
+                rows.append((self.id, fp, language, code, comments, blanks))
+        _insertMany(SnapshotLoc, ['snapshotID', 'pathID', 'languageID',
+                                  'code', 'comments', 'blanks'], rows,
+                    connection)
+
+    def markOversized(self, files, connection=None):
+        """Record the (filepath, size) pairs of the files of the snapshot
+        that were not counted because of their size."""
+        rows = [ (self.id, FilePath.idFromFilePath(filepath, connection),
+                  size) for (filepath, size) in files ]
+        _insertMany(SnapshotOversized, ['snapshotID', 'pathID', 'size'], rows,
+                    connection)
+
+    def getTotals(self, connection=None):
+        """Return the (code, comments, blanks) of the whole snapshot."""
+        query = SnapshotLoc.select(SnapshotLoc.q.snapshot == self.id,
+                                   connection=connection)
+        return tuple([ query.sum(column) or 0
+                       for column in (SnapshotLoc.q.code,
+                                      SnapshotLoc.q.comments,
+                                      SnapshotLoc.q.blanks) ])
+
+    def getLanguageTotals(self, connection=None):
+        """Return a dictionary mapping language ids to the (code, comments,
+        blanks) of the whole snapshot."""
+        conn = connection or self._connection
+        return dict([ (language, (int(code), int(comments), int(blanks)))
+            for (language, code, comments, blanks) in conn.queryAll(
+                conn.sqlrepr(Select(
+                    [SnapshotLoc.q.language, func.SUM(SnapshotLoc.q.code),
+                     func.SUM(SnapshotLoc.q.comments),
+                     func.SUM(SnapshotLoc.q.blanks)],
+                    where=SnapshotLoc.q.snapshot == self.id,
+                    groupBy=SnapshotLoc.q.language))) ])
+
+    def getState(self, revno, path='/', connection=None):
+        """Return a dictionary mapping the files at `path`, or below it, to
+        their list of (language, code, comments, blanks) tuples as of
+        revision `revno`: the snapshot, less what later changes added or
+        plus what changes since the snapshot added. Files without lines of
+        code are left out. Only valid for revisions already read."""
+        conn = connection or self._connection
+        files = [FilePath.q.path == Path.q.id,
+                 FilePath.q.file == File.q.id] + _belowpath(path)
+        state = {}
+        for (dir, name, language, code, comments, blanks) in conn.queryAll(
+                conn.sqlrepr(Select(
+                    [Path.q.path, File.q.name, Language.q.language,
+                     SnapshotLoc.q.code, SnapshotLoc.q.comments,
+                     SnapshotLoc.q.blanks],
+                    where=AND(SnapshotLoc.q.snapshot == self.id,
+                              SnapshotLoc.q.path == FilePath.q.id,
+                              SnapshotLoc.q.language == Language.q.id,
+                              *files)))):
+            state.setdefault(os.path.join(dir, name), []).append(
+                (language, code, comments, blanks))
+
+        if revno < self.revno:
+            (low, high, sign) = (revno, self.revno, -1)
+        else:
+            (low, high, sign) = (self.revno, revno, 1)
+        deltas = {}
+        for (dir, name, language, code, comments, blanks) in conn.queryAll(
+                conn.sqlrepr(Select(
+                    [Path.q.path, File.q.name, Language.q.language,
+                     LocDelta.q.code, LocDelta.q.comments,
+                     LocDelta.q.blanks],
+                    where=AND(Revision.q.branch == self.branchID,
+                              Revision.q.revno > low,
+                              Revision.q.revno <= high,
+                              Change.q.revision == Revision.q.id,
+                              LocDelta.q.change == Change.q.id,
+                              Change.q.path == FilePath.q.id,
+                              LocDelta.q.language == Language.q.id,
+                              *files)))):
+            deltas.setdefault(os.path.join(dir, name), []).append(
+                (language, code, comments, blanks))
+        for filepath, delta in deltas.iteritems():
+            locs = addlocs(state.get(filepath, []), delta, sign)
+            if len(locs) > 0:
+                state[filepath] = locs
+            else:
+                state.pop(filepath, None)
+        return state
+
+class SnapshotLoc(SQLObject):
+    snapshot = ForeignKey('Snapshot', notNone=True, cascade=True)
+    path = ForeignKey('FilePath', notNone=True, cascade=False)
+    language = ForeignKey('Language', notNone=True, cascade=True)
+    snapshotPathLanguage = DatabaseIndex(snapshot, path, language,
+                                         unique=True)
+    code = IntCol(notNone=True)
+    comments = IntCol(notNone=True)
+    blanks = IntCol(notNone=True)
+
+class SnapshotOversized(SQLObject):
+    """Marks files of a snapshot skipped for being too large."""
+    snapshot = ForeignKey('Snapshot', notNone=True, cascade=True)
+    path = ForeignKey('FilePath', notNone=True, cascade=False)
+    snapshotPath = DatabaseIndex(snapshot, path, unique=True)
+    size = BigIntCol(notNone=True)
+
+class LocDelta(SQLObject):
+    """Lines of code a change added to its file, negative when removed."""
+    language = ForeignKey('Language', cascade=True)
+    change = ForeignKey('Change', cascade=True)
+    languageChange = DatabaseIndex(language, change, unique=True)
+    code = IntCol(notNone=True)
+    comments = IntCol(notNone=True)
+    blanks = IntCol(notNone=True)
+
+    @staticmethod
+    def byLanguageChange(language, change, connection=None):
+        language = Language.byLanguage(language, connection=connection)
+        return LocDelta.select(
+            AND(LocDelta.q.language == language,
+                LocDelta.q.change == change),
+            connection=connection
+        ).getOne()
+
+class RevisionLoc(SQLObject):
+    """Lines of code a revision added and the totals of its branch after
+    it, for each language the revision changed and, with no language, for
+    all of them. Kept along with the revisions, for reports to read in a
+    single scan."""
+    revision = ForeignKey('Revision', cascade=True)
+    language = ForeignKey('Language', default=None, cascade=True)
+    revisionLanguage = DatabaseIndex(revision, language, unique=True)
+    code = IntCol(notNone=True)
+    comments = IntCol(notNone=True)
+    blanks = IntCol(notNone=True)
+    totalCode = IntCol(notNone=True)
+    totalComments = IntCol(notNone=True)
+    totalBlanks = IntCol(notNone=True)
+
+_revisionloccolumns = ['revisionID', 'languageID', 'code', 'comments',
+                       'blanks', 'totalCode', 'totalComments', 'totalBlanks']
+
 if __name__ == "__main__":
     import pydot
 
@@ -0,0 +1,90 @@
+# idcache.py - in-process caches of the ids of XRay dimension rows
+#
+# Copyright (C) 2010 Guilherme Versiani <guibv@comunip.com.br>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+import threading, weakref
+from collections import OrderedDict
+from sqlobject.dbconnection import Transaction
+
+_caches = []
+
+class IdCache(object):
+    """Bounded LRU mapping of keys (like author names) to the ids of the
+    rows holding them. Ids learnt inside a transaction are kept apart until
+    it commits, and forgotten if it rolls back, so that the cache never
+    gives out rows other connections cannot see."""
+
+    def __init__(self, size):
+        self.size     = size
+        self._entries = OrderedDict()
+        self._pending = weakref.WeakKeyDictionary()
+        self._lock    = threading.Lock()
+
+    def get(self, key, connection=None):
+        """Return the id of a key, or None when it is not cached."""
+        with self._lock:
+            if isinstance(connection, Transaction):
+                pending = self._pending.get(connection, {})
+                if key in pending:
+                    return pending[key]
+            id = self._entries.pop(key, None)
+            if id is not None:
+                self._entries[key] = id # the most recently used
+            return id
+
+    def put(self, key, id, connection=None):
+        with self._lock:
+            if isinstance(connection, Transaction):
+                self._pending.setdefault(connection, {})[key] = id
+            else:
+                self._add(key, id)
+
+    def _add(self, key, id):
+        self._entries.pop(key, None)
+        self._entries[key] = id
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def commit(self, trans):
+        with self._lock:
+            for key, id in self._pending.pop(trans, {}).iteritems():
+                self._add(key, id)
+
+    def rollback(self, trans):
+        with self._lock:
+            self._pending.pop(trans, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pending.clear()
+
+def cache(size):
+    """Create a cache kept in step with the transactions of storage."""
+    c = IdCache(size)
+    _caches.append(c)
+    return c
+
+def clear():
+    """Forget every cached id, as when tables are dropped."""
+    for c in _caches:
+        c.clear()
+
+class CachingTransaction(Transaction):
+    """Transaction telling the caches when the ids learnt through it become
+    visible to everyone, or are gone."""
+
+    def commit(self, close=False):
+        Transaction.commit(self, close=close)
+        for c in _caches:
+            c.commit(self)
+
+    def rollback(self):
+        Transaction.rollback(self)
+        for c in _caches:
+            c.rollback(self)
+
+# Modeline for vim: set tw=79 et ts=4:
@@ -0,0 +1,100 @@
+# migrate.py - in place upgrades of XRay databases
+#
+# Copyright (C) 2010 Guilherme Versiani <guibv@comunip.com.br>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+from entities import *
+import entities, idcache
+import xray4scm.error as error
+from xray4scm.i18n import _
+
+def _hasIndex(connection, cls, name):
+    """Tell whether an index of a table was created already, as by an
+    interrupted upgrade. Backends whose catalog is not known are assumed
+    not to have it."""
+    table = cls.sqlmeta.table
+    if connection.dbName == 'mysql':
+        return len(connection.queryAll("SHOW INDEX FROM %s WHERE "
+            "Key_name = %s" % (table, connection.sqlrepr(name)))) > 0
+    if connection.dbName == 'postgres':
+        query = "SELECT COUNT(*) FROM pg_indexes WHERE indexname = %s"
+    elif connection.dbName == 'sqlite':
+        query = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' " \
+                "AND name = %s"
+    else:
+        return False
+    # named after the table, as SQLObject does
+    return connection.queryOne(query % connection.sqlrepr(
+        '%s_%s' % (table, name)))[0] > 0
+
+def _createIndex(cls, name):
+    def migrate(connection):
+        for index in cls.sqlmeta.indexes:
+            if index.name == name and not _hasIndex(connection, cls, name):
+                connection.query(connection.createIndexSQL(cls, index))
+    return migrate
+
+def _createTables(connection):
+    pass # done before any migration runs
+
+def _rebuildReports(connection):
+    for branch in Branch.select(connection=connection):
+        trans = idcache.CachingTransaction(connection)
+        try:
+            branch.rebuildReports(connection=trans)
+        except:
+            trans.rollback()
+            raise
+        trans.commit(close=True)
+
+# Migrations, in order: the n-th one brings a database from version n to
+# version n+1. The new version is written after each one, so that an
+# interrupted upgrade resumes with the migration that failed. Tables added
+# since version 1 are created before any migration runs.
+_migrations = [
+    (_("index the revisions of each branch by date"),
+     _createIndex(Revision, 'branchCommitdate')),
+    (_("index the changes of each file by revision"),
+     _createIndex(Change, 'pathRevision')),
+    (_("compute the lines of code each change added and the totals after "
+       "each revision"),
+     _rebuildReports),
+    (_("keep track of the files of snapshots skipped for their size"),
+     _createTables),
+]
+
+version = len(_migrations) + 1
+
+def getVersion(connection=None):
+    """Return the version of the database, or None if it has none."""
+    try:
+        m = Metadata.select(connection=connection).getOne(None)
+    except:
+        return None
+    if m is None:
+        return None
+    return int(m.version)
+
+def upgrade(connection, notify=None):
+    """Bring a database to the current version, calling notify(version,
+    description) before each migration. Returns how many were run."""
+    current = getVersion(connection)
+    if current is None:
+        raise error.Abort(_("There is no XRay database to upgrade"))
+    if current > version:
+        raise error.Abort(_("The database is from a newer version of XRay "
+            "(%d, expected %d)") % (current, version))
+    for name in entities.__all__:
+        getattr(entities, name).createTable(ifNotExists=True,
+                                            connection=connection)
+    for n in xrange(current, version):
+        (description, migrate) = _migrations[n-1]
+        if notify is not None:
+            notify(n+1, description)
+        migrate(connection)
+        Metadata.select(connection=connection).getOne().version = str(n+1)
+    return version - current
+
+# Modeline for vim: set tw=79 et ts=4:
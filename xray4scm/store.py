@@ -0,0 +1,127 @@
+# store.py - local store of the file contents read from repositories.
+#
+# Copyright (C) 2010 Guilherme Versiani <guibv@comunip.com.br>
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2, incorporated herein by reference.
+
+import os, errno, tempfile, threading, hashlib, zlib
+
+class ContentStore(object):
+    """Contents kept on disk, compressed and addressed by their sha1 digest
+    under 'objects/', along with an index per branch under 'index/' telling
+    which contents a path had at some revision."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _objpath(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest[2:])
+
+    def _makedirs(self, path):
+        try:
+            os.makedirs(path)
+        except OSError as inst:
+            if inst.errno != errno.EEXIST:
+                raise
+
+    def put(self, contents):
+        """Store some contents and return their digest."""
+        digest = hashlib.sha1(contents).hexdigest()
+        path = self._objpath(digest)
+        if not os.path.exists(path):
+            self._makedirs(os.path.dirname(path))
+            (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                os.write(fd, zlib.compress(contents))
+            finally:
+                os.close(fd)
+            # readers never see a partial object
+            os.rename(tmp, path)
+        return digest
+
+    def get(self, digest):
+        """Return the contents with some digest, or None if not stored."""
+        try:
+            f = open(self._objpath(digest), 'rb')
+        except IOError as inst:
+            if inst.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            return zlib.decompress(f.read())
+        finally:
+            f.close()
+
+    def index(self, repourl, branch):
+        key = hashlib.sha1(repourl + '\0' + branch).hexdigest()
+        self._makedirs(os.path.join(self.root, 'index'))
+        return ContentIndex(self, os.path.join(self.root, 'index', key),
+                            '%s %s' % (repourl, branch))
+
+def encodepath(path):
+    """Paths are kept as utf-8 strings."""
+    if isinstance(path, unicode):
+        return path.encode('utf-8')
+    return path
+
+class ContentIndex(object):
+    """The contents of the files of one branch, by (revno, path). Entries
+    are appended to a text file, one 'revno digest path' line each."""
+
+    def __init__(self, store, filename, title):
+        self.store    = store
+        self.filename = filename
+        self.title    = title
+        self._entries = None
+        self._lock    = threading.Lock()
+
+    def entries(self):
+        """Return a dictionary with the digest of each (revno, path)."""
+        with self._lock:
+            if self._entries is None:
+                self._entries = {}
+                if os.path.exists(self.filename):
+                    f = open(self.filename, 'rb')
+                    try:
+                        for line in f:
+                            if line.startswith('#'):
+                                continue
+                            (revno, digest, path) = \
+                                line.rstrip('\n').split(' ', 2)
+                            self._entries[(int(revno), path)] = digest
+                    finally:
+                        f.close()
+            return self._entries
+
+    def digest(self, revno, path):
+        """Return the digest of the contents of a path at some revision, or
+        None if they were not stored."""
+        return self.entries().get((revno, encodepath(path)))
+
+    def get(self, revno, path):
+        """Return the stored contents of a path at some revision, or
+        None."""
+        digest = self.digest(revno, path)
+        if digest is None:
+            return None
+        return self.store.get(digest)
+
+    def put(self, revno, path, contents):
+        path = encodepath(path)
+        digest = self.store.put(contents)
+        entries = self.entries()
+        with self._lock:
+            if entries.get((revno, path)) == digest:
+                return
+            entries[(revno, path)] = digest
+            exists = os.path.exists(self.filename)
+            f = open(self.filename, 'ab')
+            try:
+                if not exists:
+                    f.write('# %s\n' % self.title)
+                f.write('%d %s %s\n' % (revno, digest, path))
+            finally:
+                f.close()
+
+# Modeline for vim: set tw=79 et ts=4:
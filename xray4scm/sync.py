@@ -5,9 +5,26 @@
 # This software may be used and distributed according to the terms of the
 # GNU General Public License version 2, incorporated herein by reference.
 
-import scm, error, storage
+import scm, error, storage, pipeline, store, match
+import ui as _ui
 from i18n import _
-import os
+from util import addlocs
+import os, sys, signal, traceback, threading, multiprocessing, Queue
+from multiprocessing.pool import ThreadPool
+import hashlib
+
+# files counted in pieces are read this many bytes at a time
+_streamchunk = 4*1024*1024
+
+# files of a snapshot read and counted at once
+_snapshotchunk = 500
+
+# revisions read backwards from a snapshot are stored (and the backfill
+# can resume) every this many revisions
+_backfillchunk = 100
+
+# leading bytes looked at to tell binary files, when the backend cannot
+_binarysniff = 8000
 
 try:
     import ohcount
@@ -17,63 +34,475 @@ except ImportError:
           "extension is located at http://github.com/balena/ohcount."
     raise
 
+def countlocs(filename, contents):
+    """Count the lines of code of a file, returning a list of
+    (language, code, comments, blanks) tuples."""
+    sf = ohcount.SourceFile(filename=filename, contents=contents)
+    return [ (loc.language, loc.code, loc.comments, loc.blanks)
+             for loc in sf.locs ]
+
+def countchunks(filename, chunks):
+    """Count the lines of code of a file read in pieces, adding up the
+    counts of each piece. Pieces are cut at line ends, but constructs
+    spanning several lines (like long comments) may still be split."""
+    totals = {}
+    languages = []
+
+    def count(data):
+        for (language, code, comments, blanks) in countlocs(filename, data):
+            if language not in totals:
+                totals[language] = [0, 0, 0]
+                languages.append(language)
+            counts = totals[language]
+            counts[0] += code
+            counts[1] += comments
+            counts[2] += blanks
+
+    pending = ''
+    for chunk in chunks:
+        data = pending + chunk
+        end = data.rfind('\n') + 1
+        pending = data[end:]
+        if end > 0:
+            count(data[:end])
+    if len(pending) > 0:
+        count(pending)
+    return [ (language,) + tuple(totals[language])
+             for language in languages ]
+
+def locdigest(name, contents):
+    """Key of the lines of code of a file in the LOC cache."""
+    return hashlib.sha1(name + '\0' + contents).hexdigest()
+
+def _countlocs(args):
+    return countlocs(*args)
+
+def _initworker():
+    # let the parent process handle keyboard interrupts
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
 class Sync(object):
 
-    def __init__(self, repo, ui, verbose):
-        self.repo    = repo
-        self.ui      = ui
-        self.verbose = verbose
+    def __init__(self, repo, ui, verbose, jobs=1, depth=0, branchjobs=1,
+                 commitevery=1, fetchjobs=1, lookahead=0,
+                 prefetchsize=64*1024*1024, contentstore=None,
+                 headfirst=False, backfill=0):
+        self.repo        = repo
+        self.ui          = ui
+        self.verbose     = verbose
+        self.jobs        = jobs
+        self.depth       = depth
+        self.branchjobs  = branchjobs
+        self.commitevery = commitevery
+        self.fetchjobs   = fetchjobs
+        self.lookahead   = lookahead
+        self.prefetchsize = prefetchsize
+        self.contentstore = contentstore
+        self.headfirst   = headfirst
+        self.backfill    = backfill
+        self.sizelimit   = None
+        self.pool        = None
+        self.fetchpool   = None
+        self.cachehits   = 0
+        self.cachemisses = 0
+        self.lock        = threading.Lock()
 
     def process(self):
         self.ui.writenl(_("Synchronizing repo %s...") % self.repo.url)
-        for branch in self.repo.branches:
-            try:
-                SyncBranch(self, branch).process()
-            except error.Abort as inst:
-                self.ui.warn('abort: %s\n' % inst)
-                continue
-            except: raise
+        self.sizelimit = self.repo.getSizeLimit()
+        if self.jobs > 1:
+            self.pool = multiprocessing.Pool(self.jobs, _initworker)
+        if self.fetchjobs > 1:
+            self.fetchpool = ThreadPool(self.fetchjobs)
+        try:
+            branches = list(self.repo.branches)
+            if self.branchjobs > 1 and len(branches) > 1:
+                self.processparallel(branches)
+            else:
+                for branch in branches:
+                    self.processbranch(branch, self.ui)
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+            if self.fetchpool is not None:
+                self.fetchpool.close()
+                self.fetchpool.join()
+                self.fetchpool = None
         self.repo.markAsUpdated()
+        if self.cachehits + self.cachemisses > 0 and self.verbose >= 0:
+            self.ui.writenl(_("LOC cache: %d hits, %d misses") %
+                (self.cachehits, self.cachemisses))
+
+    def processbranch(self, branch, ui):
+        syncbranch = SyncBranch(self, branch, ui)
+        try:
+            syncbranch.process()
+        except error.Abort as inst:
+            ui.warn('abort: %s\n' % inst)
+        finally:
+            syncbranch.scminst.close()
+            with self.lock:
+                self.cachehits += syncbranch.cachehits
+                self.cachemisses += syncbranch.cachemisses
+
+    def processparallel(self, branches):
+        """Synchronize up to `branchjobs` branches at the same time, each
+        one in its own thread and with its own SCM client. The output of a
+        branch is written at once when it is finished. A failing branch
+        does not stop the others; the first unexpected error is raised
+        again after all of them are done."""
+        pending = Queue.Queue()
+        for branch in branches:
+            pending.put(branch)
+        lock = threading.Lock()
+        failures = []
+
+        def worker():
+            while True:
+                try:
+                    branch = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                u = self.ui.copy()
+                u.pushbuffer()
+                try:
+                    self.processbranch(branch, u)
+                except:
+                    u.warn(_("abort: unexpected error while synchronizing "
+                             "branch %s\n") % branch.name)
+                    failures.append(sys.exc_info())
+                finally:
+                    output = u.popbuffer()
+                    with lock:
+                        self.ui.write(output)
+                        self.ui.flush()
+
+        threads = []
+        for i in xrange(min(self.branchjobs, len(branches))):
+            t = threading.Thread(target=worker, name='xray-branch-%d' % i)
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            # join with a timeout, so that keyboard interrupts get through
+            while t.isAlive():
+                t.join(0.5)
+        if len(failures) > 0:
+            raise failures[0][0], failures[0][1], failures[0][2]
 
 class SyncBranch(object):
 
-    def __init__(self, parent, branch):
+    def __init__(self, parent, branch, ui=None):
         self.parent  = parent
-        self.ui      = parent.ui
+        self.ui      = ui or parent.ui
         self.verbose = parent.verbose
+        self.pool    = parent.pool
+        self.fetchpool = parent.fetchpool
+        self.sizelimit = parent.sizelimit
+        self.lookahead = parent.lookahead
+        self.prefetchsize = parent.prefetchsize
+        self.depth   = parent.depth
         self.branch  = branch
+        self.batch   = SyncBatch(self, parent.commitevery)
+        self.cachehits   = 0
+        self.cachemisses = 0
         self.scminst = scm.createInstance(parent.repo.url)
         self.scminst.setbranch(branch.name)
+        (includes, excludes) = branch.getFilters()
+        self.accept = match.match(includes, excludes)
+        self.scminst.setfilter(self.accept)
+        self.contents = None
+        if parent.contentstore is not None:
+            self.contents = parent.contentstore.index(parent.repo.url,
+                                                      branch.name)
+        self.snapshot = None
+
+    def saveboundaries(self):
+        """Keep what the SCM client found out about the branch boundaries,
+        so that later syncs need fewer requests to find its revisions."""
+        boundaries = self.scminst.getboundaries()
+        if boundaries != self.boundaries:
+            self.branch.setBoundaries(boundaries)
+            self.boundaries = boundaries
 
     def getrevrange(self):
+        self.boundaries = self.branch.getBoundaries()
+        self.scminst.setboundaries(self.boundaries)
         (startrev, endrev) = self.scminst.getrevrange()
+        self.saveboundaries()
+        self.firstrev = startrev
         if startrev != 0 and endrev != 0:
             dbstartrev = self.branch.getLastRev()
             if dbstartrev is not None:
                 startrev = dbstartrev+1
         return (startrev, endrev)
 
+    def revisions(self, startrev, endrev):
+        """Yield the revisions to synchronize, with their files fetched.
+        With a lookahead, revisions are fetched in a thread of their own
+        while earlier ones are counted and stored."""
+
+        def fetch():
+            for scmrev in self.scminst.iterrevs(startrev, endrev):
+                syncrev = SyncRevision(self, scmrev)
+                syncrev.fetch(self.fetchpool)
+                yield syncrev
+
+        if self.lookahead <= 0:
+            for syncrev in fetch():
+                yield syncrev
+            return
+        prefetcher = pipeline.Prefetcher(fetch(), self.lookahead,
+            self.prefetchsize, SyncRevision.size)
+        try:
+            for syncrev in prefetcher:
+                yield syncrev
+        finally:
+            if self.verbose >= 0:
+                self.ui.writenl("  " + _("prefetch: waited for %d of %d "
+                    "revisions") % (prefetcher.stalls,
+                    prefetcher.consumed))
+
+    def readfiles(self, files):
+        """Read the contents of SyncFile objects, on the fetch threads if
+        any, and count their lines of code, in the worker pool if any."""
+        if self.fetchpool is not None and len(files) > 1:
+            self.fetchpool.map(SyncFile.fetch, files)
+        else:
+            for f in files:
+                f.fetch()
+        pending = self.lookuplocs(files)
+        args = [ (f.path, f.contents) for f in pending ]
+        if self.pool is not None and len(args) > 1:
+            results = self.pool.map(_countlocs, args)
+        else:
+            results = map(_countlocs, args)
+        for f, locs in zip(pending, results):
+            f.locs = locs
+            f.contents = None
+
+    def lookuplocs(self, items):
+        """Take from the LOC cache the lines of code of the fetched items
+        (SyncChange or SyncFile objects) whose contents were counted before,
+        returning the items left to count."""
+        fetched = [ i for i in items if i.contents is not None ]
+        for i in fetched:
+            i.digest = locdigest(i.name, i.contents)
+        cached = storage.LocCache.lookup([ i.digest for i in fetched ])
+        pending = []
+        for i in fetched:
+            if i.digest in cached:
+                i.locs = cached[i.digest]
+                i.cached = True
+                i.contents = None
+            else:
+                pending.append(i)
+        self.cachehits += len(fetched) - len(pending)
+        self.cachemisses += len(pending)
+        return pending
+
+    def cachelocs(self, item, trans):
+        """Add the lines of code counted for an item to the LOC cache."""
+        if item.digest is not None and not item.cached:
+            storage.LocCache.insert(item.digest, item.locs, connection=trans)
+
+    def filelocs(self, path, revno, trans):
+        """Return the lines of code of the files at `path`, or below it, as
+        of some revision already stored."""
+        if self.snapshot is not None:
+            return self.snapshot.getState(revno, path, connection=trans)
+        return self.branch.getFileLocs(path, revno, connection=trans)
+
     def process(self):
         self.ui.writenl("  " + _("Branch %s:") % self.branch.name)
         (startrev, endrev) = self.getrevrange()
         if startrev == 0 and endrev == 0:
             raise error.Abort(_("There is no revision available to sync yet."))
-        if startrev > endrev:
-            raise error.Abort(_("Up-to-date."))
-        for scmrev in self.scminst.iterrevs(startrev, endrev):
-            SyncRevision(self, scmrev).process()
-        if scmrev is None:
+        self.snapshot = self.branch.getSnapshot()
+        count = 0
+        if self.snapshot is None and self.parent.headfirst and \
+                self.branch.getLastRev() is None:
+            self.snapshot = SyncSnapshot(self, endrev).process()
+            count += 1
+        if self.snapshot is not None:
+            # revisions up to the snapshot are read backwards, later
+            startrev = max(startrev, self.snapshot.revno+1)
+        if startrev <= endrev:
+            count += self.forward(startrev, endrev)
+        if self.snapshot is not None and not self.snapshot.complete:
+            count += SyncBackfill(self, self.parent.backfill).process()
+        if self.snapshot is not None and not self.snapshot.complete and \
+                self.verbose >= 0:
+            self.ui.writenl("  " + _("history of revisions %d-%d still "
+                "pending") % (self.snapshot.startRev, self.snapshot.nextRev))
+        if count == 0:
             raise error.Abort(_("Up-to-date."))
 
+    def forward(self, startrev, endrev):
+        """Synchronize the revisions from `startrev` to `endrev`, returning
+        how many were stored."""
+        try:
+            if self.depth > 0:
+                count = self.pipeline(startrev, endrev)
+            else:
+                count = 0
+                for syncrev in self.revisions(startrev, endrev):
+                    syncrev.analyze(self.pool)
+                    self.batch.add(syncrev)
+                    count += 1
+        except:
+            # revisions already stored are complete, keep them
+            exc_info = sys.exc_info()
+            self.batch.flush()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.batch.flush()
+        self.saveboundaries()
+        return count
+
+    def pipeline(self, startrev, endrev):
+        """Synchronize revisions through a fetch -> analyze -> store
+        pipeline, so that SCM access, line counting and database writes
+        overlap. Revisions are still stored one at a time and in order."""
+
+        def fetch():
+            return self.revisions(startrev, endrev)
+
+        def analyze(syncrev):
+            # counting is waited for here, not when storing, so that a
+            # slow count shows as stalls of this stage
+            syncrev.analyze(self.pool)
+            syncrev.wait()
+            return syncrev
+
+        def store(syncrev):
+            self.batch.add(syncrev)
+
+        p = pipeline.Pipeline(self.depth)
+        p.add('fetch', fetch)
+        p.add('analyze', analyze)
+        p.add('store', store)
+        try:
+            p.run()
+        finally:
+            if self.verbose >= 0:
+                for (name, items, inputstalls, inwait,
+                        outputstalls, outwait) in p.stats():
+                    self.ui.writenl("  " + _("%-8s %d revisions, stalled "
+                        "%d times on input (%.1fs) and %d times on "
+                        "output (%.1fs)") % (name+':', items, inputstalls,
+                        inwait, outputstalls, outwait))
+        return p.stages[-1].items
+
+class SyncBatch(object):
+    """Stores revisions of a branch sharing one transaction for every
+    `size` revisions. If storing or committing fails, the transaction is
+    rolled back and the revisions of the batch are stored again one
+    transaction each, so that every revision before the failing one is
+    kept and a later sync resumes right after them."""
+
+    def __init__(self, parent, size=1):
+        self.parent  = parent
+        self.ui      = parent.ui
+        self.size    = size
+        self.trans   = None
+        self.pending = []
+
+    def add(self, syncrev):
+        if self.trans is None:
+            self.trans = storage.transaction()
+        self.pending.append(syncrev)
+        try:
+            syncrev.store(self.trans)
+        except:
+            self.isolate(sys.exc_info())
+            return
+        if len(self.pending) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.trans is None:
+            return
+        try:
+            self.trans.commit(close=True)
+        except:
+            self.isolate(sys.exc_info())
+            return
+        self.trans = None
+        self.pending = []
+
+    def isolate(self, exc_info):
+        pending, self.pending = self.pending, []
+        try:
+            self.trans.rollback()
+        finally:
+            self.trans = None
+        if len(pending) == 1:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.ui.warn(_("error while storing revisions %d-%d, "
+                       "storing them one at a time: %s\n") %
+                     (pending[0].scmrev.id, pending[-1].scmrev.id,
+                      exc_info[1]))
+        for syncrev in pending:
+            syncrev.store()
+
 class SyncRevision(object):
+    """Synchronizes one revision in three steps: fetch() downloads the
+    contents of the changed files, analyze() counts their lines of code
+    (in the worker pool, if any) and store() writes everything to the
+    database inside a single transaction."""
 
     def __init__(self, parent, scmrev):
         self.parent      = parent
         self.ui          = parent.ui
         self.verbose     = parent.verbose
         self.scmrev      = scmrev
+        self.changes     = [ SyncChange(self, change)
+                             for change in scmrev.iterchanges() ]
+        self.paths       = set([ str(c.change.path) for c in self.changes ])
+
+    def fetch(self, fetchpool=None):
+        """Find out what each change needs and download the contents of the
+        changed files, several at once if a pool of threads is given."""
+        for change in self.changes:
+            change.fetch()
+        wanted = [ c for c in self.changes if c.wanted ]
+        if fetchpool is not None and len(wanted) > 1:
+            fetchpool.map(SyncChange.cat, wanted)
+        else:
+            for change in wanted:
+                change.cat()
+
+    def size(self):
+        """Return the number of bytes of contents held by the revision."""
+        return sum([ len(c.contents) for c in self.changes
+                     if c.contents is not None ])
+
+    def analyze(self, pool=None):
+        self.pending = self.parent.lookuplocs(self.changes)
+        args = [ (str(c.change.path), c.contents) for c in self.pending ]
+        if pool is not None and len(args) > 1:
+            # collected later by wait(), the pool keeps counting meanwhile
+            self.counting = pool.map_async(_countlocs, args)
+        else:
+            self.counting = map(_countlocs, args)
+        for change in self.pending:
+            change.contents = None
+
+    def wait(self):
+        results = self.counting
+        if not isinstance(results, list):
+            results = results.get()
+            self.counting = results
+        for change, locs in zip(self.pending, results):
+            change.locs = locs
+
+    def store(self, trans=None):
+        """Write the revision to the database. Unless a transaction is
+        given, the revision is committed in a transaction of its own."""
+        self.wait()
 
-    def process(self):
         if self.verbose == 1:
             self.ui.writenl('--- Revision %d ---' % self.scmrev.id)
             self.ui.flush()
@@ -81,23 +510,33 @@ class SyncRevision(object):
             self.ui.write("  %d " % self.scmrev.id)
             self.ui.flush()
 
-        self.trans = storage.transaction()
-        self.storrev = self.parent.branch.insertRevision(
-            self.scmrev.id,
-            self.scmrev.author,
-            self.scmrev.message,
-            self.scmrev.date,
-            connection=self.trans
-        )
-
+        self.trans = trans or storage.transaction()
         try:
-            for change in self.scmrev.iterchanges():
-                SyncChange(self, change).process()
+            self.storrev = self.parent.branch.insertRevision(
+                self.scmrev.id,
+                self.scmrev.author,
+                self.scmrev.message,
+                self.scmrev.date,
+                connection=self.trans
+            )
+            rows = []
+            for change in self.changes:
+                rows.extend(change.store())
+            ids = self.storrev.insertChanges(rows, connection=self.trans)
+            self.storrev.insertTotals(connection=self.trans)
+            for change in self.changes:
+                for (filepath, size) in change.oversizedfiles():
+                    if filepath in ids:
+                        storage.Change.get(ids[filepath],
+                            connection=self.trans).markOversized(
+                                size, connection=self.trans)
         except:
-            self.trans.rollback()
+            if trans is None:
+                self.trans.rollback()
             raise
 
-        self.trans.commit(close=True)
+        if trans is None:
+            self.trans.commit(close=True)
 
         if self.verbose != 1:
             self.ui.writenl('done')
@@ -106,50 +545,574 @@ class SyncRevision(object):
 class SyncChange(object):
 
     def __init__(self, parent, change):
-        self.parent  = parent
-        self.ui      = parent.ui
-        self.verbose = parent.verbose
-        self.change  = change
+        self.parent   = parent
+        self.ui       = parent.ui
+        self.verbose  = parent.verbose
+        self.change   = change
+        self.contents = None
+        self.digest   = None
+        self.cached   = False
+        self.locs     = []
+        self.copied   = {}
+        self.propsonly = False
+        self.wanted   = False
+        self.streamed = False
+        self.oversized = None
+        self.copyfiles = []
 
-    def process(self):
+    @property
+    def name(self):
+        return self.change.path.name
+
+    def fetch(self):
+        path = self.change.path
+
+        if self.change.changetype == 'D' or self.change.changetype == 'R':
+            return
+        if path.isdir():
+            if self.change.iscopy() and not self.copyorigin():
+                self.readcopies()
+            return
+        if self.change.changetype == 'M' and \
+                self.change.textmodified() is False:
+            # only properties changed, locs are taken from storage later
+            self.propsonly = True
+            return
+        if self.change.iscopy() and self.change.textmodified() is False:
+            if self.copyorigin() and str(path) in self.copied:
+                self.locs = self.copied.pop(str(path))
+                return
+        # before telling binary files, which reads some of them
+        limit = self.parent.parent.sizelimit
+        if limit is not None:
+            (maxsize, stream) = limit
+            size = path.size()
+            if size is not None and size > maxsize:
+                if not stream:
+                    self.oversized = size
+                    return
+                self.streamed = True
+        if path.isbinary():
+            self.streamed = False
+            return
+
+        self.wanted = True
+
+    def cat(self):
+        """Read the contents of the file, from the content store when it
+        has them, from the repository otherwise (storing them then)."""
+        syncbranch = self.parent.parent
+        revno = self.parent.scmrev.id
+        path = str(self.change.path)
+        if self.streamed:
+            # too large to be held at once, nor to be stored
+            self.locs = countchunks(path,
+                syncbranch.scminst.catchunks(revno, path, _streamchunk))
+            return
+        if syncbranch.contents is not None:
+            self.contents = syncbranch.contents.get(revno, path)
+            if self.contents is not None:
+                return
+        self.contents = syncbranch.scminst.cat(revno, path)
+        if syncbranch.contents is not None:
+            syncbranch.contents.put(revno, path, self.contents)
+
+    def copyorigin(self):
+        """Read from storage the lines of code of the copy origin, mapped to
+        their paths in this branch. Returns False if the origin is not in a
+        monitored branch or was not synchronized that far yet."""
+        (origin, revno) = self.change.getorigin()
+        repo = self.parent.parent.parent.repo
+        (branch, relpath) = repo.findBranch(origin.fullpath)
+        if branch is None:
+            return False
+        snapshot = branch.getSnapshot()
+        if snapshot is not None:
+            # only what was read of its history is known
+            if revno < snapshot.nextRev or \
+                    revno > max(branch.getLastRev(0), snapshot.revno):
+                return False
+            found = snapshot.getState(revno, relpath)
+        elif branch.getLastRev(0) < revno:
+            return False
+        else:
+            found = branch.getFileLocs(relpath, revno)
+        prefix = relpath.rstrip('/')
+        target = str(self.change.path).rstrip('/')
+        for filepath, locs in found.iteritems():
+            self.copied[target + filepath[len(prefix):] or '/'] = locs
+        return True
+
+    def readcopies(self):
+        """Read from the repository the files below a copied directory
+        whose origin is not stored (not in a monitored branch, or not
+        synchronized that far yet), counting them as added files."""
+        syncbranch = self.parent.parent
+        revno = self.parent.scmrev.id
+        path = str(self.change.path)
+        try:
+            entries = syncbranch.scminst.listfiles(revno, path)
+        except NotImplementedError:
+            self.ui.warn(_("files copied to %s in revision %d not "
+                           "counted, their origin is not stored\n") %
+                         (path, revno))
+            return
+        self.copyfiles = [ SyncFile(syncbranch, revno, f, size, binary)
+                           for (f, size, binary) in entries
+                           if f not in self.parent.paths ]
+        syncbranch.readfiles(self.copyfiles)
+
+    def copies(self):
+        """Return the rows of the files below a copied directory, unless
+        this revision lists them on its own (edited or deleted along with
+        the copy)."""
+        rows = []
+        accept = self.parent.parent.accept
+        for filepath in sorted(self.copied.keys()):
+            if filepath in self.parent.paths:
+                continue
+            if accept is not None and not accept(filepath):
+                continue
+            rows.append(('A', filepath, self.copied[filepath], []))
+        if self.verbose == 1 and len(self.copied) > 0:
+            self.ui.writenl('    (copied %d entries from %s@%d)' %
+                ((len(self.copied),) + self.change.getorigin()))
+            self.ui.flush()
+        return rows
+
+    def store(self):
+        """Return the (changetype, filepath, locs, deltas) rows of the
+        change, and those of the files copied or deleted along with it, to
+        be written with the other changes of the revision."""
         path = self.change.path
 
         if self.verbose == 1:
             self.ui.writenl('  %s %s' % (self.change.changetype, path))
             self.ui.flush()
 
-        details = self.parent.storrev.insertChange(
-            self.change.changetype, str(path), connection=self.parent.trans)
+        if self.oversized is not None and self.verbose == 1:
+            self.ui.writenl('    (skipped, %d bytes)' % self.oversized)
+            self.ui.flush()
+
+        if self.propsonly:
+            # earlier revisions are visible here, even in the same batch
+            self.locs = self.parent.parent.filelocs(str(path),
+                self.parent.scmrev.id-1, self.parent.trans
+            ).get(str(path), [])
 
-        if self.change.changetype == 'D' or self.change.changetype == 'R':
+        self.parent.parent.cachelocs(self, self.parent.trans)
+        for f in self.copyfiles:
+            f.store(self.parent.trans)
+            self.copied[f.path] = f.locs
+
+        if self.verbose == 1:
+            for (language, code, comments, blanks) in self.locs:
+                self.ui.writenl('    (lang=%s,code=%d,comments=%d,blanks=%d)'%\
+                    (language, code, comments, blanks))
+                self.ui.flush()
+
+        rows = [ (self.change.changetype, str(path), self.locs, []) ]
+        rows.extend(self.copies())
+        if not self.propsonly:
+            rows = self.deltas(rows)
+
+        if self.verbose != 1:
+            self.ui.write('.')
+            self.ui.flush()
+        return rows
+
+    def oversizedfiles(self):
+        """Return the (filepath, size) pairs of the files skipped for their
+        size: the file of the change and those copied along with it."""
+        files = [ (f.path, f.oversized) for f in self.copyfiles
+                  if f.oversized is not None ]
+        if self.oversized is not None:
+            files.append((str(self.change.path), self.oversized))
+        return files
+
+    def deltas(self, rows):
+        """Add to the rows of the change the lines of code it added to each
+        of its files, which reports add up. The files below a deleted
+        directory get rows of their own."""
+        syncrev = self.parent
+        path = str(self.change.path)
+        before = {}
+        if self.change.changetype != 'A':
+            # nothing was there before an addition
+            before = syncrev.parent.filelocs(path, syncrev.scmrev.id-1,
+                                             syncrev.trans)
+        after = dict(self.copied)
+        if self.change.changetype != 'D':
+            after[path] = self.locs
+        byfile = dict([ (row[1], row) for row in rows ])
+        accept = syncrev.parent.accept
+        for filepath in sorted(set(before.keys()) | set(after.keys())):
+            if filepath != path and filepath in syncrev.paths:
+                continue # stored by a change of its own
+            if accept is not None and not accept(filepath):
+                continue
+            delta = addlocs(after.get(filepath, []),
+                            before.get(filepath, []), -1)
+            if len(delta) == 0:
+                continue
+            if filepath in byfile:
+                (changetype, filepath, locs, deltas) = byfile[filepath]
+                byfile[filepath] = (changetype, filepath, locs, delta)
+            else:
+                byfile[filepath] = ('D', filepath, [], delta)
+                rows.append(byfile[filepath])
+        return [ byfile[row[1]] for row in rows ]
+
+class SyncFile(object):
+    """A file read on its own rather than as a change of a revision: the
+    files of a snapshot, those below a directory copied from somewhere not
+    stored and the earlier versions of the files changed by revisions read
+    backwards."""
+
+    def __init__(self, parent, revno, path, size=None, binary=None):
+        self.parent    = parent
+        self.revno     = revno
+        self.path      = path
+        self.size      = size
+        self.binary    = binary
+        self.contents  = None
+        self.digest    = None
+        self.cached    = False
+        self.locs      = []
+        self.oversized = None
+
+    def fetch(self):
+        if self.binary:
             return
-        if path.isdir():
+        scminst = self.parent.scminst
+        limit = self.parent.sizelimit
+        if limit is not None and self.size is not None and \
+                self.size > limit[0]:
+            (maxsize, stream) = limit
+            if stream:
+                self.locs = countchunks(self.path,
+                    scminst.catchunks(self.revno, self.path, _streamchunk))
+            else:
+                # recorded by whoever stores the file
+                self.oversized = self.size
             return
-        if path.isbinary():
+        contents = scminst.cat(self.revno, self.path)
+        if self.binary is None and '\0' in contents[:_binarysniff]:
             return
+        self.contents = contents
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    def store(self, trans):
+        self.parent.cachelocs(self, trans)
+
+class SyncSnapshot(object):
+    """Counts the lines of code of every file of a branch at some revision
+    before reading any of its history, so that reports have current numbers
+    early. The files are listed with a few requests, read on the fetch
+    threads and stored in a single transaction."""
+
+    def __init__(self, parent, revno):
+        self.parent  = parent
+        self.ui      = parent.ui
+        self.verbose = parent.verbose
+        self.revno   = revno
+
+    def process(self):
+        syncbranch = self.parent
+        self.ui.write("  " + _("snapshot of revision %d ") % self.revno)
+        self.ui.flush()
+        try:
+            entries = syncbranch.scminst.listfiles(self.revno)
+        except NotImplementedError:
+            raise error.Abort(_("This repository cannot be synchronized "
+                                "head-first."))
+        files = [ SyncFile(syncbranch, self.revno, path, size, binary)
+                  for (path, size, binary) in entries ]
+        for i in xrange(0, len(files), _snapshotchunk):
+            syncbranch.readfiles(files[i:i+_snapshotchunk])
+            if self.verbose >= 0:
+                self.ui.write('.')
+                self.ui.flush()
+        date = None
+        for scmrev in syncbranch.scminst.iterrevs(self.revno, self.revno):
+            date = scmrev.date
+        if date is None:
+            raise error.Abort(_("Revision %d not found.") % self.revno)
 
-        contents = self.parent.parent.scminst.cat(
-            self.parent.scmrev.id, str(path))
-
-        sf = ohcount.SourceFile(filename=str(path), contents=contents)
-        for loc in sf.locs:
-            details.insertLoc(
-                language=loc.language,
-                code=loc.code,
-                comments=loc.comments,
-                blanks=loc.blanks,
-                connection=self.parent.trans
+        trans = storage.transaction()
+        try:
+            snapshot = storage.Snapshot(
+                branch=syncbranch.branch,
+                revno=self.revno,
+                commitdate=date,
+                startRev=syncbranch.firstrev,
+                nextRev=self.revno,
+                connection=trans
             )
+            for f in files:
+                f.store(trans)
+            snapshot.insertLocs([ (f.path, f.locs) for f in files
+                                  if len(f.locs) > 0 ], connection=trans)
+            oversized = [ (f.path, f.oversized) for f in files
+                          if f.oversized is not None ]
+            snapshot.markOversized(oversized, connection=trans)
+        except:
+            trans.rollback()
+            raise
+        trans.commit(close=True)
+        if len(oversized) > 0:
+            self.ui.writenl(_(" done, %d files, %d skipped for their size") %
+                            (len(files), len(oversized)))
+        else:
+            self.ui.writenl(_(" done, %d files") % len(files))
+        return storage.Snapshot.get(snapshot.id)
+
+class SyncBackfill(object):
+    """Reads the history of a branch backwards, from its snapshot down to
+    its first revision, storing `_backfillchunk` revisions per transaction
+    along with the next revision to read, so that an interrupted backfill
+    resumes where it stopped. With a limit, at most that many revisions
+    are read per sync.
+
+    Going backwards, the lines of code of a file after a change are known
+    already, from the snapshot or from a later change; only the version
+    before the change is read, so each version of a file is read once."""
+
+    def __init__(self, parent, limit=0):
+        self.parent   = parent
+        self.snapshot = parent.snapshot
+        self.limit    = limit
+
+    def process(self):
+        snapshot = self.snapshot
+        # lines of code of the files as of the next revision to read
+        state = snapshot.getState(snapshot.nextRev)
+        count, done = 0, 0
+        while not snapshot.complete and \
+                (self.limit <= 0 or done < self.limit):
+            high = snapshot.nextRev
+            low = max(snapshot.startRev, high - _backfillchunk + 1)
+            if self.limit > 0:
+                low = max(low, high - (self.limit - done) + 1)
+            revisions = list(self.parent.scminst.iterrevs(low, high))
+            revisions.reverse()
+            trans = storage.transaction()
+            try:
+                for scmrev in revisions:
+                    BackfillRevision(self.parent, scmrev).store(state, trans)
+                storage.Snapshot.get(snapshot.id,
+                                     connection=trans).nextRev = low-1
+            except:
+                trans.rollback()
+                raise
+            trans.commit(close=True)
+            snapshot.sync()
+            self.parent.saveboundaries()
+            count += len(revisions)
+            done += high - low + 1
+        return count
+
+class BackfillRevision(object):
+    """A revision read backwards. The lines of code of its files after it
+    come from the state of the backfill, those before it are read from the
+    previous revision, and the state is moved back to them."""
+
+    def __init__(self, parent, scmrev):
+        self.parent  = parent
+        self.ui      = parent.ui
+        self.verbose = parent.verbose
+        self.scmrev  = scmrev
+        self.changes = list(scmrev.iterchanges())
+
+    def plan(self, state):
+        """Return [changetype, path, locs after, locs before, implied]
+        entries, the locs before being a SyncFile when they must be read.
+        Implied entries are files below added or deleted directories."""
+        revno = self.scmrev.id
+        scminst = self.parent.scminst
+        limit = self.parent.sizelimit
+        paths = set([ str(c.path) for c in self.changes ])
+        added = [ str(c.path).rstrip('/') + '/' for c in self.changes
+                  if c.changetype == 'A' and c.path.isdir() ]
+        entries = {}
+        order = []
+
+        def add(changetype, filepath, after, before, implied=False):
+            if filepath in entries:
+                # below a replaced directory, both before and after it
+                entry = entries[filepath]
+                entry[0] = 'R'
+                entry[3] = before
+                return
+            entries[filepath] = [changetype, filepath, after, before, implied]
+            order.append(filepath)
+
+        def isnew(filepath):
+            for prefix in added:
+                if filepath.startswith(prefix):
+                    return True
+            return False
+
+        for change in self.changes:
+            path = change.path
+            filepath = str(path)
+            changetype = change.changetype
+            if path.isdir():
+                prefix = filepath.rstrip('/') + '/'
+                if changetype in ('A', 'R'):
+                    for f in sorted(state.keys()):
+                        if f.startswith(prefix) and f not in paths:
+                            add('A', f, state[f], [], True)
+                if changetype in ('D', 'R'):
+                    for (f, size, binary) in scminst.listfiles(revno-1,
+                                                               filepath):
+                        if f not in paths:
+                            add('D', f, [], SyncFile(self.parent, revno-1,
+                                f, size, binary), True)
+                add(changetype, filepath, [], [])
+                continue
+            after = []
+            if changetype != 'D':
+                after = state.get(filepath, [])
+            if changetype == 'A' or isnew(filepath):
+                before = []
+            elif changetype == 'M' and change.textmodified() is False:
+                before = after
+            elif path.isbinary():
+                before = []
+            else:
+                size = None
+                if limit is not None:
+                    size = path.size()
+                before = SyncFile(self.parent, revno-1, filepath, size,
+                                  False)
+            add(changetype, filepath, after, before)
+        return [ entries[filepath] for filepath in order ]
+
+    def store(self, state, trans):
+        entries = self.plan(state)
+        self.parent.readfiles([ e[3] for e in entries
+                                if isinstance(e[3], SyncFile) ])
+
+        if self.verbose == 1:
+            self.ui.writenl('--- Revision %d ---' % self.scmrev.id)
+            self.ui.flush()
+        else:
+            self.ui.write("  %d " % self.scmrev.id)
+            self.ui.flush()
+
+        storrev = self.parent.branch.insertRevision(
+            self.scmrev.id,
+            self.scmrev.author,
+            self.scmrev.message,
+            self.scmrev.date,
+            connection=trans
+        )
+        rows = []
+        oversized = {}
+        for (changetype, filepath, after, before, implied) in entries:
+            if isinstance(before, SyncFile):
+                before.store(trans)
+                if before.oversized is not None:
+                    oversized[filepath] = before.oversized
+                before = before.locs
+            delta = addlocs(after, before, -1)
+            if implied and len(after) == 0 and len(delta) == 0 and \
+                    filepath not in oversized:
+                continue
             if self.verbose == 1:
-                self.ui.writenl('    (lang=%s,code=%d,comments=%d,blanks=%d)'%\
-                    (loc.language, loc.code, loc.comments, loc.blanks))
+                self.ui.writenl('  %s %s' % (changetype, filepath))
+                if filepath in oversized:
+                    self.ui.writenl('    (skipped, %d bytes)' %
+                                    oversized[filepath])
+                self.ui.flush()
+            rows.append((changetype, filepath, after, delta))
+            if len(before) > 0:
+                state[filepath] = before
+            else:
+                state.pop(filepath, None)
+            if self.verbose != 1:
+                self.ui.write('.')
                 self.ui.flush()
+        ids = storrev.insertChanges(rows, connection=trans)
+        storrev.insertTotals(connection=trans)
+        for filepath, size in oversized.iteritems():
+            # the version before the change was skipped, so is its delta
+            storage.Change.get(ids[filepath],
+                connection=trans).markOversized(size, connection=trans)
 
         if self.verbose != 1:
-            self.ui.write('.')
+            self.ui.writenl('done')
             self.ui.flush()
 
-def execute(repo, ui, verbose):
-    Sync(repo, ui, verbose).process()
+def execute(repo, ui, verbose, jobs=1, depth=0, branchjobs=1, commitevery=1,
+            fetchjobs=1, lookahead=0, prefetchsize=64*1024*1024,
+            contentstore=None, headfirst=False, backfill=0):
+    Sync(repo, ui, verbose, jobs, depth, branchjobs, commitevery,
+         fetchjobs, lookahead, prefetchsize, contentstore, headfirst,
+         backfill).process()
+
+def _initrepoworker(sqldb):
+    _initworker()
+    storage.init(storage.connectionForURI(sqldb))
+
+def _executerepo(args):
+    (repoid, verbose, jobs, depth, branchjobs, commitevery, fetchjobs,
+     lookahead, prefetchsize, storeroot, headfirst, backfill) = args
+    u = _ui.ui()
+    u.pushbuffer()
+    failed = False
+    try:
+        repo = storage.Repository.get(repoid)
+        contentstore = None
+        if storeroot is not None:
+            contentstore = store.ContentStore(storeroot)
+        execute(repo, u, verbose, jobs, depth, branchjobs, commitevery,
+                fetchjobs, lookahead, prefetchsize, contentstore, headfirst,
+                backfill)
+    except error.Abort as inst:
+        u.warn('abort: %s\n' % inst)
+    except Exception:
+        u.warn(traceback.format_exc())
+        failed = True
+    return (repoid, u.popbuffer(), failed)
+
+def executeparallel(repos, ui, verbose, sqldb, parallel, jobs=1, depth=0,
+                    branchjobs=1, commitevery=1, fetchjobs=1, lookahead=0,
+                    prefetchsize=64*1024*1024, contentstore=None,
+                    headfirst=False, backfill=0):
+    """Synchronize several repositories at the same time, each one in its
+    own worker process with its own database connection. The output of
+    each repository is written at once, as soon as it is finished."""
+    if jobs > 1:
+        ui.warn(_("warning: --jobs is ignored when synchronizing "
+                  "repositories in parallel\n"))
+    pool = multiprocessing.Pool(min(parallel, len(repos)),
+                                _initrepoworker, (sqldb,))
+    failures = []
+    storeroot = contentstore and contentstore.root
+    try:
+        args = [ (r.id, verbose, 1, depth, branchjobs, commitevery,
+                  fetchjobs, lookahead, prefetchsize, storeroot, headfirst,
+                  backfill)
+                 for r in repos ]
+        for (repoid, output, failed) in pool.imap_unordered(_executerepo,
+                                                            args):
+            ui.write(output)
+            ui.flush()
+            if failed:
+                failures.append(repoid)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    if len(failures) > 0:
+        raise error.Abort(_("synchronization failed for repositories %s") %
+            ', '.join([str(id) for id in failures]))
 
 # Modeline for vim: set tw=79 et ts=4:
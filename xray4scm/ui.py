@@ -11,26 +11,48 @@ import errno, os, sys, tempfile, traceback
 import error
 
 class ui(object):
-    def __init__(self):
+    def __init__(self, src=None):
         self._buffers = []
         self.quiet = self.verbose = self.debugflag = self.tracebackflag = False
         self._reportuntrusted = True
 
+        if src:
+            self.quiet = src.quiet
+            self.verbose = src.verbose
+            self.debugflag = src.debugflag
+            self.tracebackflag = src.tracebackflag
+            self._reportuntrusted = src._reportuntrusted
+
     def copy(self):
         return self.__class__(self)
 
     def setconfig(self, section, name, value):
         pass
 
+    def pushbuffer(self):
+        self._buffers.append([])
+
+    def popbuffer(self):
+        return "".join(self._buffers.pop())
+
     def write(self, *args):
-        for a in args:
-            sys.stdout.write(str(a))
+        if self._buffers:
+            self._buffers[-1].extend([str(a) for a in args])
+        else:
+            for a in args:
+                sys.stdout.write(str(a))
 
     def writenl(self, *args):
-        for a in args:
-            sys.stdout.write(str(a)+'\n')
+        if self._buffers:
+            self._buffers[-1].extend([str(a)+'\n' for a in args])
+        else:
+            for a in args:
+                sys.stdout.write(str(a)+'\n')
 
     def write_err(self, *args):
+        if self._buffers:
+            self.write(*args)
+            return
         try:
             if not sys.stdout.closed: sys.stdout.flush()
             for a in args:
@@ -7,7 +7,9 @@
 # GNU General Public License version 2, incorporated herein by reference.
 
 import error
-import time, calendar
+from i18n import _
+import time, calendar, threading
+from collections import OrderedDict
 
 # used by parsedate
 defaultdateformats = (
@@ -141,4 +143,101 @@ def parsedate(date, formats=None, defaults=None):
         raise error.Abort(_('impossible time zone offset: %d') % offset)
     return when, offset
 
+_sizeunits = (('m', 2**20), ('k', 2**10), ('g', 2**30),
+              ('kb', 2**10), ('mb', 2**20), ('gb', 2**30), ('b', 1))
+
+def sizetoint(s):
+    """Convert a size specifier like '10mb' to a byte count."""
+    t = s.strip().lower()
+    try:
+        for k, u in _sizeunits:
+            if t.endswith(k):
+                return int(float(t[:-len(k)]) * u)
+        return int(t)
+    except ValueError:
+        raise error.Abort(_("couldn't parse size: %s") % s)
+
+class lrucachedict(object):
+    """Dictionary holding at most `maxsize` entries, the least recently
+    used ones being forgotten first. With a weigh function, entries count
+    for weigh(value) instead of one. Safe to share between threads."""
+
+    def __init__(self, maxsize, weigh=None):
+        self.maxsize = maxsize
+        self._weigh = weigh or (lambda value: 1)
+        self._weight = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._entries.pop(key)
+            self._entries[key] = value # the most recently used
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = value
+            self._weight += self._weigh(value)
+            while self._weight > self.maxsize:
+                self._weight -= self._weigh(
+                    self._entries.popitem(last=False)[1])
+
+    def _discard(self, key, default=None):
+        value = self._entries.pop(key, self)
+        if value is self:
+            return default
+        self._weight -= self._weigh(value)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._discard(key, default)
+
+    def update(self, other):
+        for key, value in other.iteritems():
+            self[key] = value
+
+    def prune(self, match):
+        """Forget the entries whose key satisfies match(key)."""
+        with self._lock:
+            for key in [ k for k in self._entries if match(k) ]:
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._weight = 0
+
+def addlocs(locs, others, sign=1):
+    """Add (or subtract, with a negative sign) two lists of (language,
+    code, comments, blanks) tuples, leaving out languages ending with no
+    lines at all."""
+    totals = {}
+    languages = []
+    for (factor, entries) in ((1, locs), (sign, others)):
+        for (language, code, comments, blanks) in entries:
+            if language not in totals:
+                totals[language] = [0, 0, 0]
+                languages.append(language)
+            counts = totals[language]
+            counts[0] += factor * code
+            counts[1] += factor * comments
+            counts[2] += factor * blanks
+    return [ (language,) + tuple(totals[language])
+             for language in languages if totals[language] != [0, 0, 0] ]
+
 # Modeline for vim: set tw=79 et ts=4: